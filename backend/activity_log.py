@@ -0,0 +1,105 @@
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Dead entries are only dropped from the front of a series once there are this many
+_COMPACT_AFTER = 1024
+
+
+class _Series:
+    """Records in ascending id order, appended at the end and evicted from the front"""
+
+    __slots__ = ('ids', 'records', 'start')
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.records: List[Dict] = []
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.start
+
+    def pop_oldest(self):
+        self.records[self.start] = None
+        self.start += 1
+        if self.start >= _COMPACT_AFTER and self.start * 2 >= len(self.ids):
+            del self.ids[:self.start]
+            del self.records[:self.start]
+            self.start = 0
+
+    def page(self, limit: int, before: Optional[int]) -> Tuple[List[Dict], Optional[int]]:
+        end = len(self.ids) if before is None else bisect_left(self.ids, before, self.start)
+        first = max(self.start, end - limit)
+        page = self.records[first:end]
+        page.reverse()
+        return page, (self.ids[first] if first > self.start else None)
+
+
+class ActivityLog:
+    """
+    The most recent activities of one spreadsheet
+    An append-only ring: once retention records are held, each new record
+    evicts the oldest. Records are also indexed by action, by user and by
+    both, so filtered pages are read from their own series instead of
+    scanning the log.
+    """
+
+    def __init__(self, retention: int):
+        self.retention = retention
+        self._all = _Series()
+        self._indexes: Dict[tuple, _Series] = {}
+
+    def __len__(self) -> int:
+        return len(self._all)
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Records from oldest to newest"""
+        return iter(self._all.records[self._all.start:])
+
+    @staticmethod
+    def _keys(record: Dict) -> Tuple[tuple, tuple, tuple]:
+        action, user_id = record.get('action'), record.get('user_id')
+        return ('action', action), ('user', user_id), ('action_user', action, user_id)
+
+    def append(self, record: Dict) -> List[Dict]:
+        """Add a record newer than every held one; returns the records evicted to make room"""
+        record_id = record['id']
+        indexes = self._indexes
+        self._all.ids.append(record_id)
+        self._all.records.append(record)
+        for key in self._keys(record):
+            series = indexes.get(key)
+            if series is None:
+                series = indexes[key] = _Series()
+            series.ids.append(record_id)
+            series.records.append(record)
+
+        evicted = []
+        while len(self._all) > self.retention:
+            oldest = self._all.records[self._all.start]
+            self._all.pop_oldest()
+            # The oldest record overall is also the oldest of each of its series
+            for key in self._keys(oldest):
+                series = indexes[key]
+                series.pop_oldest()
+                if not series:
+                    del indexes[key]
+            evicted.append(oldest)
+        return evicted
+
+    def page(self, limit: int, before: Optional[int] = None, action: Optional[str] = None,
+             user_id: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Up to limit records with an id below before, newest first, optionally
+        only those with the given action and/or user. Returns the page and the
+        before cursor of the next page, None when it is the last.
+        """
+        if action is not None and user_id is not None:
+            key = ('action_user', action, user_id)
+        elif action is not None:
+            key = ('action', action)
+        elif user_id is not None:
+            key = ('user', user_id)
+        else:
+            return self._all.page(limit, before)
+        series = self._indexes.get(key)
+        return series.page(limit, before) if series is not None else ([], None)
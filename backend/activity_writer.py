@@ -0,0 +1,105 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# Actions whose repeats on one cell by one user are merged into a single activity
+COALESCED_ACTIONS = frozenset({'cell_updated'})
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityWriter:
+    """
+    Records activities from a background thread
+    record() only puts the activity on a bounded queue; when the queue is
+    full it blocks until the writer catches up. An activity in
+    COALESCED_ACTIONS is held for window seconds, and further updates of
+    the same cell by the same user in that time are folded into it: the
+    stored activity keeps the latest details plus a 'count' of the updates.
+    Everything else is written as soon as the writer takes it.
+    """
+
+    def __init__(self, create_activity: Callable[[Dict], Dict], window: float = 2.0,
+                 max_queue: int = 10000):
+        self._create_activity = create_activity
+        self.window = window
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        # coalescing key -> (deadline, activity), in deadline order
+        self._held: Dict[Tuple, Tuple[float, Dict]] = {}
+        self._thread = threading.Thread(target=self._run, name='activity-writer', daemon=True)
+        self._thread.start()
+
+    def record(self, activity: Dict):
+        self._queue.put(activity)
+
+    def flush(self):
+        """Wait until every activity recorded so far, held ones included, is written"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    @staticmethod
+    def _key(activity: Dict) -> Optional[Tuple]:
+        if activity.get('action') not in COALESCED_ACTIONS:
+            return None
+        details = activity.get('details') or {}
+        return (activity.get('spreadsheet_id'), activity.get('user_id'), activity['action'],
+                details.get('sheet_id'), details.get('row'), details.get('column'))
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._held:
+                deadline = next(iter(self._held.values()))[0]
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._write_held(None)
+                return
+            if isinstance(item, threading.Event):
+                self._write_held(None)
+                item.set()
+                continue
+            if item is not None:
+                self._add(item)
+            self._write_held(time.monotonic())
+
+    def _add(self, activity: Dict):
+        key = self._key(activity)
+        if key is None:
+            self._write(activity)
+            return
+        held = self._held.get(key)
+        if held is None:
+            self._held[key] = (time.monotonic() + self.window, activity)
+            return
+        count = held[1].get('details', {}).get('count', 1) + 1
+        activity['details'] = {**activity.get('details', {}), 'count': count}
+        self._held[key] = (held[0], activity)
+
+    def _write_held(self, now: Optional[float]):
+        """Write the held activities whose window is over by now, or all of them"""
+        while self._held:
+            key, (deadline, activity) = next(iter(self._held.items()))
+            if now is not None and deadline > now:
+                break
+            del self._held[key]
+            self._write(activity)
+
+    def _write(self, activity: Dict):
+        try:
+            self._create_activity(activity)
+        except Exception:
+            # A failed write loses that activity, never the writer thread
+            logger.exception('Failed to record activity %r', activity.get('action'))
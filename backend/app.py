@@ -1,17 +1,47 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from models import SpreadsheetModel
+from activity_writer import ActivityWriter
+from models import DEFAULT_ACTIVITY_RETENTION, LoggedSpreadsheetModel, PersistentSpreadsheetModel, SpreadsheetModel
+from parallel_recalc import ParallelRecalculator
 from routes import register_routes
+from sheet_events import SheetEventHub
+import atexit
 import os
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize the model
-model = SpreadsheetModel()
+# Initialize the model. Set PIXELSHEET_DB to a file path to persist data in
+# SQLite, or PIXELSHEET_WAL_DIR to a directory to keep it in memory with a
+# write-ahead log and snapshots; otherwise nothing outlives the process.
+# PIXELSHEET_ACTIVITY_RETENTION caps the activities kept per spreadsheet.
+# PIXELSHEET_RECALC_WORKERS above 1 spreads large recalculations over that
+# many worker processes.
+database_path = os.environ.get('PIXELSHEET_DB')
+log_directory = os.environ.get('PIXELSHEET_WAL_DIR')
+activity_retention = int(os.environ.get('PIXELSHEET_ACTIVITY_RETENTION', DEFAULT_ACTIVITY_RETENTION))
+recalc_workers = int(os.environ.get('PIXELSHEET_RECALC_WORKERS', 0))
+recalculator = ParallelRecalculator(recalc_workers) if recalc_workers > 1 else None
+if database_path:
+    model = PersistentSpreadsheetModel(database_path, activity_retention=activity_retention,
+                                       recalculator=recalculator)
+elif log_directory:
+    model = LoggedSpreadsheetModel(log_directory, activity_retention=activity_retention,
+                                   recalculator=recalculator)
+else:
+    model = SpreadsheetModel(activity_retention=activity_retention, recalculator=recalculator)
+
+# Activities are written by a background thread; write the held ones on exit
+activity_writer = ActivityWriter(model.create_activity)
+atexit.register(activity_writer.close)
+sheet_events = SheetEventHub(model)
+atexit.register(sheet_events.close)
+# Drop formula engines of sheets nobody has used for a while, even once traffic stops
+model.engines.start_evicting()
+atexit.register(model.engines.close)
 
 # Register routes
-register_routes(app, model)
+register_routes(app, model, activity_writer, sheet_events)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
@@ -0,0 +1,135 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from cell_record import Cell
+
+
+class SheetIndex:
+    """
+    Spatial index of the cells of one sheet
+    Point lookups go through a (row, column) dict; range queries walk the
+    sorted row keys so they only touch rows that hold cells.
+    """
+
+    def __init__(self):
+        self.cells: Dict[Tuple[int, int], Cell] = {}
+        # Tuple of the cells, shared by readers until a cell is added or removed
+        self._snapshot: Optional[Tuple[Cell, ...]] = None
+        self.rows: Dict[int, Dict[int, Cell]] = {}
+        # column -> how many cells it holds, so column_keys knows when one empties
+        self.column_counts: Dict[int, int] = {}
+        self.row_keys: List[int] = []
+        self.column_keys: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def __iter__(self) -> Iterator[Cell]:
+        return iter(self.cells.values())
+
+    def get(self, row: int, column: int) -> Optional[Cell]:
+        return self.cells.get((row, column))
+
+    def snapshot(self) -> Tuple[Cell, ...]:
+        """The cells as a tuple, only rebuilt after the index changed"""
+        cells = self._snapshot
+        if cells is None:
+            cells = self._snapshot = tuple(self.cells.values())
+        return cells
+
+    def add(self, cell: Cell):
+        row, column = cell.row, cell.column
+        assert (row, column) not in self.cells, f"row {row}, column {column} already holds a cell"
+        self._snapshot = None
+        self.cells[(row, column)] = cell
+        if row not in self.rows:
+            self.rows[row] = {}
+            insort(self.row_keys, row)
+        self.rows[row][column] = cell
+        count = self.column_counts.get(column, 0)
+        if not count:
+            insort(self.column_keys, column)
+        self.column_counts[column] = count + 1
+
+    def remove(self, row: int, column: int) -> Optional[Cell]:
+        cell = self.cells.pop((row, column), None)
+        if cell is None:
+            return None
+        self._snapshot = None
+        row_cells = self.rows[row]
+        del row_cells[column]
+        if not row_cells:
+            del self.rows[row]
+            del self.row_keys[bisect_left(self.row_keys, row)]
+        count = self.column_counts[column] - 1
+        if count:
+            self.column_counts[column] = count
+        else:
+            del self.column_counts[column]
+            del self.column_keys[bisect_left(self.column_keys, column)]
+        return cell
+
+    def rows_between(self, top: int, bottom: int) -> List[int]:
+        """Row numbers holding cells, in order, within [top, bottom]"""
+        return self.row_keys[bisect_left(self.row_keys, top):bisect_right(self.row_keys, bottom)]
+
+    def in_range(self, top: int, left: int, bottom: int, right: int) -> List[Cell]:
+        """Cells inside the rectangle, in row-major order"""
+        result = []
+        width = right - left + 1
+        for row in self.rows_between(top, bottom):
+            row_cells = self.rows[row]
+            if len(row_cells) <= width:
+                for column in sorted(row_cells):
+                    if left <= column <= right:
+                        result.append(row_cells[column])
+            else:
+                for column in range(left, right + 1):
+                    cell = row_cells.get(column)
+                    if cell is not None:
+                        result.append(cell)
+        return result
+
+
+class LazySheetIndexes(dict):
+    """
+    sheet_id -> SheetIndex mapping with entries that are built on first access
+    Sheets marked pending are loaded by loader(sheet_id) the first time they
+    are looked up; removing a pending sheet drops it without loading it.
+    """
+
+    def __init__(self, loader: Callable[[int], SheetIndex]):
+        super().__init__()
+        self.loader = loader
+        self.pending: Set[int] = set()
+        # Held while a sheet loads
+        self.load_lock = threading.Lock()
+
+    def _load(self, sheet_id: int):
+        if sheet_id in self.pending:
+            with self.load_lock:
+                if sheet_id in self.pending:
+                    super().__setitem__(sheet_id, self.loader(sheet_id))
+                    # Discarded only once loaded, so a concurrent reader of
+                    # pending and the loaded cells sees the sheet in one or the other
+                    self.pending.discard(sheet_id)
+
+    def get(self, sheet_id: int, default=None):
+        self._load(sheet_id)
+        return super().get(sheet_id, default)
+
+    def __getitem__(self, sheet_id: int) -> SheetIndex:
+        self._load(sheet_id)
+        return super().__getitem__(sheet_id)
+
+    def __contains__(self, sheet_id) -> bool:
+        return sheet_id in self.pending or super().__contains__(sheet_id)
+
+    def __setitem__(self, sheet_id: int, index: SheetIndex):
+        self.pending.discard(sheet_id)
+        super().__setitem__(sheet_id, index)
+
+    def pop(self, sheet_id: int, *default):
+        self.pending.discard(sheet_id)
+        return super().pop(sheet_id, *default)
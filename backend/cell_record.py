@@ -0,0 +1,217 @@
+import time
+from datetime import datetime
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from gc_utils import paused_gc
+from style_table import StyleTable
+
+
+class DataType(str, Enum):
+    TEXT = 'text'
+    NUMBER = 'number'
+    DATE = 'date'
+    BOOLEAN = 'boolean'
+    FORMULA = 'formula'
+
+
+# DataType.value goes through a descriptor; serializing many cells reads it from here
+_DATA_TYPE_VALUES = {None: None, **{data_type: data_type.value for data_type in DataType}}
+
+def now_timestamp() -> int:
+    """The current local time as integer microseconds since the epoch"""
+    return time.time_ns() // 1000
+
+
+# Cells written together share a timestamp, so conversions repeat a lot
+@lru_cache(maxsize=4096)
+def timestamp_to_iso(timestamp: int) -> str:
+    seconds, microseconds = divmod(timestamp, 1_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=microseconds).isoformat()
+
+
+def iso_to_timestamp(value: str) -> int:
+    moment = datetime.fromisoformat(value)
+    return int(moment.replace(microsecond=0).timestamp()) * 1_000_000 + moment.microsecond
+
+
+def _timestamp(value: Any) -> int:
+    return iso_to_timestamp(value) if isinstance(value, str) else int(value)
+
+
+class Cell:
+    """
+    Compact record for one cell
+    Timestamps are integer microseconds, data_type is a DataType and
+    formatting is a style id in the spreadsheet's StyleTable. Fields outside
+    the fixed set go in extra.
+    Cells also read like the dicts they replace (cell['row'], get, update,
+    'calculated_value' in cell), in their API form; to_dict gives the JSON view.
+    """
+
+    __slots__ = ('id', 'sheet_id', 'row', 'column', 'value', 'formula', 'data_type',
+                 'style_id', 'created_at', 'updated_at', 'calculated_value', 'extra')
+
+    FIELDS = __slots__[:-1]
+    # Kept by the model; a write cannot set them
+    MANAGED = ('id', 'style_id', 'created_at', 'updated_at', 'calculated_value')
+
+    def __init__(self, id: int, sheet_id: int, row: int, column: int, value: Any = '',
+                 formula: Optional[str] = None, data_type: Optional[DataType] = DataType.TEXT,
+                 style_id: int = 0, created_at: int = 0, updated_at: int = 0,
+                 extra: Optional[Dict] = None):
+        self.id = id
+        self.sheet_id = sheet_id
+        self.row = row
+        self.column = column
+        self.value = value
+        self.formula = formula
+        self.data_type = data_type
+        self.style_id = style_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+        # The last result of the formula, None when not calculated
+        self.calculated_value = None
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Cell':
+        cell = cls(data.get('id'), data.get('sheet_id'), data.get('row'), data.get('column'))
+        cell.update(data)
+        return cell
+
+    def to_dict(self, styles: Optional[StyleTable] = None) -> Dict:
+        """The JSON form of the cell, with its formatting spelled out when given the style table"""
+        result = {
+            'id': self.id,
+            'sheet_id': self.sheet_id,
+            'row': self.row,
+            'column': self.column,
+            'value': self.value,
+            'formula': self.formula,
+            'data_type': _DATA_TYPE_VALUES[self.data_type],
+            'style_id': self.style_id,
+            'created_at': timestamp_to_iso(self.created_at),
+            'updated_at': timestamp_to_iso(self.updated_at)
+        }
+        if styles is not None:
+            result['formatting'] = styles[self.style_id]
+        if self.extra:
+            result.update(self.extra)
+        if self.calculated_value is not None:
+            result['calculated_value'] = self.calculated_value
+        return result
+
+    # Stored state: everything but the calculated result
+    def __getstate__(self) -> Tuple:
+        return (self.id, self.sheet_id, self.row, self.column, self.value, self.formula,
+                self.data_type.value if self.data_type is not None else None, self.style_id,
+                self.created_at, self.updated_at, self.extra)
+
+    def __setstate__(self, state: Tuple):
+        (self.id, self.sheet_id, self.row, self.column, self.value, self.formula, data_type,
+         self.style_id, self.created_at, self.updated_at, self.extra) = state
+        self.data_type = DataType(data_type) if data_type is not None else None
+        self.calculated_value = None
+
+    # Dict-style access, in the JSON form
+    def __setitem__(self, key: str, value: Any):
+        if key == 'data_type':
+            value = DataType(value) if value is not None else None
+        elif key in ('created_at', 'updated_at'):
+            value = _timestamp(value)
+        elif key not in self.FIELDS:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+        setattr(self, key, value)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if key in ('created_at', 'updated_at'):
+                return timestamp_to_iso(value)
+            if key == 'data_type':
+                return value.value if value is not None else None
+            if key == 'calculated_value' and value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __contains__(self, key: str) -> bool:
+        if key == 'calculated_value':
+            return self.calculated_value is not None
+        return key in self.FIELDS or (self.extra is not None and key in self.extra)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, updates: Dict):
+        for key, value in updates.items():
+            self[key] = value
+
+    def pop(self, key: str, *default) -> Any:
+        if key == 'calculated_value':
+            value, self.calculated_value = self.calculated_value, None
+            if value is not None:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra.pop(key)
+        elif key in self.FIELDS:
+            raise KeyError(f"{key} cannot be removed from a cell")
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def keys(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return iter(self.to_dict().items())
+
+    def __repr__(self) -> str:
+        return f"Cell({self.to_dict()!r})"
+
+
+# The fields of the compact layouts, in order. sheet_id is left out: every
+# cell of a response belongs to the same sheet.
+COMPACT_FIELDS = ('id', 'row', 'column', 'value', 'formula', 'data_type', 'style_id',
+                  'created_at', 'updated_at', 'calculated_value')
+
+
+def cells_to_rows(cells: Iterable[Cell]) -> Tuple[List[str], List[List]]:
+    """
+    Cells as one array each, and the keys naming the array positions: the
+    COMPACT_FIELDS, then any extra fields the cells have (null where a cell
+    lacks one). Formatting is left to the style table.
+    """
+    cells = list(cells)
+    extra_keys = sorted({key for cell in cells if cell.extra for key in cell.extra})
+    rows = []
+    with paused_gc():
+        for cell in cells:
+            row = [cell.id, cell.row, cell.column, cell.value, cell.formula,
+                   _DATA_TYPE_VALUES[cell.data_type], cell.style_id,
+                   timestamp_to_iso(cell.created_at), timestamp_to_iso(cell.updated_at),
+                   cell.calculated_value]
+            if extra_keys:
+                extra = cell.extra or {}
+                row.extend([extra.get(key) for key in extra_keys])
+            rows.append(row)
+    return list(COMPACT_FIELDS) + extra_keys, rows
+
+
+def cells_to_columns(cells: Iterable[Cell]) -> Dict[str, List]:
+    """Cells as one array per field, keyed like the positions of cells_to_rows"""
+    keys, rows = cells_to_rows(cells)
+    if not rows:
+        return {key: [] for key in keys}
+    with paused_gc():
+        return dict(zip(keys, map(list, zip(*rows))))
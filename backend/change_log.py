@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+Position = Tuple[int, int]
+
+
+class SheetChangeLog:
+    """
+    The version of the last write to each changed position of one sheet
+    A position written again moves to the end, so entries stay in version
+    order and the changes since a version are read from the end backwards.
+    Beyond max_entries the oldest entries are dropped and the horizon moves
+    up to their version: changes since an older version are no longer known.
+    """
+
+    def __init__(self, max_entries: int, horizon: int = 0):
+        self.max_entries = max_entries
+        self.horizon = horizon
+        # position -> (version, removed)
+        self._entries: 'OrderedDict[Position, Tuple[int, bool]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, version: int, positions: Iterable[Position], removed: bool = False):
+        entries = self._entries
+        for position in positions:
+            entries.pop(position, None)
+            entries[position] = (version, removed)
+        while len(entries) > self.max_entries:
+            _, (dropped, _) = entries.popitem(last=False)
+            self.horizon = max(self.horizon, dropped)
+
+    def since(self, version: int) -> Optional[Tuple[List[Position], List[Position]]]:
+        """
+        The positions written and the positions emptied after version, or
+        None when version is older than the horizon.
+        """
+        if version < self.horizon:
+            return None
+        written, removed = [], []
+        for position in reversed(self._entries):
+            changed_at, was_removed = self._entries[position]
+            if changed_at <= version:
+                break
+            (removed if was_removed else written).append(position)
+        return written, removed
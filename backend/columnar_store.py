@@ -0,0 +1,147 @@
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+Position = Tuple[int, int]
+
+
+class ColumnStore:
+    """
+    One column of a sheet
+    Numbers live in a float64 array indexed by row with a validity mask;
+    text, formulas and anything else live in a row -> object dict.
+    """
+
+    __slots__ = ('numbers', 'valid', 'objects')
+
+    def __init__(self):
+        self.numbers = np.zeros(0, dtype=np.float64)
+        self.valid = np.zeros(0, dtype=bool)
+        self.objects: Dict[int, Any] = {}
+
+    def _reserve(self, row: int):
+        size = len(self.numbers)
+        if row < size:
+            return
+        capacity = max(16, row + 1, size * 2)
+        numbers = np.zeros(capacity, dtype=np.float64)
+        valid = np.zeros(capacity, dtype=bool)
+        numbers[:size] = self.numbers
+        valid[:size] = self.valid
+        self.numbers, self.valid = numbers, valid
+
+    def get(self, row: int) -> Any:
+        if row < len(self.valid) and self.valid[row]:
+            return float(self.numbers[row])
+        return self.objects.get(row)
+
+    def set_number(self, row: int, value: float):
+        self.objects.pop(row, None)
+        self._reserve(row)
+        self.numbers[row] = value
+        self.valid[row] = True
+
+    def set_object(self, row: int, value: Any):
+        if row < len(self.valid):
+            self.valid[row] = False
+            self.numbers[row] = 0.0
+        self.objects[row] = value
+
+    def remove(self, row: int) -> bool:
+        if row < len(self.valid) and self.valid[row]:
+            self.valid[row] = False
+            self.numbers[row] = 0.0
+            return True
+        return self.objects.pop(row, None) is not None
+
+    def rows(self) -> List[int]:
+        """Occupied rows, in order"""
+        numeric = np.flatnonzero(self.valid).tolist()
+        return sorted(numeric + list(self.objects)) if self.objects else numeric
+
+
+class ColumnarSheet:
+    """
+    Array-backed storage for the cell values of one sheet, keyed by (row, column)
+    Behaves like a dict of positions to values: numbers come back as floats,
+    everything else as stored.
+    """
+
+    def __init__(self):
+        self.columns: Dict[int, ColumnStore] = {}
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, position: Position) -> bool:
+        return self.get(position) is not None
+
+    def get(self, position: Position, default: Any = None) -> Any:
+        column = self.columns.get(position[1])
+        if column is None:
+            return default
+        value = column.get(position[0])
+        return default if value is None else value
+
+    def __getitem__(self, position: Position) -> Any:
+        value = self.get(position)
+        if value is None:
+            raise KeyError(position)
+        return value
+
+    def __setitem__(self, position: Position, value: Any):
+        row, col = position
+        column = self.columns.get(col)
+        if column is None:
+            column = self.columns[col] = ColumnStore()
+        elif column.remove(row):
+            self.count -= 1
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            column.set_number(row, value)
+        else:
+            column.set_object(row, value)
+        self.count += 1
+
+    def pop(self, position: Position, default: Any = None) -> Any:
+        value = self.get(position)
+        if value is None:
+            return default
+        self.columns[position[1]].remove(position[0])
+        self.count -= 1
+        return value
+
+    def items(self) -> Iterator[Tuple[Position, Any]]:
+        for col in sorted(self.columns):
+            column = self.columns[col]
+            for row in column.rows():
+                yield (row, col), column.get(row)
+
+    def keys(self) -> Iterator[Position]:
+        for position, _ in self.items():
+            yield position
+
+    __iter__ = keys
+
+    def numeric_slice(self, column: int, top: int, bottom: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Contiguous views of the numbers and validity mask of rows top..bottom
+        in one column. Rows past the end of the stored arrays are omitted.
+        """
+        store = self.columns.get(column)
+        if store is None:
+            empty = np.zeros(0, dtype=np.float64)
+            return empty, np.zeros(0, dtype=bool)
+        end = min(bottom + 1, len(store.numbers))
+        start = min(top, end)
+        return store.numbers[start:end], store.valid[start:end]
+
+    def objects_between(self, column: int, top: int, bottom: int) -> List[Tuple[int, Any]]:
+        """Non-numeric values of rows top..bottom in one column, in row order"""
+        store = self.columns.get(column)
+        if store is None or not store.objects:
+            return []
+        objects = store.objects
+        if len(objects) <= bottom - top + 1:
+            return sorted((row, value) for row, value in objects.items() if top <= row <= bottom)
+        return [(row, objects[row]) for row in range(top, bottom + 1) if row in objects]
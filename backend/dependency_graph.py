@@ -0,0 +1,111 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+Position = Tuple[int, int]
+Range = Tuple[int, int, int, int]
+
+
+class DependencyGraph:
+    """
+    Precedent/dependent graph for the formulas of one sheet
+    Direct cell references are stored as edges; range references are
+    bucketed by column so a changed cell only checks ranges that cover it.
+    """
+
+    def __init__(self):
+        self.precedents: Dict[Position, Tuple[Tuple[Position, ...], Tuple[Range, ...]]] = {}
+        self.dependents: Dict[Position, Set[Position]] = {}
+        self.range_columns: Dict[int, Set[Position]] = {}
+
+    def set_formula(self, position: Position, cells: Iterable[Position], ranges: Iterable[Range]):
+        """Record the cells and ranges read by the formula at position"""
+        self.remove_formula(position)
+        cells, ranges = tuple(cells), tuple(ranges)
+        self.precedents[position] = (cells, ranges)
+        for cell in cells:
+            self.dependents.setdefault(cell, set()).add(position)
+        for _, left, _, right in ranges:
+            for column in range(left, right + 1):
+                self.range_columns.setdefault(column, set()).add(position)
+
+    def remove_formula(self, position: Position):
+        """Forget the precedents of position, e.g. when it no longer holds a formula"""
+        entry = self.precedents.pop(position, None)
+        if entry is None:
+            return
+        cells, ranges = entry
+        for cell in cells:
+            dependents = self.dependents.get(cell)
+            if dependents is not None:
+                dependents.discard(position)
+                if not dependents:
+                    del self.dependents[cell]
+        for _, left, _, right in ranges:
+            for column in range(left, right + 1):
+                bucket = self.range_columns.get(column)
+                if bucket is not None:
+                    bucket.discard(position)
+                    if not bucket:
+                        del self.range_columns[column]
+
+    def is_formula(self, position: Position) -> bool:
+        return position in self.precedents
+
+    def direct_dependents(self, position: Position) -> Set[Position]:
+        """Formulas that read position directly or through a range"""
+        result = set(self.dependents.get(position, ()))
+        row, column = position
+        for formula in self.range_columns.get(column, ()):
+            for top, left, bottom, right in self.precedents[formula][1]:
+                if top <= row <= bottom and left <= column <= right:
+                    result.add(formula)
+                    break
+        return result
+
+    def dirty_cells(self, changed: Iterable[Position]) -> Set[Position]:
+        """Changed formulas plus every formula downstream of the changed cells"""
+        dirty = set()
+        queue = deque(changed)
+        for position in queue:
+            if position in self.precedents:
+                dirty.add(position)
+        while queue:
+            position = queue.popleft()
+            for dependent in self.direct_dependents(position):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    queue.append(dependent)
+        return dirty
+
+    def recalculation_order(self, changed: Iterable[Position]) -> List[Position]:
+        """
+        Dirty formulas in topological order, precedents first
+        Formulas caught in a cycle cannot be ordered and are appended last.
+        """
+        dirty = self.dirty_cells(changed)
+        return self.topological_order(dirty)
+
+    def topological_order(self, positions: Set[Position]) -> List[Position]:
+        """Order formula positions so that each comes after the formulas it reads"""
+        pending = {position: 0 for position in positions}
+        edges: Dict[Position, List[Position]] = {}
+        for position in positions:
+            for dependent in self.direct_dependents(position):
+                if dependent in pending:
+                    pending[dependent] += 1
+                    edges.setdefault(position, []).append(dependent)
+
+        ready = deque(sorted(p for p, count in pending.items() if count == 0))
+        order = []
+        while ready:
+            position = ready.popleft()
+            order.append(position)
+            for dependent in edges.get(position, ()):
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) < len(positions):
+            ordered = set(order)
+            order.extend(sorted(p for p in positions if p not in ordered))
+        return order
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from formula_engine import FormulaEngine
+
+
+class EngineRegistry:
+    """
+    Warm FormulaEngine instances, one per sheet
+    Engines are built on first use by the loader, kept in sync by the model
+    as cells change, and evicted when idle or when the registry is full.
+    Idle engines are dropped on every get(), and by a background thread once
+    start_evicting() is called, so they go even when traffic stops.
+    The registry may be used from many threads; using one sheet's engine is
+    left to the caller's lock on that sheet, which is held while it loads.
+    """
+
+    def __init__(self, loader: Callable[[int], FormulaEngine], max_engines: int = 32,
+                 idle_seconds: float = 900, clock: Callable[[], float] = time.monotonic):
+        self.loader = loader
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.engines: "OrderedDict[int, FormulaEngine]" = OrderedDict()
+        self.last_used: Dict[int, float] = {}
+        # Guards engines and last_used; loaders run outside it
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, sheet_id: int) -> FormulaEngine:
+        """Engine for a sheet, loading it if it is not warm"""
+        engine = self.peek(sheet_id)
+        if engine is None:
+            engine = self.loader(sheet_id)
+        with self._lock:
+            engine = self.engines.setdefault(sheet_id, engine)
+            self.last_used[sheet_id] = self.clock()
+            self._evict_idle()
+        return engine
+
+    def peek(self, sheet_id: int) -> Optional[FormulaEngine]:
+        """Engine for a sheet if it is warm, without loading it"""
+        with self._lock:
+            engine = self.engines.get(sheet_id)
+            if engine is not None:
+                self.engines.move_to_end(sheet_id)
+                self.last_used[sheet_id] = self.clock()
+        return engine
+
+    def evict(self, sheet_id: int):
+        with self._lock:
+            self._evict(sheet_id)
+
+    def evict_idle(self):
+        """Drop engines unused for idle_seconds, then the least recently used beyond max_engines"""
+        with self._lock:
+            self._evict_idle()
+
+    def _evict(self, sheet_id: int):
+        self.engines.pop(sheet_id, None)
+        self.last_used.pop(sheet_id, None)
+
+    def start_evicting(self, interval: float = 60):
+        """Call evict_idle() from a background thread every interval seconds"""
+        def run():
+            while not self._stop.wait(interval):
+                self.evict_idle()
+
+        self._thread = threading.Thread(target=run, name='engine-eviction', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _evict_idle(self):
+        cutoff = self.clock() - self.idle_seconds
+        for sheet_id in [s for s, used in self.last_used.items() if used < cutoff]:
+            self._evict(sheet_id)
+        while len(self.engines) > self.max_engines:
+            sheet_id, _ = self.engines.popitem(last=False)
+            self.last_used.pop(sheet_id, None)
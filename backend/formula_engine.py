@@ -1,16 +1,77 @@
-import re
 import math
-from typing import Dict, List, Union, Any
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union, Any
+
+import numpy as np
+
+from columnar_store import ColumnarSheet
+from dependency_graph import DependencyGraph
+from gc_utils import paused_gc
+from range_cache import RangeAggregateCache
+from formula_parser import (
+    CompiledFormula,
+    FormulaError,
+    RangeRef,
+    compile_formula,
+    column_to_number,
+    number_to_column,
+    parse_cell_key,
+    to_text,
+)
+
+CIRCULAR_ERROR = '#CIRCULAR'
+
+
+class CircularReferenceError(FormulaError):
+    """Raised when a formula depends on its own result"""
+
+    def __init__(self):
+        super().__init__(CIRCULAR_ERROR)
+
+    def __reduce__(self):
+        # Results cross process boundaries in parallel recalculation
+        return CircularReferenceError, ()
+
+
+class RecalcContext:
+    """
+    Bookkeeping for one recalculation pass
+    Results live in FormulaEngine.results, so each cell is evaluated at most
+    once per pass (and not again until one of its precedents changes).
+    """
+
+    def __init__(self):
+        self.in_progress: Set[Tuple[int, int]] = set()
+        self.evaluations = 0
+        self.cache_hits = 0
+
+    def stats(self) -> Dict[str, int]:
+        """How many formulas were evaluated and how many evaluations the memo saved"""
+        return {'evaluations': self.evaluations, 'evaluations_saved': self.cache_hits}
 
 
 class FormulaEngine:
     """
     A comprehensive formula engine for spreadsheet calculations
     Supports basic arithmetic, statistical functions, and cell references
+    Given a recalculator, large batches of stale formulas are evaluated by
+    it across processes instead of one by one.
+    Formulas bulk-loaded by load_cells keep their text until they are first
+    evaluated or their precedents are first needed, so reading part of a
+    sheet only compiles the formulas it reaches. Looking up dependents needs
+    every formula's references, and compiles the rest.
     """
-    
-    def __init__(self):
-        self.cells: Dict[str, str] = {}
+
+    def __init__(self, recalculator=None):
+        # (row, column) -> float, str, CompiledFormula or FormulaError; a str starting
+        # with = is the text of a formula not compiled yet
+        self.cells = ColumnarSheet()
+        self.aggregates = RangeAggregateCache(self.cells)
+        # (row, column) -> last result (or FormulaError) of each formula cell
+        self.results: Dict[Tuple[int, int], Any] = {}
+        self.graph = DependencyGraph()
+        # Positions of the formulas still held as text; the graph knows only the others
+        self.uncompiled: Set[Tuple[int, int]] = set()
         self.functions = {
             'SUM': self._sum,
             'AVERAGE': self._average,
@@ -23,7 +84,6 @@ class FormulaEngine:
             'SQRT': self._sqrt,
             'POWER': self._power,
             'POW': self._power,
-            'IF': self._if,
             'CONCATENATE': self._concatenate,
             'CONCAT': self._concatenate,
             'LEN': self._len,
@@ -37,439 +97,478 @@ class FormulaEngine:
             'TODAY': self._today,
             'NOW': self._now,
         }
-    
+        self.context: Optional[RecalcContext] = None
+        self.last_pass: Optional[RecalcContext] = None
+        self.recalculator = recalculator
+
     def set_cells(self, cells: Dict[str, str]):
-        """Set the cell values for reference resolution"""
-        self.cells = cells.copy()
-    
+        """Set the cell values for reference resolution, keyed by A1 references"""
+        self.cells = ColumnarSheet()
+        self.aggregates = RangeAggregateCache(self.cells)
+        self.results = {}
+        self.graph = DependencyGraph()
+        self.uncompiled = set()
+        for cell_id, value in cells.items():
+            self.set_cell(parse_cell_key(cell_id), value)
+
+    def load_cells(self, cells: Iterable[Tuple[Tuple[int, int], str]]):
+        """
+        Bulk-load raw values into an empty engine
+        Skips the per-cell invalidation of set_cell, which has nothing to
+        invalidate before the first evaluation. Formulas are stored as text
+        and compiled when first needed.
+        """
+        store, uncompiled = self.cells, self.uncompiled
+        with paused_gc():
+            for position, value in cells:
+                if value is None or value == '':
+                    continue
+                value = str(value)
+                if value.startswith('='):
+                    uncompiled.add(position)
+                    store[position] = value
+                    continue
+                try:
+                    store[position] = float(value)
+                except ValueError:
+                    store[position] = value
+        self.aggregates.clear()
+
+    def set_cell(self, position: Tuple[int, int], value: str):
+        """
+        Store a single raw cell value, pre-parsing numbers and formulas
+        Results of the formulas downstream of the cell are invalidated;
+        call recalculate to recompute them.
+        """
+        if self.results:
+            for dirty in self.dirty_cells([position]):
+                self.results.pop(dirty, None)
+        old = self.cells.pop(position, None)
+        self.results.pop(position, None)
+        self.uncompiled.discard(position)
+        self.graph.remove_formula(position)
+        if value is not None and value != '':
+            self.cells[position] = self._parse_value(position, str(value))
+        self.aggregates.cell_changed(position, old, self.cells.get(position))
+
+    def _parse_value(self, position: Tuple[int, int], value: str) -> Any:
+        if value.startswith('='):
+            try:
+                compiled = compile_formula(value)
+            except FormulaError as e:
+                self.graph.set_formula(position, (), ())
+                return e
+            self.graph.set_formula(position, compiled.cells, compiled.ranges)
+            return compiled
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    def _compile(self, position: Tuple[int, int], value: Any) -> Any:
+        """The stored value of a cell, with the formula text of an uncompiled one compiled in place"""
+        if type(value) is not str or position not in self.uncompiled:
+            return value
+        self.uncompiled.discard(position)
+        value = self.cells[position] = self._parse_value(position, value)
+        return value
+
+    def _compile_all(self):
+        """Compile every formula still held as text, so the graph knows all of them"""
+        if not self.uncompiled:
+            return
+        cells = self.cells
+        with paused_gc():
+            for position in list(self.uncompiled):
+                self._compile(position, cells.get(position))
+
+    def is_formula(self, position: Tuple[int, int]) -> bool:
+        return position in self.uncompiled or self.graph.is_formula(position)
+
+    def dirty_cells(self, changed: Iterable[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+        """Changed formulas plus every formula downstream of the changed cells"""
+        self._compile_all()
+        return self.graph.dirty_cells(changed)
+
+    def recalculate(self, changed: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], Union[str, float, int]]:
+        """
+        Recompute the formulas downstream of the changed positions in
+        topological order. Returns the new result of each recomputed formula.
+        """
+        self._compile_all()
+        order = self.graph.recalculation_order(changed)
+        return self._evaluate_in_order(order)
+
+    def recalculate_all(self) -> Dict[Tuple[int, int], Union[str, float, int]]:
+        """Recompute every formula in the sheet"""
+        self.results = {}
+        self._compile_all()
+        # evaluate_cells puts the stale formulas in order
+        return self.evaluate_cells(list(self.graph.precedents))
+
+    def _evaluate_in_order(self, order: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Union[str, float, int]]:
+        for position in order:
+            self.results.pop(position, None)
+        return self.evaluate_cells(order)
+
+    def evaluate_cells(self, positions: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], Union[str, float, int]]:
+        """
+        Results of the given cells. Stale formulas among them and their
+        precedents are evaluated first, in topological order, so only what
+        the cells need is computed and long chains do not recurse deeply.
+        """
+        positions = list(positions)
+        stale = self._stale_precedents(positions)
+        evaluated = {}
+        with self.recalculation_pass():
+            if self.recalculator is None or not self.recalculator.evaluate(self, stale):
+                for position in self.graph.topological_order(stale):
+                    self.evaluate_cell(position)
+            for position in positions:
+                result = self.results.get(position)
+                if type(result) is float:
+                    evaluated[position] = int(result) if result.is_integer() else result
+                elif type(result) is str:
+                    evaluated[position] = result
+                else:
+                    evaluated[position] = self.evaluate_cell(position)
+        return evaluated
+
+    def _stale_precedents(self, positions: Iterable[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+        """
+        Formulas without a current result among positions and everything they
+        read, each compiled as it is reached
+        """
+        precedents, uncompiled = self.graph.precedents, self.uncompiled
+        stale = set()
+        stack = [p for p in positions if (p in precedents or p in uncompiled) and p not in self.results]
+        if not self.results:
+            requested = set(stack)
+            if len(requested) == len(precedents) + len(uncompiled):
+                # No formula has a result and every one was asked for: nothing to walk
+                self._compile_all()
+                return requested
+        while stack:
+            position = stack.pop()
+            if position in stale:
+                continue
+            stale.add(position)
+            if position in uncompiled:
+                self._compile(position, self.cells.get(position))
+            cells, ranges = precedents[position]
+            for cell in cells:
+                if (cell in precedents or cell in uncompiled) and cell not in self.results and cell not in stale:
+                    stack.append(cell)
+            for top, left, bottom, right in ranges:
+                for column in range(left, right + 1):
+                    for row in self.aggregates.formula_rows(column, top, bottom):
+                        cell = (row, column)
+                        if cell not in self.results and cell not in stale:
+                            stack.append(cell)
+        return stale
+
     def evaluate(self, formula: str) -> Union[str, float, int]:
         """
         Evaluate a formula and return the result
         Supports:
-        - Basic arithmetic (+, -, *, /, %, ^)
+        - Basic arithmetic (+, -, *, /, %, ^) and comparisons (=, <>, <, >, <=, >=)
+        - Text concatenation (&)
         - Cell references (A1, B2, etc.)
         - Range references (A1:B3)
         - Functions (SUM, AVERAGE, etc.)
         - Nested formulas
+
+        Formulas are compiled once and cached by their text, so repeated
+        evaluation never re-parses the expression.
         """
         try:
             if not formula.startswith('='):
                 return formula
-            
-            # Remove the = sign
-            expression = formula[1:].strip()
-            
+
             # Handle empty formula
-            if not expression:
+            if not formula[1:].strip():
                 return ""
-            
-            # Evaluate the expression
-            result = self._evaluate_expression(expression)
-            
-            # Convert to appropriate type
-            if isinstance(result, (int, float)):
-                # Return int if it's a whole number, otherwise float
-                return int(result) if result == int(result) else result
-            
-            return result
-            
+
+            with self.recalculation_pass():
+                result = compile_formula(formula).evaluate(self)
+            return self._to_result(result)
+
+        except CircularReferenceError:
+            return CIRCULAR_ERROR
+        except Exception as e:
+            return f"#ERROR: {str(e)}"
+
+    def evaluate_cell(self, position: Tuple[int, int]) -> Union[str, float, int]:
+        """Evaluate the cell at (row, column), reusing results that are still current"""
+        try:
+            with self.recalculation_pass():
+                result = self.cell_value(position)
+            return self._to_result(result)
+
+        except CircularReferenceError:
+            return CIRCULAR_ERROR
         except Exception as e:
             return f"#ERROR: {str(e)}"
-    
-    def _evaluate_expression(self, expression: str) -> Union[str, float, int]:
-        """Evaluate a mathematical expression with functions and cell references"""
-        
-        # Handle function calls first
-        expression = self._resolve_functions(expression)
-        
-        # Handle cell references
-        expression = self._resolve_cell_references(expression)
-        
-        # Handle basic arithmetic
+
+    @contextmanager
+    def recalculation_pass(self):
+        """
+        Evaluate within one pass: every formula cell is computed at most once
+        and circular references become #CIRCULAR. Nested calls join the
+        active pass.
+        """
+        if self.context is not None:
+            yield self.context
+            return
+        self.context = RecalcContext()
         try:
-            # Replace ^ with ** for power operator
-            expression = expression.replace('^', '**')
-            
-            # Evaluate the expression safely
-            result = self._safe_eval(expression)
+            yield self.context
+        finally:
+            self.last_pass = self.context
+            self.context = None
+
+    def _to_result(self, result: Any) -> Union[str, float, int]:
+        """Convert an evaluated value to the type returned to callers"""
+        if isinstance(result, bool):
+            return 'TRUE' if result else 'FALSE'
+        if isinstance(result, (int, float)):
+            # Return int if it's a whole number, otherwise float
+            return int(result) if float(result).is_integer() else result
+        if isinstance(result, RangeRef):
+            raise FormulaError("Range cannot be used as a single value")
+        return result
+
+    # Reference resolution, called from compiled formulas
+    def cell_value(self, position: Tuple[int, int]) -> Any:
+        """Value of a referenced cell: a number, text, or the result of its formula"""
+        value = self.cells.get(position)
+        if value is None:
+            return 0.0
+        if type(value) is str:
+            value = self._compile(position, value)
+        if isinstance(value, CompiledFormula):
+            return self._formula_value(position, value)
+        if isinstance(value, FormulaError):
+            raise value
+        return value
+
+    def _formula_value(self, position: Tuple[int, int], formula: CompiledFormula) -> Any:
+        """Result of the formula cell at position, memoized until a precedent changes"""
+        context = self.context
+        if context is None:
+            with self.recalculation_pass():
+                return self._formula_value(position, formula)
+
+        if position in self.results:
+            context.cache_hits += 1
+            result = self.results[position]
+            if isinstance(result, FormulaError):
+                raise result
             return result
-            
+        if position in context.in_progress:
+            raise CircularReferenceError()
+
+        context.in_progress.add(position)
+        try:
+            result = formula.evaluate(self)
+        except FormulaError as e:
+            self.results[position] = e
+            raise
         except Exception as e:
-            raise ValueError(f"Invalid expression: {expression}")
-    
-    def _resolve_functions(self, expression: str) -> str:
-        """Resolve all function calls in the expression"""
-        # Pattern to match function calls: FUNCTION(arguments)
-        pattern = r'([A-Z]+)\(([^()]*(?:\([^()]*\)[^()]*)*)\)'
-        
-        def replace_function(match):
-            func_name = match.group(1)
-            args_str = match.group(2)
-            
-            if func_name in self.functions:
-                try:
-                    # Parse arguments
-                    args = self._parse_function_args(args_str)
-                    # Call the function
-                    result = self.functions[func_name](args)
-                    return str(result)
-                except Exception as e:
-                    return f"#ERROR"
-            else:
-                return f"#ERROR: Unknown function {func_name}"
-        
-        # Keep resolving until no more functions are found
-        while re.search(pattern, expression):
-            expression = re.sub(pattern, replace_function, expression)
-        
-        return expression
-    
-    def _parse_function_args(self, args_str: str) -> List[str]:
-        """Parse function arguments, handling nested parentheses and commas"""
-        if not args_str.strip():
-            return []
-        
-        args = []
-        current_arg = ""
-        paren_count = 0
-        
-        for char in args_str:
-            if char == ',' and paren_count == 0:
-                args.append(current_arg.strip())
-                current_arg = ""
-            else:
-                if char == '(':
-                    paren_count += 1
-                elif char == ')':
-                    paren_count -= 1
-                current_arg += char
-        
-        if current_arg.strip():
-            args.append(current_arg.strip())
-        
-        return args
-    
-    def _resolve_cell_references(self, expression: str) -> str:
-        """Resolve cell references to their values"""
-        # Pattern to match cell references (A1, B2, etc.) and ranges (A1:B3)
-        cell_pattern = r'([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?'
-        
-        def replace_cell(match):
-            col1, row1, col2, row2 = match.groups()
-            
-            if col2 and row2:  # Range reference
-                return str(self._get_range_values(col1, int(row1), col2, int(row2)))
-            else:  # Single cell reference
-                cell_id = f"{col1}{row1}"
-                value = self.cells.get(cell_id, "0")
-                
-                # If the cell contains a formula, evaluate it
-                if value.startswith('='):
-                    try:
-                        evaluated = self.evaluate(value)
-                        return str(evaluated) if evaluated != "#ERROR" else "0"
-                    except:
-                        return "0"
-                
-                # Try to convert to number
-                try:
-                    return str(float(value)) if value else "0"
-                except:
-                    return f'"{value}"'  # Return as string literal
-        
-        return re.sub(cell_pattern, replace_cell, expression)
-    
-    def _get_range_values(self, col1: str, row1: int, col2: str, row2: int) -> List[float]:
-        """Get values from a range of cells"""
-        values = []
-        
-        col1_num = self._column_to_number(col1)
-        col2_num = self._column_to_number(col2)
-        
-        for row in range(min(row1, row2), max(row1, row2) + 1):
-            for col_num in range(min(col1_num, col2_num), max(col1_num, col2_num) + 1):
-                col = self._number_to_column(col_num)
-                cell_id = f"{col}{row}"
-                value = self.cells.get(cell_id, "0")
-                
-                # Convert to number
-                try:
-                    if value.startswith('='):
-                        evaluated = self.evaluate(value)
-                        values.append(float(evaluated) if isinstance(evaluated, (int, float)) else 0)
-                    else:
-                        values.append(float(value) if value else 0)
-                except:
-                    values.append(0)
-        
-        return values
-    
+            error = FormulaError(str(e))
+            self.results[position] = error
+            raise error
+        finally:
+            context.in_progress.discard(position)
+        context.evaluations += 1
+        self.results[position] = result
+        return result
+
+    def range_numbers(self, top: int, left: int, bottom: int, right: int) -> np.ndarray:
+        """
+        Numeric values in a range as one array, column by column
+        Blank and text cells are skipped; formula cells contribute their
+        numeric result, and an error in any formula cell is raised.
+        """
+        parts = []
+        for column in range(left, right + 1):
+            numbers, valid = self.cells.numeric_slice(column, top, bottom)
+            if len(numbers):
+                parts.append(numbers[valid])
+            formula_values = []
+            for row, value in self.cells.objects_between(column, top, bottom):
+                if type(value) is str:
+                    value = self._compile((row, column), value)
+                if isinstance(value, CompiledFormula):
+                    result = self._formula_value((row, column), value)
+                    if isinstance(result, (int, float)) and not isinstance(result, bool):
+                        formula_values.append(result)
+                elif isinstance(value, FormulaError):
+                    raise value
+            if formula_values:
+                parts.append(np.array(formula_values, dtype=np.float64))
+        if not parts:
+            return np.zeros(0, dtype=np.float64)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def range_sum_count(self, top: int, left: int, bottom: int, right: int) -> Tuple[float, int]:
+        """
+        Sum and count of the numbers in a range, from the cached column
+        segment trees plus the current results of the formula cells inside it
+        """
+        total, count = 0.0, 0
+        for column in range(left, right + 1):
+            column_total, column_count, formula_rows = self.aggregates.sum_count(column, top, bottom)
+            total += column_total
+            count += column_count
+            for row in formula_rows:
+                value = self._compile((row, column), self.cells.get((row, column)))
+                if isinstance(value, FormulaError):
+                    raise value
+                result = self._formula_value((row, column), value)
+                if isinstance(result, (int, float)) and not isinstance(result, bool):
+                    total += result
+                    count += 1
+        return total, count
+
     def _column_to_number(self, col: str) -> int:
         """Convert column letter to number (A=1, B=2, etc.)"""
-        result = 0
-        for char in col:
-            result = result * 26 + (ord(char) - ord('A') + 1)
-        return result
-    
+        return column_to_number(col)
+
     def _number_to_column(self, num: int) -> str:
         """Convert number to column letter (1=A, 2=B, etc.)"""
-        result = ""
-        while num > 0:
-            num -= 1
-            result = chr(ord('A') + num % 26) + result
-            num //= 26
-        return result
-    
-    def _safe_eval(self, expression: str) -> Union[float, int]:
-        """Safely evaluate a mathematical expression"""
-        # Remove any potentially dangerous characters/functions
-        allowed_chars = set('0123456789+-*/.() ')
-        
-        # Allow decimal points and scientific notation
-        if not all(c in allowed_chars or c.isdigit() or c in 'eE' for c in expression):
-            # If expression contains strings, handle them appropriately
-            if '"' in expression:
-                return expression.strip('"')
-            else:
-                raise ValueError("Invalid characters in expression")
-        
-        try:
-            # Use eval with restricted globals for safety
-            result = eval(expression, {"__builtins__": {}}, {})
-            return result
-        except:
-            raise ValueError("Cannot evaluate expression")
-    
+        return number_to_column(num)
+
     # Statistical Functions
-    def _sum(self, args: List[str]) -> float:
+    def _sum(self, args: List[Any]) -> float:
         """SUM function implementation"""
-        total = 0
-        for arg in args:
-            if ':' in arg:  # Range
-                values = self._parse_range_arg(arg)
-                total += sum(values)
-            else:
-                values = self._parse_single_arg(arg)
-                total += sum(values) if isinstance(values, list) else values
-        return total
-    
-    def _average(self, args: List[str]) -> float:
+        return self._sum_count(args)[0]
+
+    def _average(self, args: List[Any]) -> float:
         """AVERAGE function implementation"""
-        values = []
-        for arg in args:
-            if ':' in arg:  # Range
-                values.extend(self._parse_range_arg(arg))
-            else:
-                val = self._parse_single_arg(arg)
-                if isinstance(val, list):
-                    values.extend(val)
-                else:
-                    values.append(val)
-        
-        numeric_values = [v for v in values if isinstance(v, (int, float)) and not math.isnan(v)]
-        return sum(numeric_values) / len(numeric_values) if numeric_values else 0
-    
-    def _count(self, args: List[str]) -> int:
+        total, count = self._sum_count(args)
+        return total / count if count else 0
+
+    def _count(self, args: List[Any]) -> int:
         """COUNT function implementation"""
-        count = 0
-        for arg in args:
-            if ':' in arg:  # Range
-                values = self._parse_range_arg(arg)
-                count += len([v for v in values if isinstance(v, (int, float)) and not math.isnan(v)])
-            else:
-                val = self._parse_single_arg(arg)
-                if isinstance(val, list):
-                    count += len([v for v in val if isinstance(v, (int, float)) and not math.isnan(v)])
-                elif isinstance(val, (int, float)) and not math.isnan(val):
-                    count += 1
-        return count
-    
-    def _max(self, args: List[str]) -> float:
+        return self._sum_count(args)[1]
+
+    def _max(self, args: List[Any]) -> float:
         """MAX function implementation"""
-        values = []
-        for arg in args:
-            if ':' in arg:  # Range
-                values.extend(self._parse_range_arg(arg))
-            else:
-                val = self._parse_single_arg(arg)
-                if isinstance(val, list):
-                    values.extend(val)
-                else:
-                    values.append(val)
-        
-        numeric_values = [v for v in values if isinstance(v, (int, float)) and not math.isnan(v)]
-        return max(numeric_values) if numeric_values else 0
-    
-    def _min(self, args: List[str]) -> float:
+        values = self._numeric_values(args)
+        return float(np.max(values)) if len(values) else 0
+
+    def _min(self, args: List[Any]) -> float:
         """MIN function implementation"""
-        values = []
-        for arg in args:
-            if ':' in arg:  # Range
-                values.extend(self._parse_range_arg(arg))
-            else:
-                val = self._parse_single_arg(arg)
-                if isinstance(val, list):
-                    values.extend(val)
-                else:
-                    values.append(val)
-        
-        numeric_values = [v for v in values if isinstance(v, (int, float)) and not math.isnan(v)]
-        return min(numeric_values) if numeric_values else 0
-    
+        values = self._numeric_values(args)
+        return float(np.min(values)) if len(values) else 0
+
     # Math Functions
-    def _abs(self, args: List[str]) -> float:
+    def _abs(self, args: List[Any]) -> float:
         """ABS function implementation"""
         if len(args) != 1:
             raise ValueError("ABS requires exactly 1 argument")
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else 0
-        return abs(value)
-    
-    def _round(self, args: List[str]) -> float:
+        return abs(self._number(args[0]))
+
+    def _round(self, args: List[Any]) -> float:
         """ROUND function implementation"""
         if len(args) < 1 or len(args) > 2:
             raise ValueError("ROUND requires 1 or 2 arguments")
-        
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else 0
-        
+
+        value = self._number(args[0])
+
         decimals = 0
         if len(args) == 2:
-            decimals = int(self._parse_single_arg(args[1]))
-        
+            decimals = int(self._number(args[1]))
+
         return round(value, decimals)
-    
-    def _sqrt(self, args: List[str]) -> float:
+
+    def _sqrt(self, args: List[Any]) -> float:
         """SQRT function implementation"""
         if len(args) != 1:
             raise ValueError("SQRT requires exactly 1 argument")
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else 0
-        return math.sqrt(value)
-    
-    def _power(self, args: List[str]) -> float:
+        return math.sqrt(self._number(args[0]))
+
+    def _power(self, args: List[Any]) -> float:
         """POWER function implementation"""
         if len(args) != 2:
             raise ValueError("POWER requires exactly 2 arguments")
-        base = self._parse_single_arg(args[0])
-        exponent = self._parse_single_arg(args[1])
-        if isinstance(base, list):
-            base = base[0] if base else 0
-        if isinstance(exponent, list):
-            exponent = exponent[0] if exponent else 0
-        return base ** exponent
-    
-    # Logic Functions
-    def _if(self, args: List[str]) -> Union[str, float]:
-        """IF function implementation"""
-        if len(args) != 3:
-            raise ValueError("IF requires exactly 3 arguments")
-        
-        condition = self._parse_single_arg(args[0])
-        true_value = args[1]
-        false_value = args[2]
-        
-        # Evaluate condition
-        if isinstance(condition, (int, float)):
-            condition = condition != 0
-        elif isinstance(condition, str):
-            condition = condition.lower() == 'true'
-        
-        if condition:
-            return self._parse_single_arg(true_value)
-        else:
-            return self._parse_single_arg(false_value)
-    
+        result = self._number(args[0]) ** self._number(args[1])
+        if isinstance(result, complex):
+            raise ValueError("Invalid power")
+        return result
+
     # Text Functions
-    def _concatenate(self, args: List[str]) -> str:
+    def _concatenate(self, args: List[Any]) -> str:
         """CONCATENATE function implementation"""
-        result = ""
-        for arg in args:
-            value = self._parse_single_arg(arg)
-            if isinstance(value, list):
-                result += str(value[0]) if value else ""
-            else:
-                result += str(value)
-        return result
-    
-    def _len(self, args: List[str]) -> int:
+        return "".join(self._text(arg) for arg in args)
+
+    def _len(self, args: List[Any]) -> int:
         """LEN function implementation"""
         if len(args) != 1:
             raise ValueError("LEN requires exactly 1 argument")
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else ""
-        return len(str(value))
-    
-    def _upper(self, args: List[str]) -> str:
+        return len(self._text(args[0]))
+
+    def _upper(self, args: List[Any]) -> str:
         """UPPER function implementation"""
         if len(args) != 1:
             raise ValueError("UPPER requires exactly 1 argument")
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else ""
-        return str(value).upper()
-    
-    def _lower(self, args: List[str]) -> str:
+        return self._text(args[0]).upper()
+
+    def _lower(self, args: List[Any]) -> str:
         """LOWER function implementation"""
         if len(args) != 1:
             raise ValueError("LOWER requires exactly 1 argument")
-        value = self._parse_single_arg(args[0])
-        if isinstance(value, list):
-            value = value[0] if value else ""
-        return str(value).lower()
-    
-    def _left(self, args: List[str]) -> str:
+        return self._text(args[0]).lower()
+
+    def _left(self, args: List[Any]) -> str:
         """LEFT function implementation"""
         if len(args) != 2:
             raise ValueError("LEFT requires exactly 2 arguments")
-        text = str(self._parse_single_arg(args[0]))
-        length = int(self._parse_single_arg(args[1]))
+        text = self._text(args[0])
+        length = int(self._number(args[1]))
         return text[:length]
-    
-    def _right(self, args: List[str]) -> str:
+
+    def _right(self, args: List[Any]) -> str:
         """RIGHT function implementation"""
         if len(args) != 2:
             raise ValueError("RIGHT requires exactly 2 arguments")
-        text = str(self._parse_single_arg(args[0]))
-        length = int(self._parse_single_arg(args[1]))
-        return text[-length:]
-    
-    def _mid(self, args: List[str]) -> str:
+        text = self._text(args[0])
+        length = int(self._number(args[1]))
+        return text[-length:] if length > 0 else ""
+
+    def _mid(self, args: List[Any]) -> str:
         """MID function implementation"""
         if len(args) != 3:
             raise ValueError("MID requires exactly 3 arguments")
-        text = str(self._parse_single_arg(args[0]))
-        start = int(self._parse_single_arg(args[1])) - 1  # Convert to 0-based index
-        length = int(self._parse_single_arg(args[2]))
+        text = self._text(args[0])
+        start = int(self._number(args[1])) - 1  # Convert to 0-based index
+        length = int(self._number(args[2]))
         return text[start:start + length]
-    
-    def _find(self, args: List[str]) -> int:
+
+    def _find(self, args: List[Any]) -> int:
         """FIND function implementation"""
         if len(args) < 2 or len(args) > 3:
             raise ValueError("FIND requires 2 or 3 arguments")
-        find_text = str(self._parse_single_arg(args[0]))
-        within_text = str(self._parse_single_arg(args[1]))
+        find_text = self._text(args[0])
+        within_text = self._text(args[1])
         start_pos = 1
         if len(args) == 3:
-            start_pos = int(self._parse_single_arg(args[2]))
-        
+            start_pos = int(self._number(args[2]))
+
         pos = within_text.find(find_text, start_pos - 1)
         return pos + 1 if pos >= 0 else -1
-    
-    def _substitute(self, args: List[str]) -> str:
+
+    def _substitute(self, args: List[Any]) -> str:
         """SUBSTITUTE function implementation"""
         if len(args) < 3 or len(args) > 4:
             raise ValueError("SUBSTITUTE requires 3 or 4 arguments")
-        text = str(self._parse_single_arg(args[0]))
-        old_text = str(self._parse_single_arg(args[1]))
-        new_text = str(self._parse_single_arg(args[2]))
-        
+        text = self._text(args[0])
+        old_text = self._text(args[1])
+        new_text = self._text(args[2])
+
         if len(args) == 4:
-            instance = int(self._parse_single_arg(args[3]))
+            instance = int(self._number(args[3]))
             # Replace only the nth occurrence
             parts = text.split(old_text)
             if instance > 0 and instance <= len(parts) - 1:
@@ -477,56 +576,79 @@ class FormulaEngine:
             return text
         else:
             return text.replace(old_text, new_text)
-    
+
     # Date Functions
-    def _today(self, args: List[str]) -> str:
+    def _today(self, args: List[Any]) -> str:
         """TODAY function implementation"""
         from datetime import date
         return date.today().strftime("%Y-%m-%d")
-    
-    def _now(self, args: List[str]) -> str:
+
+    def _now(self, args: List[Any]) -> str:
         """NOW function implementation"""
         from datetime import datetime
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
+
     # Helper methods
-    def _parse_range_arg(self, arg: str) -> List[float]:
-        """Parse a range argument (e.g., A1:B3)"""
-        if ':' in arg:
-            start, end = arg.split(':')
-            start_col = re.match(r'([A-Z]+)', start).group(1)
-            start_row = int(re.match(r'[A-Z]+(\d+)', start).group(1))
-            end_col = re.match(r'([A-Z]+)', end).group(1)
-            end_row = int(re.match(r'[A-Z]+(\d+)', end).group(1))
-            
-            return self._get_range_values(start_col, start_row, end_col, end_row)
-        else:
-            return [self._parse_single_arg(arg)]
-    
-    def _parse_single_arg(self, arg: str) -> Union[float, str, List[float]]:
-        """Parse a single argument (could be a number, cell reference, or string)"""
-        arg = arg.strip()
-        
-        # Check if it's a cell reference
-        if re.match(r'^[A-Z]+\d+$', arg):
-            cell_value = self.cells.get(arg, "0")
-            if cell_value.startswith('='):
+    def _numeric_values(self, args: List[Any]) -> np.ndarray:
+        """
+        Collect the numbers in evaluated arguments into one array
+        Ranges contribute their numeric cells; literal and referenced numbers,
+        logical values and numeric text count, other text is skipped.
+        """
+        arrays = []
+        scalars = []
+        for arg in args:
+            if isinstance(arg, RangeRef):
+                arrays.append(self.range_numbers(*arg))
+            elif isinstance(arg, bool):
+                scalars.append(1.0 if arg else 0.0)
+            elif isinstance(arg, (int, float)):
+                scalars.append(arg)
+            else:
                 try:
-                    evaluated = self.evaluate(cell_value)
-                    return float(evaluated) if isinstance(evaluated, (int, float)) else 0
-                except:
-                    return 0
+                    scalars.append(float(arg))
+                except ValueError:
+                    pass
+        if scalars:
+            arrays.append(np.array(scalars, dtype=np.float64))
+        if not arrays:
+            return np.zeros(0, dtype=np.float64)
+        values = arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+        return values[~np.isnan(values)] if np.isnan(values).any() else values
+
+    def _sum_count(self, args: List[Any]) -> Tuple[float, int]:
+        """Sum and count of the numbers in evaluated arguments, using the range cache"""
+        total, count = 0.0, 0
+        scalars = []
+        for arg in args:
+            if isinstance(arg, RangeRef):
+                range_total, range_count = self.range_sum_count(*arg)
+                total += range_total
+                count += range_count
+            else:
+                scalars.append(arg)
+        if scalars:
+            values = self._numeric_values(scalars)
+            total += float(np.sum(values))
+            count += len(values)
+        return total, count
+
+    def _scalar(self, value: Any) -> Any:
+        """Use the top-left cell of a range where a single value is expected"""
+        if isinstance(value, RangeRef):
+            return self.cell_value((value.top, value.left))
+        return value
+
+    def _number(self, value: Any) -> float:
+        """Coerce an evaluated argument to a number"""
+        value = self._scalar(value)
+        if isinstance(value, str):
             try:
-                return float(cell_value) if cell_value else 0
-            except:
-                return str(cell_value)
-        
-        # Check if it's a string literal
-        if arg.startswith('"') and arg.endswith('"'):
-            return arg[1:-1]
-        
-        # Check if it's a number
-        try:
-            return float(arg)
-        except:
-            return str(arg)
+                return float(value) if value else 0
+            except ValueError:
+                raise ValueError(f"Cannot use text {value!r} as a number")
+        return value
+
+    def _text(self, value: Any) -> str:
+        """Coerce an evaluated argument to text"""
+        return to_text(self._scalar(value))
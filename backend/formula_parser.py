@@ -0,0 +1,422 @@
+import re
+from functools import lru_cache
+from typing import Any, Callable, List, NamedTuple, Tuple
+
+
+class FormulaError(Exception):
+    """Raised when a formula cannot be parsed or evaluated"""
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+
+
+_TOKEN_PATTERN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<range>\$?[A-Za-z]+\$?\d+:\$?[A-Za-z]+\$?\d+)
+  | (?P<cell>\$?[A-Za-z]+\$?\d+)(?![A-Za-z0-9_(])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<op><=|>=|<>|[-+*/^%&=<>])
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | (?P<comma>,)
+''', re.VERBOSE)
+
+_CELL_PATTERN = re.compile(r'^\$?([A-Za-z]+)\$?(\d+)$')
+
+
+def column_to_number(col: str) -> int:
+    """Convert column letter to number (A=1, B=2, etc.)"""
+    result = 0
+    for char in col.upper():
+        result = result * 26 + (ord(char) - ord('A') + 1)
+    return result
+
+
+def number_to_column(num: int) -> str:
+    """Convert number to column letter (1=A, 2=B, etc.)"""
+    result = ""
+    while num > 0:
+        num -= 1
+        result = chr(ord('A') + num % 26) + result
+        num //= 26
+    return result
+
+
+def parse_cell_key(key: str) -> Tuple[int, int]:
+    """Convert an A1-style cell key to a (row, column) pair"""
+    match = _CELL_PATTERN.match(key.strip())
+    if not match:
+        raise FormulaError(f"Invalid cell reference {key}")
+    return int(match.group(2)), column_to_number(match.group(1))
+
+
+def tokenize(expression: str) -> List[Token]:
+    """Split a formula expression into tokens"""
+    tokens = []
+    position = 0
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise FormulaError(f"Unexpected character {expression[position]!r}")
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append(Token(kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+# AST nodes
+class Literal(NamedTuple):
+    value: Any
+
+
+class CellRef(NamedTuple):
+    row: int
+    column: int
+
+
+class RangeRef(NamedTuple):
+    top: int
+    left: int
+    bottom: int
+    right: int
+
+
+class UnaryOp(NamedTuple):
+    op: str
+    operand: Any
+
+
+class BinaryOp(NamedTuple):
+    op: str
+    left: Any
+    right: Any
+
+
+class FunctionCall(NamedTuple):
+    name: str
+    args: Tuple[Any, ...]
+
+
+class _Parser:
+    """Recursive descent parser producing an AST from a token list"""
+
+    _COMPARISON_OPS = ('=', '<>', '<', '>', '<=', '>=')
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaError("Empty expression")
+        node = self._comparison()
+        if self.position < len(self.tokens):
+            raise FormulaError(f"Unexpected token {self.tokens[self.position].text!r}")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self) -> Token:
+        token = self._peek()
+        if token is None:
+            raise FormulaError("Unexpected end of formula")
+        self.position += 1
+        return token
+
+    def _expect(self, kind: str) -> Token:
+        token = self._next()
+        if token.kind != kind:
+            raise FormulaError(f"Expected {kind} but found {token.text!r}")
+        return token
+
+    def _match_op(self, ops) -> str:
+        token = self._peek()
+        if token is not None and token.kind == 'op' and token.text in ops:
+            self.position += 1
+            return token.text
+        return ''
+
+    def _comparison(self):
+        node = self._concatenation()
+        op = self._match_op(self._COMPARISON_OPS)
+        while op:
+            node = BinaryOp(op, node, self._concatenation())
+            op = self._match_op(self._COMPARISON_OPS)
+        return node
+
+    def _concatenation(self):
+        node = self._additive()
+        while self._match_op(('&',)):
+            node = BinaryOp('&', node, self._additive())
+        return node
+
+    def _additive(self):
+        node = self._multiplicative()
+        op = self._match_op(('+', '-'))
+        while op:
+            node = BinaryOp(op, node, self._multiplicative())
+            op = self._match_op(('+', '-'))
+        return node
+
+    def _multiplicative(self):
+        node = self._unary()
+        op = self._match_op(('*', '/', '%'))
+        while op:
+            node = BinaryOp(op, node, self._unary())
+            op = self._match_op(('*', '/', '%'))
+        return node
+
+    def _unary(self):
+        op = self._match_op(('+', '-'))
+        if op:
+            return UnaryOp(op, self._unary())
+        return self._power()
+
+    def _power(self):
+        # Right-associative and binds tighter than unary minus, like ** in Python
+        node = self._primary()
+        if self._match_op(('^',)):
+            return BinaryOp('^', node, self._unary())
+        return node
+
+    def _primary(self):
+        token = self._next()
+        if token.kind == 'number':
+            return Literal(float(token.text))
+        if token.kind == 'string':
+            return Literal(token.text[1:-1].replace('""', '"'))
+        if token.kind == 'cell':
+            return CellRef(*parse_cell_key(token.text))
+        if token.kind == 'range':
+            start, end = token.text.split(':')
+            row1, col1 = parse_cell_key(start)
+            row2, col2 = parse_cell_key(end)
+            return RangeRef(min(row1, row2), min(col1, col2), max(row1, row2), max(col1, col2))
+        if token.kind == 'name':
+            name = token.text.upper()
+            if name in ('TRUE', 'FALSE') and not self._is_call():
+                return Literal(name == 'TRUE')
+            self._expect('lparen')
+            return FunctionCall(name, self._arguments())
+        if token.kind == 'lparen':
+            node = self._comparison()
+            self._expect('rparen')
+            return node
+        raise FormulaError(f"Unexpected token {token.text!r}")
+
+    def _is_call(self) -> bool:
+        token = self._peek()
+        return token is not None and token.kind == 'lparen'
+
+    def _arguments(self) -> Tuple[Any, ...]:
+        args = []
+        token = self._peek()
+        if token is not None and token.kind == 'rparen':
+            self.position += 1
+            return ()
+        while True:
+            args.append(self._comparison())
+            token = self._next()
+            if token.kind == 'rparen':
+                return tuple(args)
+            if token.kind != 'comma':
+                raise FormulaError(f"Expected , or ) but found {token.text!r}")
+
+
+def parse(expression: str):
+    """Parse a formula expression (without the leading =) into an AST"""
+    return _Parser(tokenize(expression)).parse()
+
+
+# Compilation: AST -> closure tree. Each closure takes the evaluation context
+# (a FormulaEngine) and returns a float, str or bool. A range evaluates to
+# its RangeRef, which functions read through the context.
+
+def _single(value):
+    if isinstance(value, RangeRef):
+        raise FormulaError("Range cannot be used as a single value")
+    return value
+
+
+def _to_number(value) -> float:
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return value
+    if _single(value) == '':
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        raise FormulaError(f"Cannot use text {value!r} as a number")
+
+
+def to_text(value) -> str:
+    """Format a value the way it is displayed when used as text"""
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _divide(a, b):
+    if b == 0:
+        raise FormulaError("Division by zero")
+    return a / b
+
+
+def _modulo(a, b):
+    if b == 0:
+        raise FormulaError("Division by zero")
+    return a % b
+
+
+def _power(a, b):
+    result = a ** b
+    if isinstance(result, complex):
+        raise FormulaError("Invalid power")
+    return result
+
+
+_ARITHMETIC_OPS = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': _divide,
+    '%': _modulo,
+    '^': _power,
+}
+
+_COMPARISON_FUNCS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _comparable(value):
+    if isinstance(_single(value), str):
+        try:
+            return float(value)
+        except ValueError:
+            return value.lower()
+    return float(value)
+
+
+def _compile_node(node) -> Callable:
+    if isinstance(node, Literal):
+        value = node.value
+        return lambda ctx: value
+
+    if isinstance(node, CellRef):
+        position = (node.row, node.column)
+        return lambda ctx: ctx.cell_value(position)
+
+    if isinstance(node, RangeRef):
+        return lambda ctx: node
+
+    if isinstance(node, UnaryOp):
+        operand = _compile_node(node.operand)
+        if node.op == '-':
+            return lambda ctx: -_to_number(operand(ctx))
+        return lambda ctx: _to_number(operand(ctx))
+
+    if isinstance(node, BinaryOp):
+        left = _compile_node(node.left)
+        right = _compile_node(node.right)
+        if node.op == '&':
+            return lambda ctx: to_text(_single(left(ctx))) + to_text(_single(right(ctx)))
+        if node.op in _COMPARISON_FUNCS:
+            compare = _COMPARISON_FUNCS[node.op]
+
+            def comparison(ctx):
+                a, b = _comparable(left(ctx)), _comparable(right(ctx))
+                if type(a) is not type(b):
+                    # Numbers sort before text, as in spreadsheets
+                    return compare(isinstance(a, str), isinstance(b, str))
+                return compare(a, b)
+            return comparison
+        apply = _ARITHMETIC_OPS[node.op]
+        return lambda ctx: apply(_to_number(left(ctx)), _to_number(right(ctx)))
+
+    if isinstance(node, FunctionCall):
+        if node.name == 'IF':
+            return _compile_if(node)
+        name = node.name
+        args = tuple(_compile_node(arg) for arg in node.args)
+
+        def call(ctx):
+            function = ctx.functions.get(name)
+            if function is None:
+                raise FormulaError(f"Unknown function {name}")
+            return function([arg(ctx) for arg in args])
+        return call
+
+    raise FormulaError(f"Cannot compile {node!r}")
+
+
+def _compile_if(node: FunctionCall) -> Callable:
+    """IF only evaluates the branch that is selected"""
+    if len(node.args) not in (2, 3):
+        raise FormulaError("IF requires 2 or 3 arguments")
+    condition = _compile_node(node.args[0])
+    if_true = _compile_node(node.args[1])
+    if_false = _compile_node(node.args[2]) if len(node.args) == 3 else (lambda ctx: False)
+
+    def evaluate_if(ctx):
+        return if_true(ctx) if is_truthy(condition(ctx)) else if_false(ctx)
+    return evaluate_if
+
+
+def is_truthy(value) -> bool:
+    """Interpret a value as a logical condition"""
+    if isinstance(_single(value), str):
+        return value.lower() == 'true'
+    return value != 0
+
+
+def _collect_references(node, cells: list, ranges: list):
+    if isinstance(node, CellRef):
+        cells.append((node.row, node.column))
+    elif isinstance(node, RangeRef):
+        ranges.append(tuple(node))
+    elif isinstance(node, UnaryOp):
+        _collect_references(node.operand, cells, ranges)
+    elif isinstance(node, BinaryOp):
+        _collect_references(node.left, cells, ranges)
+        _collect_references(node.right, cells, ranges)
+    elif isinstance(node, FunctionCall):
+        for arg in node.args:
+            _collect_references(arg, cells, ranges)
+
+
+class CompiledFormula:
+    """A parsed formula: its AST, the closure that evaluates it and the cells it reads"""
+
+    __slots__ = ('source', 'ast', 'evaluate', 'cells', 'ranges')
+
+    def __init__(self, source: str, ast):
+        self.source = source
+        self.ast = ast
+        self.evaluate = _compile_node(ast)
+        cells, ranges = [], []
+        _collect_references(ast, cells, ranges)
+        self.cells = tuple(dict.fromkeys(cells))
+        self.ranges = tuple(dict.fromkeys(ranges))
+
+
+@lru_cache(maxsize=8192)
+def compile_formula(formula: str) -> CompiledFormula:
+    """Compile formula text (with or without the leading =), caching by text"""
+    expression = formula[1:] if formula.startswith('=') else formula
+    return CompiledFormula(formula, parse(expression))
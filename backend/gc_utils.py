@@ -0,0 +1,19 @@
+import gc
+from contextlib import contextmanager
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pause the cyclic garbage collector for a bulk load
+    Creating hundreds of thousands of dicts and closures otherwise triggers
+    repeated full collections over an already large heap. Reference counting
+    still frees everything that is not part of a cycle.
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
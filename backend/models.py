@@ -1,15 +1,77 @@
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Sequence, Set, Tuple
 import json
+import threading
+import uuid
+import numpy as np
+from activity_log import ActivityLog
+from cell_index import LazySheetIndexes, SheetIndex
+from cell_record import Cell, DataType, now_timestamp
+from change_log import SheetChangeLog
+from engine_registry import EngineRegistry
+from formula_engine import FormulaEngine
+from gc_utils import paused_gc
+from parallel_recalc import ParallelRecalculator
+from sheet_locks import SheetLocks
+from snapshot_file import SnapshotReader
+from sqlite_store import SQLiteStore
+from style_table import StyleTable
+from write_ahead_log import WriteAheadLog
+
+# Activities kept per spreadsheet; older ones are dropped as new ones arrive
+DEFAULT_ACTIVITY_RETENTION = 10000
+# Changed positions remembered per sheet for delta sync
+CHANGE_LOG_ENTRIES = 10000
+
 
 class SpreadsheetModel:
-    def __init__(self):
+    """
+    The spreadsheets, sheets, cells and their comments, activities and collaborators
+    Safe to share between threads. Each sheet has a reader/writer lock:
+    reads of its cells run side by side, writes have the sheet to themselves,
+    and writes to different sheets do not wait for each other. Id and
+    version counters, and the per-spreadsheet tables made on first use, are
+    guarded by one short-held lock; records outside sheets are single dict
+    operations, which are atomic.
+    """
+
+    def __init__(self, activity_retention: int = DEFAULT_ACTIVITY_RETENTION,
+                 recalculator: Optional[ParallelRecalculator] = None):
         self.spreadsheets = {}
         self.sheets = {}
         self.cells = {}
+        # sheet_id -> SheetIndex of that sheet's cells by position
+        self.sheet_cells = {}
+        # spreadsheet_id -> StyleTable over the 'styles' list of the spreadsheet record
+        self.style_tables = {}
         self.comments = {}
         self.activities = {}
+        # spreadsheet_id -> ActivityLog over that spreadsheet's activities
+        self.activity_logs = {}
+        self.activity_retention = activity_retention
         self.collaborators = {}
+        # Evaluates large recalculations across processes; None keeps them in this one
+        self.recalculator = recalculator
+        # Warm per-sheet formula engines, fed every cell change
+        self.engines = EngineRegistry(self._load_engine)
+        # sheet_id -> positions written during a batch on that sheet, recalculated once at the end
+        self._deferred_positions: Dict[int, List[Tuple[int, int]]] = {}
+        self.sheet_locks = SheetLocks()
+        # Guards the id and version counters and creating per-spreadsheet state; never held
+        # while waiting for another lock
+        self._lock = threading.Lock()
+        # Guards the activity logs, appended to by the activity writer while requests read pages
+        self._activities_lock = threading.Lock()
+        # Every mutation takes the next version; a sheet or spreadsheet keeps the
+        # version of its last change. Versions restart with the process, so they
+        # are only comparable within one epoch.
+        self.version = 0
+        self.version_epoch = uuid.uuid4().hex[:12]
+        self.sheet_versions: Dict[int, int] = {}
+        self.spreadsheet_versions: Dict[int, int] = {}
+        # sheet_id -> SheetChangeLog of the cell positions written under those versions
+        self.change_logs: Dict[int, SheetChangeLog] = {}
         self.current_ids = {
             'spreadsheet': 1,
             'sheet': 1,
@@ -19,6 +81,7 @@ class SpreadsheetModel:
             'collaborator': 1
         }
         self._initialize_sample_data()
+        self._index_activities()
 
     def _initialize_sample_data(self):
         """Initialize with sample data for demonstration"""
@@ -64,23 +127,18 @@ class SpreadsheetModel:
 
         for cell_data in sample_cells:
             cell_id = self._get_next_id('cell')
-            self.cells[cell_id] = {
-                'id': cell_id,
-                'sheet_id': sheet_id,
-                'row': cell_data['row'],
-                'column': cell_data['column'],
-                'value': cell_data['value'],
-                'formula': cell_data.get('formula'),
-                'data_type': cell_data['data_type'],
-                'formatting': {},
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
-            }
+            now = now_timestamp()
+            self.cells[cell_id] = Cell(
+                cell_id, sheet_id, cell_data['row'], cell_data['column'], cell_data['value'],
+                cell_data.get('formula'), DataType(cell_data['data_type']), 0, now, now
+            )
+            self._sheet_index(sheet_id).add(self.cells[cell_id])
 
     def _get_next_id(self, entity_type: str) -> int:
         """Get the next available ID for an entity type"""
-        current_id = self.current_ids[entity_type]
-        self.current_ids[entity_type] += 1
+        with self._lock:
+            current_id = self.current_ids[entity_type]
+            self.current_ids[entity_type] += 1
         return current_id
 
     # Spreadsheet methods
@@ -88,7 +146,7 @@ class SpreadsheetModel:
         return self.spreadsheets.get(spreadsheet_id)
 
     def get_spreadsheets_by_user(self, user_id: int) -> List[Dict]:
-        return [s for s in self.spreadsheets.values() if s['owner_id'] == user_id]
+        return [s for s in list(self.spreadsheets.values()) if s['owner_id'] == user_id]
 
     def create_spreadsheet(self, data: Dict) -> Dict:
         spreadsheet_id = self._get_next_id('spreadsheet')
@@ -99,6 +157,8 @@ class SpreadsheetModel:
             'updated_at': datetime.now().isoformat()
         }
         self.spreadsheets[spreadsheet_id] = spreadsheet
+        self._touch_spreadsheet(spreadsheet_id)
+        self._records_written('spreadsheet', [spreadsheet])
         return spreadsheet
 
     def update_spreadsheet(self, spreadsheet_id: int, updates: Dict) -> Optional[Dict]:
@@ -107,11 +167,13 @@ class SpreadsheetModel:
         
         self.spreadsheets[spreadsheet_id].update(updates)
         self.spreadsheets[spreadsheet_id]['updated_at'] = datetime.now().isoformat()
+        self._touch_spreadsheet(spreadsheet_id)
+        self._records_written('spreadsheet', [self.spreadsheets[spreadsheet_id]])
         return self.spreadsheets[spreadsheet_id]
 
     # Sheet methods
     def get_sheets_by_spreadsheet(self, spreadsheet_id: int) -> List[Dict]:
-        return [s for s in self.sheets.values() if s['spreadsheet_id'] == spreadsheet_id]
+        return [s for s in list(self.sheets.values()) if s['spreadsheet_id'] == spreadsheet_id]
 
     def get_sheet(self, sheet_id: int) -> Optional[Dict]:
         return self.sheets.get(sheet_id)
@@ -125,6 +187,8 @@ class SpreadsheetModel:
             'updated_at': datetime.now().isoformat()
         }
         self.sheets[sheet_id] = sheet
+        self._touch_sheet(sheet_id)
+        self._records_written('sheet', [sheet])
         return sheet
 
     def update_sheet(self, sheet_id: int, updates: Dict) -> Optional[Dict]:
@@ -133,68 +197,540 @@ class SpreadsheetModel:
         
         self.sheets[sheet_id].update(updates)
         self.sheets[sheet_id]['updated_at'] = datetime.now().isoformat()
+        self._touch_sheet(sheet_id)
+        self._records_written('sheet', [self.sheets[sheet_id]])
         return self.sheets[sheet_id]
 
     def delete_sheet(self, sheet_id: int) -> bool:
-        if sheet_id not in self.sheets:
-            return False
-        
-        del self.sheets[sheet_id]
-        # Also delete all cells in this sheet
-        cells_to_delete = [cid for cid, cell in self.cells.items() if cell['sheet_id'] == sheet_id]
-        for cell_id in cells_to_delete:
-            del self.cells[cell_id]
+        with self.sheet_locks[sheet_id].write():
+            if sheet_id not in self.sheets:
+                return False
+
+            self._touch_sheet(sheet_id)
+            self.change_logs.pop(sheet_id, None)
+            del self.sheets[sheet_id]
+            self.engines.evict(sheet_id)
+            # Also delete all cells in this sheet
+            for cell in self.sheet_cells.pop(sheet_id, ()):
+                del self.cells[cell.id]
+            self._sheet_deleted(sheet_id)
         return True
 
+    # Version methods
+    def get_sheet_version(self, sheet_id: int) -> int:
+        return self.sheet_versions.get(sheet_id, 0)
+
+    def get_spreadsheet_version(self, spreadsheet_id: int) -> int:
+        return self.spreadsheet_versions.get(spreadsheet_id, 0)
+
+    def _touch_spreadsheet(self, spreadsheet_id: int):
+        with self._lock:
+            self.version += 1
+            self.spreadsheet_versions[spreadsheet_id] = self.version
+
+    def _touch_sheet(self, sheet_id: int, written: Iterable[Tuple[int, int]] = (),
+                     removed: Iterable[Tuple[int, int]] = ()):
+        """
+        Give a sheet, and the spreadsheet it belongs to, a new version, and log
+        the cell positions written or emptied under it. Cell writes call this
+        holding the sheet's write lock, so its change log only grows under it.
+        """
+        sheet = self.sheets.get(sheet_id)
+        with self._lock:
+            self.version += 1
+            version = self.version
+            self.sheet_versions[sheet_id] = version
+            if sheet is not None:
+                self.spreadsheet_versions[sheet['spreadsheet_id']] = version
+        if written or removed:
+            log = self.change_logs.get(sheet_id)
+            if log is None:
+                log = self.change_logs[sheet_id] = SheetChangeLog(CHANGE_LOG_ENTRIES)
+            log.record(version, written)
+            log.record(version, removed, removed=True)
+
+    def get_changes_since(self, sheet_id: int, version: int) -> Optional[Tuple[List[Cell], List[Tuple[int, int]]]]:
+        """
+        The cells of a sheet written after version, with every formula
+        downstream of them recalculated, and the positions emptied since.
+        None when the sheet's change log no longer reaches back to version.
+        """
+        lock = self.sheet_locks[sheet_id]
+        with lock.read():
+            log = self.change_logs.get(sheet_id)
+            if log is None:
+                return [], []
+            changes = log.since(version)
+            if changes is None:
+                return None
+            written, removed = changes
+            if not written and not removed:
+                return [], []
+            positions = set(written)
+            with lock.calculating:
+                positions.update(self.engines.get(sheet_id).dirty_cells(written + removed))
+            index = self.sheet_cells.get(sheet_id)
+            cells = [cell for cell in (index.get(row, column) for row, column in sorted(positions)) if cell is not None]
+            return self.calculate_cells(sheet_id, cells), removed
+
     # Cell methods
-    def get_cells_by_sheet(self, sheet_id: int) -> List[Dict]:
-        return [c for c in self.cells.values() if c['sheet_id'] == sheet_id]
+    def _sheet_index(self, sheet_id: int) -> SheetIndex:
+        index = self.sheet_cells.get(sheet_id)
+        if index is None:
+            index = self.sheet_cells[sheet_id] = SheetIndex()
+        return index
+
+    def get_cells_by_sheet(self, sheet_id: int) -> Sequence[Cell]:
+        """
+        The cells of a sheet, as a snapshot shared by every reader until the
+        sheet gains or loses a cell. The cells themselves are live records.
+        """
+        with self.sheet_locks[sheet_id].read():
+            index = self.sheet_cells.get(sheet_id)
+            return index.snapshot() if index is not None else ()
 
-    def get_cell(self, sheet_id: int, row: int, column: int) -> Optional[Dict]:
-        for cell in self.cells.values():
-            if cell['sheet_id'] == sheet_id and cell['row'] == row and cell['column'] == column:
-                return cell
-        return None
+    def get_cell(self, sheet_id: int, row: int, column: int) -> Optional[Cell]:
+        # A single dict lookup needs no lock
+        index = self.sheet_cells.get(sheet_id)
+        return index.get(row, column) if index is not None else None
 
-    def create_cell(self, data: Dict) -> Dict:
+    def iter_rows(self, sheet_id: int) -> Iterator[Tuple[int, Dict[int, Cell]]]:
+        """
+        (row, {column: cell}) for every row of a sheet that holds cells, in row
+        order. Each row is copied as it is reached, so writes made while the
+        caller iterates never change a row under it.
+        """
+        with self.sheet_locks[sheet_id].read():
+            index = self.sheet_cells.get(sheet_id)
+            if index is None:
+                return
+            row_keys = list(index.row_keys)
+        for row in row_keys:
+            # A single C call, so it sees the row before or after any write
+            row_cells = dict(index.rows.get(row) or ())
+            if row_cells:
+                yield row, row_cells
+
+    def get_sheet_bounds(self, sheet_id: int) -> Tuple[int, int]:
+        """Highest row and column holding a cell, (0, 0) for an empty sheet"""
+        with self.sheet_locks[sheet_id].read():
+            index = self.sheet_cells.get(sheet_id)
+            if index is None or not index.row_keys:
+                return 0, 0
+            return index.row_keys[-1], index.column_keys[-1]
+
+    def get_cells_in_range(self, sheet_id: int, top: int, left: int, bottom: int, right: int) -> List[Cell]:
+        """Cells inside a rectangle of a sheet, in row-major order"""
+        with self.sheet_locks[sheet_id].read():
+            index = self.sheet_cells.get(sheet_id)
+            return index.in_range(top, left, bottom, right) if index is not None else []
+
+    def format_range(self, sheet_id: int, top: int, left: int, bottom: int, right: int,
+                     formatting: Dict, merge: bool = False) -> List[Cell]:
+        """
+        Give every cell inside a rectangle the same formatting: one style is
+        interned and its id assigned to each cell. With merge, the formatting
+        is layered over each cell's own, once per distinct style in the range.
+        Blank positions hold no cell and are left alone.
+        Returns the restyled cells.
+        """
+        styles = self.get_sheet_styles(sheet_id)
+        with self.sheet_locks[sheet_id].write(), self._write_batch():
+            cells = self.get_cells_in_range(sheet_id, top, left, bottom, right)
+            now = now_timestamp()
+            style_id = self._intern_style(sheet_id, formatting)
+            # old style id -> merged style id
+            merged: Dict[int, int] = {}
+            for cell in cells:
+                if merge:
+                    new_style = merged.get(cell.style_id)
+                    if new_style is None:
+                        new_style = merged[cell.style_id] = self._intern_style(
+                            sheet_id, {**styles[cell.style_id], **formatting})
+                    cell.style_id = new_style
+                else:
+                    cell.style_id = style_id
+                cell.updated_at = now
+            self._touch_sheet(sheet_id, [(cell.row, cell.column) for cell in cells])
+            self._records_written('cell', cells)
+        return cells
+
+    # Style methods
+    def get_style_table(self, spreadsheet_id: int) -> StyleTable:
+        styles = self.style_tables.get(spreadsheet_id)
+        if styles is None:
+            with self._lock:
+                styles = self.style_tables.get(spreadsheet_id)
+                if styles is None:
+                    spreadsheet = self.spreadsheets.get(spreadsheet_id)
+                    styles = StyleTable(spreadsheet and spreadsheet.get('styles'))
+                    if spreadsheet is not None:
+                        spreadsheet['styles'] = styles.styles
+                    self.style_tables[spreadsheet_id] = styles
+        return styles
+
+    def get_sheet_styles(self, sheet_id: int) -> StyleTable:
+        """The style table of the spreadsheet a sheet belongs to"""
+        sheet = self.sheets.get(sheet_id)
+        return self.get_style_table(sheet['spreadsheet_id'] if sheet is not None else None)
+
+    def _intern_style(self, sheet_id: int, formatting: Optional[Dict]) -> int:
+        """The style id of formatting for a sheet; a new style is saved with the spreadsheet record"""
+        styles = self.get_sheet_styles(sheet_id)
+        count = len(styles)
+        style_id = styles.intern(formatting)
+        if len(styles) != count and sheet_id in self.sheets:
+            spreadsheet = self.spreadsheets.get(self.sheets[sheet_id]['spreadsheet_id'])
+            if spreadsheet is not None:
+                self._records_written('spreadsheet', [spreadsheet])
+        return style_id
+
+    def create_cell(self, data: Dict) -> Cell:
         cell_id = self._get_next_id('cell')
-        cell = {
-            'id': cell_id,
-            **data,
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
-        self.cells[cell_id] = cell
+        data = dict(data)
+        formatting = data.pop('formatting', None)
+        cell = Cell.from_dict({'id': cell_id, **data})
+        with self.sheet_locks[cell.sheet_id].write():
+            cell.style_id = self._intern_style(cell.sheet_id, formatting)
+            cell.created_at = cell.updated_at = now_timestamp()
+            self.cells[cell.id] = cell
+            self._sheet_index(cell.sheet_id).add(cell)
+            self._cell_changed(cell)
+            self._touch_sheet(cell.sheet_id, [(cell.row, cell.column)])
+            self._records_written('cell', [cell])
         return cell
 
-    def update_cell(self, cell_id: int, updates: Dict) -> Optional[Dict]:
-        if cell_id not in self.cells:
-            return None
-        
-        self.cells[cell_id].update(updates)
-        self.cells[cell_id]['updated_at'] = datetime.now().isoformat()
-        return self.cells[cell_id]
+    def update_cell(self, cell_id: int, updates: Dict) -> Optional[Cell]:
+        self._check_cell_fields(updates)
+        while True:
+            cell = self.cells.get(cell_id)
+            if cell is None:
+                return None
+            sheet_id = cell.sheet_id
+            # A move locks the sheet the cell leaves and the one it joins
+            with self.sheet_locks.writing(sheet_id, updates.get('sheet_id', sheet_id)):
+                # Otherwise it moved or went away while this thread waited; look again
+                if self.cells.get(cell_id) is cell and cell.sheet_id == sheet_id:
+                    return self._update_cell(cell, updates)
 
-    def update_cell_by_position(self, sheet_id: int, row: int, column: int, updates: Dict) -> Dict:
-        existing_cell = self.get_cell(sheet_id, row, column)
-        
-        if existing_cell:
-            self.update_cell(existing_cell['id'], updates)
-            return existing_cell
+    def _update_cell(self, cell: Cell, updates: Dict) -> Cell:
+        moved = any(key in updates and updates[key] != getattr(cell, key) for key in ('sheet_id', 'row', 'column'))
+        if moved:
+            self._check_free(updates.get('sheet_id', cell.sheet_id), updates.get('row', cell.row),
+                             updates.get('column', cell.column))
+            self.sheet_cells[cell.sheet_id].remove(cell.row, cell.column)
+            self._cell_removed(cell)
+            self._touch_sheet(cell.sheet_id, removed=[(cell.row, cell.column)])
+
+        if 'formatting' in updates:
+            updates = dict(updates)
+            formatting = updates.pop('formatting')
+        elif updates.get('sheet_id', cell.sheet_id) != cell.sheet_id:
+            # Style ids are per spreadsheet; carry the style over by value
+            formatting = self.get_sheet_styles(cell.sheet_id)[cell.style_id]
+        else:
+            formatting = None
+        cell.update(updates)
+        if formatting is not None:
+            cell.style_id = self._intern_style(cell.sheet_id, formatting)
+        cell.updated_at = now_timestamp()
+        if moved:
+            self._sheet_index(cell.sheet_id).add(cell)
+        if moved or 'value' in updates or 'formula' in updates or 'data_type' in updates:
+            self._cell_changed(cell)
+        self._touch_sheet(cell.sheet_id, [(cell.row, cell.column)])
+        self._records_written('cell', [cell])
+        return cell
+
+    def update_cell_by_position(self, sheet_id: int, row: int, column: int, updates: Dict) -> Cell:
+        self._check_cell_fields(updates)
+        # Held across the lookup, so two writers of a blank position cannot both create it.
+        # A move also locks the sheet the cell joins, up front: taking it while holding
+        # this one could deadlock with a move the other way
+        with self.sheet_locks.writing(sheet_id, updates.get('sheet_id', sheet_id)):
+            existing_cell = self.get_cell(sheet_id, row, column)
+
+            if existing_cell:
+                self._update_cell(existing_cell, updates)
+                return existing_cell
+            else:
+                return self.create_cell({
+                    'sheet_id': sheet_id,
+                    'row': row,
+                    'column': column,
+                    'value': updates.get('value', ''),
+                    'formula': updates.get('formula'),
+                    'data_type': updates.get('data_type', 'text'),
+                    'formatting': updates.get('formatting')
+                })
+
+    def _check_free(self, sheet_id: int, row: int, column: int):
+        """Raise ValueError if a cell already holds the position a cell moves to"""
+        if self.get_cell(sheet_id, row, column) is not None:
+            raise ValueError(f"row {row}, column {column} of sheet {sheet_id} already holds a cell")
+
+    def update_cells_by_position(self, sheet_id: int, updates: List[Dict]) -> Tuple[List[Cell], Dict[Tuple[int, int], Any]]:
+        """
+        Apply many cell updates, each a dict with 'row', 'column' and the cell
+        fields to write, then recalculate the affected formulas once.
+        Every update is checked before any is written, so a batch with a bad
+        entry raises ValueError having changed nothing.
+        Returns the written cells and the new result of each recomputed formula.
+        """
+        batch = [(update['row'], update['column'],
+                  {key: value for key, value in update.items() if key not in ('row', 'column')})
+                 for update in updates]
+        for _, _, fields in batch:
+            self._check_cell_fields(fields)
+        # Sheets that entries move cells to are locked up front with this one
+        destinations = [fields['sheet_id'] for _, _, fields in batch if 'sheet_id' in fields]
+        with self.sheet_locks.writing(sheet_id, *destinations):
+            self._check_batch_moves(sheet_id, batch)
+            self.engines.get(sheet_id)
+            changed = self._deferred_positions[sheet_id] = []
+            try:
+                with self._write_batch():
+                    cells = [self.update_cell_by_position(sheet_id, row, column, fields)
+                             for row, column, fields in batch]
+            finally:
+                del self._deferred_positions[sheet_id]
+            return cells, self._recalculate(sheet_id, changed)
+
+    def _check_batch_moves(self, sheet_id: int, batch: List[Tuple[int, int, Dict]]):
+        """Raise ValueError if an entry would move a cell onto one, counting the entries before it"""
+        # (sheet, row, column) -> whether a cell holds it once the entries so far are written
+        held: Dict[Tuple[int, int, int], bool] = {}
+
+        def holds(position: Tuple[int, int, int]) -> bool:
+            return held[position] if position in held else self.get_cell(*position) is not None
+
+        for row, column, fields in batch:
+            source = (sheet_id, row, column)
+            target = (fields.get('sheet_id', sheet_id), fields.get('row', row), fields.get('column', column))
+            if not holds(source):
+                # Written as a new cell where it is addressed
+                held[source] = True
+            elif target != source:
+                if holds(target):
+                    raise ValueError(f"row {target[1]}, column {target[2]} of sheet {target[0]} already holds a cell")
+                held[source], held[target] = False, True
+
+    def _check_cell_fields(self, fields: Dict):
+        """Raise ValueError for cell fields that could not be written"""
+        managed = [key for key in fields if key in Cell.MANAGED]
+        if managed:
+            raise ValueError(f"{', '.join(managed)} cannot be written")
+        fields = dict(fields)
+        formatting = fields.pop('formatting', None)
+        if formatting is not None and not isinstance(formatting, dict):
+            raise ValueError('formatting must be an object')
+        if 'sheet_id' in fields and fields['sheet_id'] not in self.sheets:
+            raise ValueError(f"sheet {fields['sheet_id']} does not exist")
+        # The conversions a write makes, tried on a cell no one sees
+        Cell(None, None, None, None).update(fields)
+
+    def import_rows(self, sheet_id: int, rows: Iterable[List[str]], start_row: int = 1,
+                    start_column: int = 1, chunk_size: int = 5000) -> Dict[str, int]:
+        """
+        Bulk-load rows of raw values into a sheet, chunk by chunk.
+        data_type is inferred per column within each chunk ('number' when every
+        value is numeric, otherwise 'text'; formulas are always 'formula').
+        No activities are logged, and formulas are recalculated once, the next
+        time the sheet is read. The cyclic garbage collector is paused while
+        the cells are created. The sheet is locked one chunk at a time, so
+        readers see the import progress chunk by chunk.
+        """
+        lock = self.sheet_locks[sheet_id]
+        imported_rows = 0
+        imported_cells = 0
+        rows = iter(rows)
+        with paused_gc():
+            while True:
+                chunk = [row for _, row in zip(range(chunk_size), rows)]
+                if not chunk:
+                    break
+                with lock.write():
+                    imported_cells += self._import_chunk(sheet_id, chunk, start_row + imported_rows, start_column)
+                imported_rows += len(chunk)
+        return {'rows': imported_rows, 'cells': imported_cells}
+
+    def _import_chunk(self, sheet_id: int, chunk: List[List[str]], start_row: int, start_column: int) -> int:
+        """Write one chunk of import_rows, whose first row goes at start_row; returns the cells written"""
+        index = self._sheet_index(sheet_id)
+        now = now_timestamp()
+        column_types = [DataType(data_type) for data_type in self._infer_column_types(chunk)]
+        written = []
+        for offset, values in enumerate(chunk):
+            row = start_row + offset
+            existing_row = index.rows.get(row) or {}
+            for position, value in enumerate(values):
+                column = start_column + position
+                existing = existing_row.get(column)
+                if value == '' and existing is None:
+                    continue
+                if value.startswith('='):
+                    data_type, formula = DataType.FORMULA, value
+                else:
+                    data_type, formula = column_types[position], None
+                if existing is not None:
+                    cell = existing
+                    cell.value, cell.formula, cell.data_type, cell.updated_at = value, formula, data_type, now
+                    cell.calculated_value = None
+                else:
+                    cell_id = self._get_next_id('cell')
+                    cell = Cell(cell_id, sheet_id, row, column, value, formula, data_type, 0, now, now)
+                    self.cells[cell_id] = cell
+                    index.add(cell)
+                written.append(cell)
+        self._touch_sheet(sheet_id, [(cell.row, cell.column) for cell in written])
+        with self._write_batch():
+            self._records_written('cell', written)
+        # The warm engine, if any, is rebuilt on the next read
+        self.engines.evict(sheet_id)
+        return len(written)
+
+    # Persistence hooks: no-ops here, overridden by the durable models below
+    def _records_written(self, entity_type: str, records: List[Dict]):
+        """Called after records of an entity type are created or updated in place"""
+
+    def _records_deleted(self, entity_type: str, ids: List[int]):
+        """Called after records of an entity type are removed by id"""
+
+    def _sheet_deleted(self, sheet_id: int):
+        """Called after a sheet and its cells are removed"""
+
+    @contextmanager
+    def _write_batch(self):
+        """Groups the writes of a multi-record operation so they are made durable together"""
+        yield
+
+    @staticmethod
+    def _infer_column_types(rows: List[List[str]]) -> List[str]:
+        width = max((len(row) for row in rows), default=0)
+        types = ['number'] * width
+        for row in rows:
+            for position, value in enumerate(row):
+                if types[position] == 'number' and value and not value.startswith('='):
+                    try:
+                        float(value)
+                    except ValueError:
+                        types[position] = 'text'
+        return types
+
+    # Calculation methods
+    def get_calculated_cells(self, sheet_id: int) -> Sequence[Cell]:
+        """Cells of a sheet with 'calculated_value' filled in for every formula"""
+        with self.sheet_locks[sheet_id].read():
+            return self.calculate_cells(sheet_id, self.get_cells_by_sheet(sheet_id))
+
+    def get_calculated_cells_in_range(self, sheet_id: int, top: int, left: int, bottom: int, right: int,
+                                      after: Optional[Tuple[int, int]] = None,
+                                      limit: Optional[int] = None) -> Tuple[List[Cell], Optional[Tuple[int, int]]]:
+        """
+        Cells inside a window of a sheet in row-major order, starting after the
+        (row, column) cursor and returning at most limit cells. Only formulas
+        in the returned page (and what they depend on) are evaluated.
+        Returns the page and the cursor of its last cell when more remain.
+        """
+        with self.sheet_locks[sheet_id].read():
+            index = self.sheet_cells.get(sheet_id)
+            if index is None:
+                return [], None
+            if after is not None:
+                top = max(top, after[0])
+            cells = []
+            for row in index.rows_between(top, bottom):
+                for cell in index.in_range(row, left, row, right):
+                    if after is not None and (cell.row, cell.column) <= after:
+                        continue
+                    if limit is not None and len(cells) == limit:
+                        last = cells[-1]
+                        return self.calculate_cells(sheet_id, cells), (last.row, last.column)
+                    cells.append(cell)
+            return self.calculate_cells(sheet_id, cells), None
+
+    def calculate_cells(self, sheet_id: int, cells: Sequence[Cell]) -> Sequence[Cell]:
+        """Fill in calculated_value for the formula cells among cells"""
+        lock = self.sheet_locks[sheet_id]
+        with lock.read(), lock.calculating:
+            engine = self.engines.get(sheet_id)
+            formulas = [cell for cell in cells if engine.is_formula((cell.row, cell.column))]
+            results = engine.evaluate_cells((cell.row, cell.column) for cell in formulas)
+            for cell in formulas:
+                cell.calculated_value = results[(cell.row, cell.column)]
+        return cells
+
+    def recalculate(self, sheet_id: int, changed: Optional[Iterable[Tuple[int, int]]] = None) -> Dict[Tuple[int, int], Any]:
+        """
+        Recompute the formulas downstream of the changed (row, column) positions,
+        or every formula when changed is None.
+        Returns the new result of each recomputed formula by position.
+        """
+        with self.sheet_locks[sheet_id].write():
+            return self._recalculate(sheet_id, changed)
+
+    def _recalculate(self, sheet_id: int, changed: Optional[Iterable[Tuple[int, int]]]) -> Dict[Tuple[int, int], Any]:
+        # Caller holds the sheet's write lock
+        engine = self.engines.get(sheet_id)
+        if changed is None:
+            results = engine.recalculate_all()
+        else:
+            results = engine.recalculate(changed)
+        self._store_results(sheet_id, results)
+        return results
+
+    def _store_results(self, sheet_id: int, results: Dict[Tuple[int, int], Any]):
+        for (row, column), value in results.items():
+            cell = self.get_cell(sheet_id, row, column)
+            if cell is not None:
+                cell.calculated_value = value
+
+    def _load_engine(self, sheet_id: int) -> FormulaEngine:
+        """Build the engine for a sheet that is not warm; formulas are evaluated as they are read"""
+        engine = FormulaEngine(self.recalculator)
+        engine.load_cells(((cell.row, cell.column), self._cell_source(cell))
+                          for cell in self.get_cells_by_sheet(sheet_id))
+        return engine
+
+    def _cell_removed(self, cell: Cell):
+        """Blank out a cell's old position in its sheet's engine"""
+        engine = self.engines.peek(cell.sheet_id)
+        if engine is not None:
+            position = (cell.row, cell.column)
+            engine.set_cell(position, '')
+            self._recalculate_after_write(cell.sheet_id, position)
+
+    def _cell_changed(self, cell: Cell):
+        """Pass a written cell to its sheet's engine and recalculate its dependents"""
+        engine = self.engines.peek(cell.sheet_id)
+        if engine is None:
+            # Not warm; the next read loads the sheet from scratch and computes the result then
+            cell.calculated_value = None
+            return
+        position = (cell.row, cell.column)
+        engine.set_cell(position, self._cell_source(cell))
+        if not engine.is_formula(position):
+            cell.calculated_value = None
+        self._recalculate_after_write(cell.sheet_id, position)
+
+    def _recalculate_after_write(self, sheet_id: int, position: Tuple[int, int]):
+        deferred = self._deferred_positions.get(sheet_id)
+        if deferred is not None:
+            deferred.append(position)
         else:
-            return self.create_cell({
-                'sheet_id': sheet_id,
-                'row': row,
-                'column': column,
-                'value': updates.get('value', ''),
-                'formula': updates.get('formula'),
-                'data_type': updates.get('data_type', 'text'),
-                'formatting': updates.get('formatting', {})
-            })
+            self._recalculate(sheet_id, [position])
+
+    @staticmethod
+    def _cell_source(cell: Cell) -> str:
+        """The text the formula engine sees for a cell: its formula or raw value"""
+        if cell.data_type is DataType.FORMULA and cell.formula:
+            return cell.formula
+        value = cell.value
+        return '' if value is None else str(value)
 
     # Comment methods
     def get_comments_by_cell(self, cell_id: int) -> List[Dict]:
-        return [c for c in self.comments.values() if c['cell_id'] == cell_id]
+        return [c for c in list(self.comments.values()) if c['cell_id'] == cell_id]
 
     def create_comment(self, data: Dict) -> Dict:
         comment_id = self._get_next_id('comment')
@@ -205,25 +741,66 @@ class SpreadsheetModel:
             'updated_at': datetime.now().isoformat()
         }
         self.comments[comment_id] = comment
+        self._records_written('comment', [comment])
         return comment
 
     # Activity methods
     def get_activities_by_spreadsheet(self, spreadsheet_id: int) -> List[Dict]:
-        return [a for a in self.activities.values() if a['spreadsheet_id'] == spreadsheet_id]
+        with self._activities_lock:
+            log = self.activity_logs.get(spreadsheet_id)
+            return list(log) if log is not None else []
+
+    def get_activity_page(self, spreadsheet_id: int, limit: int, before: Optional[int] = None,
+                          action: Optional[str] = None,
+                          user_id: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+        """A page of a spreadsheet's activities, newest first; see ActivityLog.page"""
+        with self._activities_lock:
+            log = self.activity_logs.get(spreadsheet_id)
+            if log is None:
+                return [], None
+            return log.page(limit, before, action, user_id)
 
     def create_activity(self, data: Dict) -> Dict:
-        activity_id = self._get_next_id('activity')
-        activity = {
-            'id': activity_id,
-            **data,
-            'created_at': datetime.now().isoformat()
-        }
-        self.activities[activity_id] = activity
+        # Ids are taken under the lock too: a log only takes activities newer than those it holds
+        with self._activities_lock:
+            activity_id = self._get_next_id('activity')
+            activity = {
+                'id': activity_id,
+                **data,
+                'created_at': datetime.now().isoformat()
+            }
+            self.activities[activity_id] = activity
+            evicted = self._activity_log(activity.get('spreadsheet_id')).append(activity)
+        with self._write_batch():
+            self._records_written('activity', [activity])
+            self._activities_evicted(evicted)
         return activity
 
+    def _activity_log(self, spreadsheet_id: int) -> ActivityLog:
+        log = self.activity_logs.get(spreadsheet_id)
+        if log is None:
+            log = self.activity_logs[spreadsheet_id] = ActivityLog(self.activity_retention)
+        return log
+
+    def _index_activities(self):
+        """Build the activity logs from the loaded activities, dropping those past retention"""
+        self.activity_logs = {}
+        evicted = []
+        for activity in sorted(self.activities.values(), key=lambda activity: activity['id']):
+            evicted.extend(self._activity_log(activity.get('spreadsheet_id')).append(activity))
+        if evicted:
+            with self._write_batch():
+                self._activities_evicted(evicted)
+
+    def _activities_evicted(self, evicted: List[Dict]):
+        if evicted:
+            for activity in evicted:
+                del self.activities[activity['id']]
+            self._records_deleted('activity', [activity['id'] for activity in evicted])
+
     # Collaborator methods
     def get_collaborators_by_spreadsheet(self, spreadsheet_id: int) -> List[Dict]:
-        return [c for c in self.collaborators.values() if c['spreadsheet_id'] == spreadsheet_id]
+        return [c for c in list(self.collaborators.values()) if c['spreadsheet_id'] == spreadsheet_id]
 
     def create_collaborator(self, data: Dict) -> Dict:
         collaborator_id = self._get_next_id('collaborator')
@@ -233,4 +810,313 @@ class SpreadsheetModel:
             'added_at': datetime.now().isoformat()
         }
         self.collaborators[collaborator_id] = collaborator
+        self._records_written('collaborator', [collaborator])
         return collaborator
+
+
+# entity type -> SpreadsheetModel attribute and storage table
+_TABLES = {
+    'spreadsheet': 'spreadsheets',
+    'sheet': 'sheets',
+    'cell': 'cells',
+    'comment': 'comments',
+    'activity': 'activities',
+    'collaborator': 'collaborators',
+}
+
+
+class PersistentSpreadsheetModel(SpreadsheetModel):
+    """
+    SpreadsheetModel backed by a SQLite database
+    The in-memory dicts stay in front as a hot cache: the database is loaded
+    once at startup, reads are served from memory and every write goes
+    through to the store. Multi-cell writes share one transaction. When a
+    write fails, the store rolls it back and the records it touched are
+    reloaded from the store, so memory never keeps what the database lost.
+    """
+
+    def __init__(self, path: str, activity_retention: int = DEFAULT_ACTIVITY_RETENTION,
+                 recalculator: Optional[ParallelRecalculator] = None):
+        self.store = SQLiteStore(path)
+        # Per thread: (entity type, ids) of the records the write in progress touched
+        self._touched = threading.local()
+        super().__init__(activity_retention, recalculator)
+
+    def _initialize_sample_data(self):
+        if self.store.is_empty():
+            super()._initialize_sample_data()
+            with self._write_batch():
+                for entity_type, table in _TABLES.items():
+                    self._records_written(entity_type, getattr(self, table).values())
+            return
+
+        with paused_gc():
+            for entity_type, table in _TABLES.items():
+                records = getattr(self, table)
+                for record in self.store.load(table):
+                    records[record['id']] = Cell.from_dict(record) if entity_type == 'cell' else record
+                self.current_ids[entity_type] = self.store.last_id(table) + 1
+            for cell in self.cells.values():
+                self._sheet_index(cell.sheet_id).add(cell)
+
+        # Cells stored before style tables carry their own formatting
+        legacy = [cell for cell in self.cells.values() if cell.extra and 'formatting' in cell.extra]
+        if legacy:
+            with self._write_batch():
+                for cell in legacy:
+                    cell.style_id = self._intern_style(cell.sheet_id, cell.extra.pop('formatting'))
+                self._records_written('cell', legacy)
+
+    def _records_written(self, entity_type: str, records: Iterable[Dict]):
+        records = list(records)
+        with self._write_batch():
+            self._touched.records.append((entity_type, [record['id'] for record in records]))
+            if entity_type == 'cell':
+                # Results are recomputed from the formulas, never stored
+                records = (_stored_cell(cell) for cell in records)
+            self.store.upsert(_TABLES[entity_type], records)
+
+    def _records_deleted(self, entity_type: str, ids: List[int]):
+        with self._write_batch():
+            self._touched.records.append((entity_type, list(ids)))
+            self.store.delete_ids(_TABLES[entity_type], ids)
+
+    def _sheet_deleted(self, sheet_id: int):
+        with self._write_batch():
+            self._touched.records.append(('sheet', [sheet_id]))
+            self.store.delete('sheets', 'id', sheet_id)
+            self.store.delete('cells', 'sheet_id', sheet_id)
+
+    @contextmanager
+    def _write_batch(self):
+        if getattr(self._touched, 'records', None) is not None:
+            with self.store.transaction():
+                yield
+            return
+        touched = self._touched.records = []
+        try:
+            with self.store.transaction():
+                yield
+        except BaseException:
+            self._restore(touched)
+            raise
+        finally:
+            self._touched.records = None
+
+    def _restore(self, touched: List[Tuple[str, List[int]]]):
+        """Reload the records a failed write touched, as the store holds them after its rollback"""
+        touched_ids: Dict[str, Set[int]] = {}
+        for entity_type, ids in touched:
+            touched_ids.setdefault(entity_type, set()).update(ids)
+        for entity_type, table in _TABLES.items():
+            ids = touched_ids.get(entity_type)
+            if not ids:
+                continue
+            stored = self.store.get(table, sorted(ids))
+            if entity_type == 'cell':
+                self._restore_cells(ids, stored)
+                continue
+            records = getattr(self, table)
+            for record_id in ids:
+                record, current = stored.get(record_id), records.get(record_id)
+                if record is None:
+                    records.pop(record_id, None)
+                elif current is None:
+                    records[record_id] = record
+                else:
+                    # In place, keeping a spreadsheet's styles list, which its StyleTable shares
+                    styles = current.get('styles')
+                    current.clear()
+                    current.update(record)
+                    if styles is not None:
+                        current['styles'] = styles
+            if entity_type == 'sheet':
+                # A sheet whose deletion failed gets its cells back
+                for sheet_id in ids:
+                    if sheet_id in stored and sheet_id not in self.sheet_cells:
+                        touched_ids.setdefault('cell', set()).update(
+                            cell['id'] for cell in self.store.select('cells', 'sheet_id', sheet_id))
+                    self._touch_sheet(sheet_id)
+            elif entity_type == 'activity':
+                self._reindex_activities()
+
+    def _restore_cells(self, ids: Set[int], stored: Dict[int, Dict]):
+        positions: Dict[int, Set[Tuple[int, int]]] = {}
+        for cell_id in ids:
+            cell = self.cells.pop(cell_id, None)
+            if cell is not None:
+                index = self.sheet_cells.get(cell.sheet_id)
+                if index is not None and index.get(cell.row, cell.column) is cell:
+                    index.remove(cell.row, cell.column)
+                positions.setdefault(cell.sheet_id, set()).add((cell.row, cell.column))
+        # All are out first: a restored cell may go back where another one moved
+        for cell_id in ids:
+            record = stored.get(cell_id)
+            if record is not None:
+                cell = self.cells[cell_id] = Cell.from_dict(record)
+                self._sheet_index(cell.sheet_id).add(cell)
+                positions.setdefault(cell.sheet_id, set()).add((cell.row, cell.column))
+        for sheet_id, sheet_positions in positions.items():
+            # Its engine saw the failed write; the next read rebuilds it
+            self.engines.evict(sheet_id)
+            written = {position for position in sheet_positions if self.get_cell(sheet_id, *position) is not None}
+            self._touch_sheet(sheet_id, written, sheet_positions - written)
+
+    def _reindex_activities(self):
+        """Rebuild the activity logs from the activities, dropping those past retention from memory"""
+        with self._activities_lock:
+            self.activity_logs = {}
+            for activity in sorted(self.activities.values(), key=lambda activity: activity['id']):
+                for evicted in self._activity_log(activity.get('spreadsheet_id')).append(activity):
+                    self.activities.pop(evicted['id'], None)
+
+
+def _stored_cell(cell: Cell) -> Dict:
+    record = cell.to_dict()
+    record.pop('calculated_value', None)
+    return record
+
+
+class LoggedSpreadsheetModel(SpreadsheetModel):
+    """
+    In-memory SpreadsheetModel made durable by a write-ahead log
+    Every write appends the whole written record (or a deletion) to the
+    log and waits for its group commit; multi-cell writes commit once. A
+    background thread snapshots the dicts and drops the log they cover.
+    Startup maps the newest snapshot and replays the log after it; the cells
+    of a sheet are only decoded from the snapshot when the sheet is first used.
+    """
+
+    def __init__(self, directory: str, snapshot_interval: float = 60.0,
+                 activity_retention: int = DEFAULT_ACTIVITY_RETENTION,
+                 recalculator: Optional[ParallelRecalculator] = None):
+        self.log = WriteAheadLog(directory)
+        self.snapshot: Optional[SnapshotReader] = None
+        # One snapshot at a time: a capture reads blocks of the snapshot the next one closes
+        self._snapshot_lock = threading.Lock()
+        super().__init__(activity_retention, recalculator)
+        if snapshot_interval:
+            self.log.start_snapshots(self.take_snapshot, snapshot_interval)
+
+    def _initialize_sample_data(self):
+        self.sheet_cells = LazySheetIndexes(self._load_sheet_cells)
+        snapshot, records = self.log.recover()
+        recovered = snapshot is not None
+        if snapshot is not None:
+            self.snapshot = snapshot
+            self.current_ids.update(snapshot.current_ids)
+            for table, records_by_id in snapshot.tables.items():
+                setattr(self, table, records_by_id)
+            self.sheet_cells.pending.update(snapshot.sheets)
+
+        with paused_gc():
+            for operation, entity_type, value in records:
+                recovered = True
+                if operation == 'delete' and entity_type == 'sheet':
+                    self.sheets.pop(value, None)
+                    for cell in self.sheet_cells.pop(value, ()):
+                        del self.cells[cell.id]
+                    continue
+                if operation == 'delete':
+                    records_by_id = getattr(self, _TABLES[entity_type])
+                    for record_id in value:
+                        records_by_id.pop(record_id, None)
+                    continue
+                if entity_type == 'cell':
+                    self._replay_cell(value)
+                else:
+                    getattr(self, _TABLES[entity_type])[value['id']] = value
+                self.current_ids[entity_type] = max(self.current_ids[entity_type], value['id'] + 1)
+
+        if not recovered:
+            super()._initialize_sample_data()
+            with self.log.group():
+                for entity_type, table in _TABLES.items():
+                    self._records_written(entity_type, getattr(self, table).values())
+
+    def _replay_cell(self, cell: Cell):
+        index = self._sheet_index(cell.sheet_id)
+        old = self.cells.get(cell.id)
+        if old is not None:
+            self.sheet_cells[old.sheet_id].remove(old.row, old.column)
+        self.cells[cell.id] = cell
+        index.add(cell)
+
+    def _load_sheet_cells(self, sheet_id: int) -> SheetIndex:
+        """Decode a sheet's cells from the snapshot into the cell records"""
+        index = SheetIndex()
+        with paused_gc():
+            for cell in self.snapshot.cells(sheet_id):
+                # A cell already loaded moved here from this sheet after the snapshot
+                if cell.id not in self.cells:
+                    self.cells[cell.id] = cell
+                    index.add(cell)
+        return index
+
+    def take_snapshot(self):
+        with self._snapshot_lock:
+            self.log.snapshot(self._capture)
+            snapshot = self.log.open_snapshot()
+            # Pending sheets load from the new snapshot, which holds their blocks too; swapped
+            # between loads, so the old map is no longer read once it is closed
+            with self.sheet_cells.load_lock:
+                previous, self.snapshot = self.snapshot, snapshot
+            if previous is not None:
+                previous.close()
+
+    def _capture(self):
+        """
+        The state to snapshot, safe to take while requests write: the list()
+        and dict() copies are single C calls, and any write they miss or that
+        is half-seen while the cells are encoded is replayed from the newer
+        log segment. Sheets never loaded
+        keep their encoded block from the current snapshot, unless cells of
+        the block were replayed into another sheet: the block is then
+        re-encoded without them, or they would come back in both sheets.
+        """
+        # Read pending before the cells: a sheet is only dropped from pending
+        # once its cells are loaded, so it shows up in one or the other
+        pending = list(self.sheet_cells.pending)
+        cells = list(self.cells.values())
+        cell_blocks = {}
+        if pending:
+            loaded = np.fromiter((cell.id for cell in cells), np.int64, len(cells))
+            for sheet_id in pending:
+                moved = np.isin(self.snapshot.cell_ids(sheet_id), loaded)
+                if moved.any():
+                    cell_blocks[sheet_id] = [cell for cell, gone in zip(self.snapshot.cells(sheet_id), moved.tolist())
+                                             if not gone]
+                else:
+                    cell_blocks[sheet_id] = self.snapshot.block(sheet_id)
+        for cell in cells:
+            sheet_id = cell.sheet_id
+            if sheet_id not in cell_blocks:
+                cell_blocks[sheet_id] = [cell]
+            elif isinstance(cell_blocks[sheet_id], list):
+                cell_blocks[sheet_id].append(cell)
+        tables = {}
+        for table in _TABLES.values():
+            if table != 'cells':
+                tables[table] = {record['id']: dict(record) for record in list(getattr(self, table).values())}
+        return dict(self.current_ids), tables, cell_blocks
+
+    def _records_written(self, entity_type: str, records: Iterable[Dict]):
+        append = self.log.append
+        with self.log.group():
+            for record in records:
+                # Cells pickle without their calculated_value
+                append(('put', entity_type, record))
+
+    def _records_deleted(self, entity_type: str, ids: List[int]):
+        self.log.append(('delete', entity_type, ids))
+
+    def _sheet_deleted(self, sheet_id: int):
+        self.log.append(('delete', 'sheet', sheet_id))
+
+    def _write_batch(self):
+        return self.log.group()
+
+    def close(self):
+        self.log.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
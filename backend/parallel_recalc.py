@@ -0,0 +1,119 @@
+import gc
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+
+Position = Tuple[int, int]
+
+logger = logging.getLogger(__name__)
+
+# The engine a worker process evaluates, inherited from the recalculating process
+_engine = None
+
+
+def _adopt(engine):
+    global _engine
+    _engine = engine
+    # A collection would visit, and so copy, every page shared with the parent; the
+    # worker only lives for one pass
+    gc.disable()
+    # It was forked inside the parent's pass; it evaluates in passes of its own, and
+    # evaluates its share itself rather than forking again
+    engine.context = None
+    engine.recalculator = None
+
+
+def _evaluate_group(positions: np.ndarray) -> Tuple[List[Any], int]:
+    """Raw results of the formulas at the (row, column) pairs and how many formulas were evaluated"""
+    positions = [tuple(position) for position in positions.tolist()]
+    _engine.evaluate_cells(positions)
+    results = _engine.results
+    # Formulas that failed to parse have no stored result; the caller evaluates those
+    return [results.get(position) for position in positions], _engine.last_pass.evaluations
+
+
+def column_tasks(stale: Set[Position], count: int) -> List[List[Position]]:
+    """
+    The stale formulas dealt into at most about count tasks of whole columns,
+    consecutive columns together, each task in position order
+    """
+    columns: Dict[int, List[Position]] = {}
+    for position in stale:
+        columns.setdefault(position[1], []).append(position)
+    target = -(-len(stale) // count)
+    tasks, current = [], []
+    for column in sorted(columns):
+        current.extend(columns[column])
+        if len(current) >= target:
+            tasks.append(sorted(current))
+            current = []
+    if current:
+        tasks.append(sorted(current))
+    return tasks
+
+
+class ParallelRecalculator:
+    """
+    Evaluates large batches of stale formulas across worker processes
+    The batch is dealt into tasks of whole formula columns, run on a pool
+    forked for the pass, so every worker starts from a copy-on-write image
+    of the engine with its formulas compiled and its values in place.
+    Columns that read nothing of one another, the usual shape of a wide
+    sheet, split cleanly; a formula reading another task's formulas has its
+    worker compute those too, so tasks never wait on each other and results
+    do not depend on how the batch was dealt. Tasks carry only the positions
+    to evaluate, as arrays of (row, column) pairs, and come back as lists of
+    raw results, merged into the engine in task order. Batches smaller than
+    min_formulas, or within a single column, are left to the caller.
+    """
+
+    def __init__(self, workers: int, min_formulas: int = 20000, tasks_per_worker: int = 4):
+        self.workers = workers
+        self.min_formulas = min_formulas
+        self.tasks_per_worker = tasks_per_worker
+        self._context = multiprocessing.get_context('fork')
+        # One pass at a time; each already keeps every worker busy
+        self._lock = threading.Lock()
+
+    def evaluate(self, engine, stale: Set[Position]) -> bool:
+        """
+        Evaluate the stale formulas into engine.results, counting them in the
+        engine's current pass. Returns False, having changed nothing, when
+        the caller should evaluate them itself.
+        """
+        if len(stale) < self.min_formulas:
+            return False
+        tasks = column_tasks(stale, self.workers * self.tasks_per_worker)
+        if len(tasks) < 2:
+            return False
+
+        try:
+            with self._lock:
+                returned = self._run(engine, tasks)
+        except Exception:
+            # No worse than evaluating serially, which the caller now does
+            logger.exception('Parallel recalculation of %d formulas failed; evaluating them serially', len(stale))
+            return False
+
+        results = engine.results
+        evaluations = 0
+        for task, (values, count) in zip(tasks, returned):
+            for position, value in zip(task, values):
+                if value is not None:
+                    results[position] = value
+            evaluations += count
+        engine.context.evaluations += evaluations
+        return True
+
+    def _run(self, engine, tasks: List[List[Position]]) -> List[Tuple[List[Any], int]]:
+        # Workers only run the engine, so no lock held by another thread of ours at the
+        # fork is ever needed in them
+        with ProcessPoolExecutor(min(self.workers, len(tasks)), mp_context=self._context,
+                                 initializer=_adopt, initargs=(engine,)) as pool:
+            futures = [pool.submit(_evaluate_group, np.array(task, dtype=np.int32)) for task in tasks]
+            return [future.result() for future in futures]
+
@@ -0,0 +1,153 @@
+import math
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from columnar_store import ColumnarSheet
+from formula_parser import CompiledFormula, FormulaError
+
+
+class ColumnSums:
+    """
+    Segment tree of the constant numbers of one column, indexed by row
+    Each node holds the sum and count of the numbers under it, so a range is
+    the sum of the O(log n) nodes that cover exactly its rows: unlike the
+    difference of two prefix sums, it picks up no rounding from the values
+    outside the range. A point update recomputes the node sums above the
+    row from their children, so updates never accumulate drift.
+    """
+
+    __slots__ = ('size', 'sums', 'counts')
+
+    def __init__(self, numbers: np.ndarray, valid: np.ndarray):
+        rows = len(numbers)
+        size = 1
+        while size < rows:
+            size *= 2
+        self.size = size
+        # NaN cells are skipped, as everywhere else numbers are collected
+        kept = valid & ~np.isnan(numbers)
+        self.sums = np.zeros(2 * size, dtype=np.float64)
+        self.counts = np.zeros(2 * size, dtype=np.int64)
+        self.sums[size:size + rows] = np.where(kept, numbers, 0.0)
+        self.counts[size:size + rows] = kept
+        level = size
+        while level > 1:
+            half = level // 2
+            self.sums[half:level] = self.sums[level:2 * level:2] + self.sums[level + 1:2 * level:2]
+            self.counts[half:level] = self.counts[level:2 * level:2] + self.counts[level + 1:2 * level:2]
+            level = half
+
+    def covers(self, row: int) -> bool:
+        return row < self.size
+
+    def set(self, row: int, value: Any):
+        """Make row hold value; anything but a number leaves the row empty"""
+        number = isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+        node = self.size + row
+        self.sums[node] = value if number else 0.0
+        self.counts[node] = 1 if number else 0
+        sums, counts = self.sums, self.counts
+        node //= 2
+        while node:
+            left = 2 * node
+            sums[node] = sums[left] + sums[left + 1]
+            counts[node] = counts[left] + counts[left + 1]
+            node //= 2
+
+    def sum_count(self, top: int, bottom: int) -> Tuple[float, int]:
+        """Sum and count of the numbers in rows top..bottom"""
+        bottom = min(bottom, self.size - 1)
+        if top > bottom:
+            return 0.0, 0
+        nodes = []
+        low, high = top + self.size, bottom + self.size + 1
+        while low < high:
+            if low & 1:
+                nodes.append(low)
+                low += 1
+            if high & 1:
+                high -= 1
+                nodes.append(high)
+            low //= 2
+            high //= 2
+        return math.fsum(self.sums[nodes].tolist()), int(self.counts[nodes].sum())
+
+
+class RangeAggregateCache:
+    """
+    SUM/COUNT building blocks for the columns of one sheet
+    Constant numbers are summed from a segment tree per column, built on the
+    first range over the column and kept current as cells change, so a range
+    costs O(log n) and its sum depends only on the values inside it. The
+    rows of the formula cells of each column are cached and kept sorted as
+    cells change; the caller adds their current results, so they never go
+    stale here.
+    """
+
+    def __init__(self, cells: ColumnarSheet):
+        self.cells = cells
+        # column -> segment tree of its constant numbers
+        self.sums: Dict[int, ColumnSums] = {}
+        # column -> sorted rows of its formula cells
+        self.columns: Dict[int, List[int]] = {}
+
+    def _column_sums(self, column: int) -> ColumnSums:
+        sums = self.sums.get(column)
+        if sums is None:
+            store = self.cells.columns.get(column)
+            if store is None:
+                sums = ColumnSums(np.zeros(0, dtype=np.float64), np.zeros(0, dtype=bool))
+            else:
+                sums = ColumnSums(store.numbers, store.valid)
+            self.sums[column] = sums
+        return sums
+
+    def _formula_rows(self, column: int) -> List[int]:
+        rows = self.columns.get(column)
+        if rows is None:
+            store = self.cells.columns.get(column)
+            objects = store.objects if store is not None else {}
+            rows = self.columns[column] = sorted(row for row, value in objects.items() if _is_formula(value))
+        return rows
+
+    def sum_count(self, column: int, top: int, bottom: int) -> Tuple[float, int, List[int]]:
+        """
+        Sum and count of the constant numbers in rows top..bottom of a column,
+        and the rows of the formula cells in that span
+        """
+        total, count = self._column_sums(column).sum_count(top, bottom)
+        return total, count, self.formula_rows(column, top, bottom)
+
+    def formula_rows(self, column: int, top: int, bottom: int) -> List[int]:
+        """Rows of the formula cells in rows top..bottom of a column"""
+        rows = self._formula_rows(column)
+        return rows[bisect_left(rows, top):bisect_right(rows, bottom)] if rows else []
+
+    def cell_changed(self, position: Tuple[int, int], old: Any, new: Any):
+        """Apply a cell change to the cached column, if there is one"""
+        row, column = position
+        sums = self.sums.get(column)
+        if sums is not None:
+            if sums.covers(row):
+                sums.set(row, new)
+            else:
+                # Past the end of the tree; rebuilt over the longer column when next summed
+                del self.sums[column]
+        rows = self.columns.get(column)
+        if rows is None:
+            return
+        if _is_formula(old) and not _is_formula(new):
+            del rows[bisect_left(rows, row)]
+        elif _is_formula(new) and not _is_formula(old):
+            insort(rows, row)
+
+    def clear(self):
+        self.sums = {}
+        self.columns = {}
+
+
+def _is_formula(value: Any) -> bool:
+    # Text starting with = is a formula the engine has not compiled yet
+    return isinstance(value, (CompiledFormula, FormulaError)) or (type(value) is str and value.startswith('='))
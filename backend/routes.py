@@ -1,9 +1,193 @@
-from flask import request, jsonify
-from formula_engine import FormulaEngine
+from flask import Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import csv
+import gzip
 import io
+import orjson
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it, responses are only gzipped
+    brotli = None
+
+from activity_writer import ActivityWriter
+from cell_record import Cell, cells_to_columns, cells_to_rows
+from gc_utils import paused_gc
+from sheet_events import SheetEventHub
+
+MAX_INDEX = 10 ** 9
+EXPORT_CHUNK_ROWS = 1000
+ACTIVITY_PAGE_SIZE = 50
+MAX_ACTIVITY_PAGE_SIZE = 1000
+# Seconds between keep-alive comments on an idle event stream
+EVENTS_KEEPALIVE = 15
+# ?format= values for cells: one object per cell, or a key header with one
+# array per cell or per field
+CELL_LAYOUTS = ('objects', 'rows', 'columns')
+# Smaller responses are sent as they are
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _parse_span(text):
+    """Parse a 1-based 'first-last' (or single 'n') span; missing means unbounded"""
+    if not text:
+        return 1, MAX_INDEX
+    first, _, last = text.partition('-')
+    try:
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise ValueError(f"Invalid span {text!r}, expected e.g. 1-200")
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid span {text!r}, expected e.g. 1-200")
+    return first, last
+
+
+def _parse_cursor(text):
+    """Parse a 'row:column' cursor returned as next_cursor"""
+    if not text:
+        return None
+    row, _, column = text.partition(':')
+    try:
+        return int(row), int(column)
+    except ValueError:
+        raise ValueError(f"Invalid cursor {text!r}")
+
+
+def _export_value(cell, computed):
+    if computed and cell.calculated_value is not None:
+        return cell.calculated_value
+    return cell.value
+
+
+def _cells_json(cells, styles, inline):
+    """
+    Cells in their API form. Inline spells out each cell's formatting;
+    otherwise cells only carry a style_id and the caller sends the styles.
+    """
+    if inline:
+        with paused_gc():
+            return [cell.to_dict(styles) for cell in cells]
+    return cells
+
+
+def _cell_layout():
+    """
+    The layout asked for with ?format=, and whether formatting goes inline.
+    The compact layouts always send formatting as a style table.
+    """
+    layout = request.args.get('format', 'objects')
+    if layout not in CELL_LAYOUTS:
+        raise ValueError(f"Invalid format {layout!r}, expected one of {', '.join(CELL_LAYOUTS)}")
+    return layout, layout == 'objects' and request.args.get('styles') != 'table'
+
+
+def _put_cells(result, cells, styles, layout, inline):
+    """Add cells to result in layout, with the styles they use unless inline"""
+    if layout == 'rows':
+        result['keys'], result['rows'] = cells_to_rows(cells)
+    elif layout == 'columns':
+        result['columns'] = cells_to_columns(cells)
+    else:
+        result['cells'] = _cells_json(cells, styles, inline)
+    if not inline:
+        result['styles'] = styles.to_dict(cell.style_id for cell in cells)
+    return result
+
+
+def _sheet_etag(model, sheet_id):
+    return f"{model.version_epoch}.s{model.get_sheet_version(sheet_id)}"
+
+
+def _spreadsheet_etag(model, spreadsheet_id):
+    return f"{model.version_epoch}.p{model.get_spreadsheet_version(spreadsheet_id)}"
+
+
+def _not_modified(etag):
+    """
+    The 304 for a conditional GET whose If-None-Match already holds etag,
+    or its tag for one of the encodings _compress sends; None otherwise
+    """
+    for tag in (etag, *(f"{etag}-{encoding}" for encoding in ('br', 'gzip'))):
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            return response
+    return None
+
+
+def _tagged(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def _compress(response):
+    """Compress a response with brotli or gzip when the client accepts it"""
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, GZIP_LEVEL, mtime=0))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    # A strong tag names the exact bytes, so the encoded body needs a tag of its own
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+class CellJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson and serializes Cell records in their API form"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Cell):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+    def _encode(self, obj, pretty=False) -> bytes:
+        # Style tables are keyed by integer ids
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self._encode(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self._encode(obj, pretty) + b'\n', mimetype=self.mimetype)
+
+
+def register_routes(app, model, activities=None, events=None):
+    """
+    Register the API. Activities are recorded through the ActivityWriter
+    given and sheet changes pushed through the SheetEventHub given, or new ones.
+    """
+    app.json = CellJSONProvider(app)
+    app.after_request(_compress)
+    if activities is None:
+        activities = ActivityWriter(model.create_activity)
+    if events is None:
+        events = SheetEventHub(model)
 
-def register_routes(app, model):
     # Spreadsheet routes
     @app.route('/api/spreadsheets', methods=['GET'])
     def get_spreadsheets():
@@ -17,10 +201,11 @@ def register_routes(app, model):
     @app.route('/api/spreadsheets/<int:spreadsheet_id>', methods=['GET'])
     def get_spreadsheet(spreadsheet_id):
         try:
+            etag = _spreadsheet_etag(model, spreadsheet_id)
             spreadsheet = model.get_spreadsheet(spreadsheet_id)
             if not spreadsheet:
                 return jsonify({'error': 'Spreadsheet not found'}), 404
-            return jsonify(spreadsheet)
+            return _not_modified(etag) or _tagged(jsonify(spreadsheet), etag)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -48,8 +233,12 @@ def register_routes(app, model):
     @app.route('/api/spreadsheets/<int:spreadsheet_id>/sheets', methods=['GET'])
     def get_sheets(spreadsheet_id):
         try:
+            etag = _spreadsheet_etag(model, spreadsheet_id)
+            not_modified = _not_modified(etag)
+            if not_modified:
+                return not_modified
             sheets = model.get_sheets_by_spreadsheet(spreadsheet_id)
-            return jsonify(sheets)
+            return _tagged(jsonify(sheets), etag)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -88,29 +277,106 @@ def register_routes(app, model):
     @app.route('/api/sheets/<int:sheet_id>/cells', methods=['GET'])
     def get_cells(sheet_id):
         try:
-            cells = model.get_cells_by_sheet(sheet_id)
-            
-            # Calculate formula values
-            formula_engine = FormulaEngine()
-            cell_values = {}
-            
-            # First pass: set all cell values
-            for cell in cells:
-                cell_id = f"{chr(64 + cell['column'])}{cell['row']}"
-                cell_values[cell_id] = cell['value']
-            
-            formula_engine.set_cells(cell_values)
-            
-            # Second pass: calculate formulas
-            for cell in cells:
-                if cell['data_type'] == 'formula' and cell['formula']:
-                    try:
-                        result = formula_engine.evaluate(cell['formula'])
-                        cell['calculated_value'] = result
-                    except:
-                        cell['calculated_value'] = '#ERROR'
-            
-            return jsonify(cells)
+            # Taken before reading, so a write racing this request only makes the tag stale
+            etag = _sheet_etag(model, sheet_id)
+            not_modified = _not_modified(etag)
+            if not_modified:
+                return not_modified
+
+            # ?styles=table sends each style used once, next to cells holding only a style_id;
+            # ?format=rows or ?format=columns sends cells as arrays under a key header
+            try:
+                layout, inline = _cell_layout()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            styles = model.get_sheet_styles(sheet_id)
+            if not any(param in request.args for param in ('rows', 'cols', 'limit', 'cursor')):
+                cells = model.get_calculated_cells(sheet_id)
+                if layout == 'objects' and inline:
+                    return _tagged(jsonify(_cells_json(cells, styles, inline)), etag)
+                return _tagged(jsonify(_put_cells({'sheet_id': sheet_id}, cells, styles, layout, inline)), etag)
+
+            # Windowed fetch: ?rows=1-200&cols=1-40&limit=500&cursor=<next_cursor>
+            try:
+                top, bottom = _parse_span(request.args.get('rows'))
+                left, right = _parse_span(request.args.get('cols'))
+                limit = request.args.get('limit', type=int)
+                cursor = _parse_cursor(request.args.get('cursor'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if limit is not None and limit < 1:
+                return jsonify({'error': 'limit must be positive'}), 400
+
+            cells, last = model.get_calculated_cells_in_range(
+                sheet_id, top, left, bottom, right, after=cursor, limit=limit
+            )
+            page = _put_cells({'sheet_id': sheet_id}, cells, styles, layout, inline)
+            page['next_cursor'] = f"{last[0]}:{last[1]}" if last else None
+            return _tagged(jsonify(page), etag)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/sheets/<int:sheet_id>/changes', methods=['GET'])
+    def get_changes(sheet_id):
+        try:
+            if not model.get_sheet(sheet_id):
+                return jsonify({'error': 'Sheet not found'}), 404
+            since = request.args.get('since', type=int)
+            if since is None or since < 0:
+                return jsonify({'error': 'since must be a version returned by this endpoint or an ETag'}), 400
+            try:
+                layout, inline = _cell_layout()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            # Taken first: changes racing this request are sent again on the next poll
+            version = model.get_sheet_version(sheet_id)
+            epoch = request.args.get('epoch')
+            changes = None
+            if (epoch is None or epoch == model.version_epoch) and since <= model.version:
+                changes = model.get_changes_since(sheet_id, since)
+            if changes is None:
+                # The client is too far behind, or from before a restart: fetch the sheet again
+                return jsonify({
+                    'error': 'changes since that version are no longer available',
+                    'epoch': model.version_epoch,
+                    'version': version
+                }), 410
+
+            cells, removed = changes
+            result = {
+                'epoch': model.version_epoch,
+                'version': version,
+                'deleted': [{'row': row, 'column': column} for row, column in removed]
+            }
+            return jsonify(_put_cells(result, cells, model.get_sheet_styles(sheet_id), layout, inline))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/sheets/<int:sheet_id>/events', methods=['GET'])
+    def sheet_events(sheet_id):
+        try:
+            if not model.get_sheet(sheet_id):
+                return jsonify({'error': 'Sheet not found'}), 404
+            # A reconnecting EventSource sends the id of the last event it saw
+            since = request.args.get('since', type=int)
+            if since is None and request.headers.get('Last-Event-ID', '').isdigit():
+                since = int(request.headers['Last-Event-ID'])
+            subscription = events.subscribe(sheet_id, since, request.args.get('epoch'))
+
+            def generate():
+                try:
+                    while True:
+                        event = subscription.get(EVENTS_KEEPALIVE)
+                        yield event if event is not None else ': keep-alive\n\n'
+                finally:
+                    events.unsubscribe(subscription)
+
+            return Response(generate(), 200, {
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -121,7 +387,7 @@ def register_routes(app, model):
             cell = model.update_cell_by_position(sheet_id, row, column, data)
             
             # Log activity
-            model.create_activity({
+            activities.record({
                 'spreadsheet_id': 1,  # TODO: Get from sheet
                 'user_id': 1,  # TODO: Get from session
                 'action': 'cell_updated',
@@ -133,7 +399,142 @@ def register_routes(app, model):
                 }
             })
             
-            return jsonify(cell)
+            return jsonify(cell.to_dict(model.get_sheet_styles(sheet_id)))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+
+    @app.route('/api/sheets/<int:sheet_id>/cells:batch', methods=['POST'])
+    def batch_update_cells(sheet_id):
+        try:
+            data = request.get_json()
+            updates = data.get('updates') if isinstance(data, dict) else None
+            if not isinstance(updates, list) or not updates:
+                return jsonify({'error': 'updates must be a non-empty list'}), 400
+            for update in updates:
+                if not isinstance(update, dict) or not isinstance(update.get('row'), int) \
+                        or not isinstance(update.get('column'), int) \
+                        or update['row'] < 1 or update['column'] < 1:
+                    return jsonify({'error': 'each update needs a positive integer row and column'}), 400
+            sheet = model.get_sheet(sheet_id)
+            if not sheet:
+                return jsonify({'error': 'Sheet not found'}), 404
+
+            cells, recalculated = model.update_cells_by_position(sheet_id, updates)
+
+            # Log one activity for the whole batch
+            rows = [u['row'] for u in updates]
+            columns = [u['column'] for u in updates]
+            activities.record({
+                'spreadsheet_id': sheet['spreadsheet_id'],
+                'user_id': 1,  # TODO: Get from session
+                'action': 'cells_batch_updated',
+                'details': {
+                    'sheet_id': sheet_id,
+                    'count': len(updates),
+                    'range': {
+                        'top': min(rows),
+                        'left': min(columns),
+                        'bottom': max(rows),
+                        'right': max(columns)
+                    }
+                }
+            })
+
+            return jsonify({
+                'cells': _cells_json(cells, model.get_sheet_styles(sheet_id), True),
+                'recalculated': [
+                    {'row': row, 'column': column, 'calculated_value': value}
+                    for (row, column), value in recalculated.items()
+                ]
+            })
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+
+    @app.route('/api/sheets/<int:sheet_id>/cells:format', methods=['POST'])
+    def format_cells(sheet_id):
+        try:
+            sheet = model.get_sheet(sheet_id)
+            if not sheet:
+                return jsonify({'error': 'Sheet not found'}), 404
+            data = request.get_json()
+            if not isinstance(data, dict) or not isinstance(data.get('formatting'), dict):
+                return jsonify({'error': 'formatting must be an object'}), 400
+            bounds = [data.get(key) for key in ('top', 'left', 'bottom', 'right')]
+            if not all(isinstance(bound, int) and bound >= 1 for bound in bounds) \
+                    or bounds[2] < bounds[0] or bounds[3] < bounds[1]:
+                return jsonify({'error': 'top, left, bottom and right must span a range of positive integers'}), 400
+
+            top, left, bottom, right = bounds
+            cells = model.format_range(sheet_id, top, left, bottom, right, data['formatting'],
+                                       merge=bool(data.get('merge')))
+
+            activities.record({
+                'spreadsheet_id': sheet['spreadsheet_id'],
+                'user_id': 1,  # TODO: Get from session
+                'action': 'cells_formatted',
+                'details': {
+                    'sheet_id': sheet_id,
+                    'count': len(cells),
+                    'range': {'top': top, 'left': left, 'bottom': bottom, 'right': right}
+                }
+            })
+
+            styles = model.get_sheet_styles(sheet_id)
+            return jsonify({
+                'cells': len(cells),
+                'styles': styles.to_dict(cell.style_id for cell in cells)
+            })
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+
+    @app.route('/api/sheets/<int:sheet_id>/styles', methods=['GET'])
+    def get_styles(sheet_id):
+        try:
+            sheet = model.get_sheet(sheet_id)
+            if not sheet:
+                return jsonify({'error': 'Sheet not found'}), 404
+            etag = _spreadsheet_etag(model, sheet['spreadsheet_id'])
+            return _not_modified(etag) or _tagged(jsonify(model.get_sheet_styles(sheet_id).to_dict()), etag)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/sheets/<int:sheet_id>/import', methods=['POST'])
+    def import_cells(sheet_id):
+        try:
+            sheet = model.get_sheet(sheet_id)
+            if not sheet:
+                return jsonify({'error': 'Sheet not found'}), 404
+
+            # Accept a multipart upload ('file') or the raw CSV/TSV request body
+            upload = request.files.get('file')
+            stream = upload.stream if upload else request.stream
+            filename = upload.filename if upload and upload.filename else ''
+            fmt = request.args.get('format') or ('tsv' if filename.lower().endswith('.tsv') else 'csv')
+            if fmt not in ('csv', 'tsv'):
+                return jsonify({'error': 'format must be csv or tsv'}), 400
+            start_row = request.args.get('row', 1, type=int)
+            start_column = request.args.get('column', 1, type=int)
+            if start_row < 1 or start_column < 1:
+                return jsonify({'error': 'row and column must be positive'}), 400
+
+            text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+            reader = csv.reader(text, delimiter='\t' if fmt == 'tsv' else ',')
+            result = model.import_rows(sheet_id, reader, start_row, start_column)
+
+            activities.record({
+                'spreadsheet_id': sheet['spreadsheet_id'],
+                'user_id': 1,  # TODO: Get from session
+                'action': 'sheet_imported',
+                'details': {
+                    'sheet_id': sheet_id,
+                    'format': fmt,
+                    **result
+                }
+            })
+
+            return jsonify(result), 201
+        except (UnicodeDecodeError, csv.Error) as e:
+            return jsonify({'error': f'Invalid {fmt} data: {e}'}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 400
 
@@ -160,8 +561,28 @@ def register_routes(app, model):
     @app.route('/api/spreadsheets/<int:spreadsheet_id>/activities', methods=['GET'])
     def get_activities(spreadsheet_id):
         try:
-            activities = model.get_activities_by_spreadsheet(spreadsheet_id)
-            return jsonify(activities)
+            if not any(param in request.args for param in ('limit', 'before', 'action', 'user')):
+                activities = model.get_activities_by_spreadsheet(spreadsheet_id)
+                return jsonify(activities)
+
+            # Paginated, newest first: ?limit=50&before=<next_before>&action=cell_updated&user=1
+            limit = request.args.get('limit', ACTIVITY_PAGE_SIZE, type=int)
+            before = request.args.get('before', type=int)
+            user_id = request.args.get('user', type=int)
+            if not 1 <= limit <= MAX_ACTIVITY_PAGE_SIZE:
+                return jsonify({'error': f'limit must be between 1 and {MAX_ACTIVITY_PAGE_SIZE}'}), 400
+            if 'user' in request.args and user_id is None:
+                return jsonify({'error': 'user must be an integer'}), 400
+            if 'before' in request.args and before is None:
+                return jsonify({'error': 'before must be an activity id'}), 400
+
+            activities, next_before = model.get_activity_page(
+                spreadsheet_id, limit, before, request.args.get('action'), user_id
+            )
+            return jsonify({
+                'activities': activities,
+                'next_before': next_before
+            })
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -178,36 +599,52 @@ def register_routes(app, model):
     @app.route('/api/spreadsheets/<int:spreadsheet_id>/export/csv', methods=['GET'])
     def export_csv(spreadsheet_id):
         try:
+            etag = _spreadsheet_etag(model, spreadsheet_id)
             sheets = model.get_sheets_by_spreadsheet(spreadsheet_id)
             
             if not sheets:
                 return jsonify({'error': 'No sheets found'}), 404
+            not_modified = _not_modified(etag)
+            if not_modified:
+                return not_modified
             
             first_sheet = sheets[0]
-            cells = model.get_cells_by_sheet(first_sheet['id'])
-            
-            # Convert cells to CSV format
-            max_row = max([c['row'] for c in cells], default=0)
-            max_col = max([c['column'] for c in cells], default=0)
-            
-            # Create CSV data
-            csv_data = []
-            for row in range(1, max_row + 1):
-                csv_row = []
-                for col in range(1, max_col + 1):
-                    cell = next((c for c in cells if c['row'] == row and c['column'] == col), None)
-                    csv_row.append(cell['value'] if cell else '')
-                csv_data.append(csv_row)
-            
-            # Generate CSV string
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerows(csv_data)
-            csv_string = output.getvalue()
-            
-            return csv_string, 200, {
+            sheet_id = first_sheet['id']
+            # ?values=computed exports formula results instead of the formulas
+            computed = request.args.get('values') == 'computed'
+            max_row, max_col = model.get_sheet_bounds(sheet_id)
+
+            def generate():
+                # Rows are laid out in one pass over the sheet index and sent in chunks
+                output = io.StringIO()
+                writer = csv.writer(output)
+                blank_row = [''] * max_col
+                next_row = 1
+                chunk = []
+                rows = model.iter_rows(sheet_id)
+                while True:
+                    chunk = [entry for _, entry in zip(range(EXPORT_CHUNK_ROWS), rows)]
+                    if not chunk:
+                        break
+                    if computed:
+                        model.calculate_cells(sheet_id, [cell for _, row_cells in chunk for cell in row_cells.values()])
+                    for row, row_cells in chunk:
+                        for _ in range(next_row, row):
+                            writer.writerow(blank_row)
+                        csv_row = [''] * max_col
+                        for column, cell in row_cells.items():
+                            # Cells written past the bounds read above, while streaming, are left out
+                            if column <= max_col:
+                                csv_row[column - 1] = _export_value(cell, computed)
+                        writer.writerow(csv_row)
+                        next_row = row + 1
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate()
+
+            return _tagged(Response(stream_with_context(generate()), 200, {
                 'Content-Type': 'text/csv',
                 'Content-Disposition': f'attachment; filename="{first_sheet["name"]}.csv"'
-            }
+            }), etag)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
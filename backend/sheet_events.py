@@ -0,0 +1,154 @@
+import queue
+import threading
+from typing import Dict, Optional, Set
+
+import orjson
+
+# Sent to a subscriber whose queue overflowed, or who asked for changes the
+# change log no longer holds: the client should fetch the sheet again
+RESET = 'reset'
+CHANGES = 'changes'
+
+
+def _event(name: str, version: int, data: Dict) -> str:
+    """One Server-Sent Events message; its id is the sheet version it brings the client to"""
+    return f"id: {version}\nevent: {name}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+class Subscription:
+    """
+    One client's stream of events for a sheet
+    Events wait in a bounded queue. A client that falls max_pending events
+    behind loses them all and gets a single reset event instead, so a slow
+    consumer costs the server a fixed amount of memory.
+    """
+
+    def __init__(self, sheet_id: int, max_pending: int):
+        self.sheet_id = sheet_id
+        self._queue: queue.Queue = queue.Queue(max_pending)
+
+    def push(self, event: str, reset: str):
+        """Queue event; when the queue is full, everything queued is replaced by reset"""
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait(reset)
+
+    def get(self, timeout: float) -> Optional[str]:
+        """The next event, or None when none came within timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class _Channel:
+    __slots__ = ('version', 'subscribers')
+
+    def __init__(self, version: int):
+        # The sheet version the last broadcast brought subscribers to
+        self.version = version
+        self.subscribers: Set[Subscription] = set()
+
+
+class SheetEventHub:
+    """
+    Pushes the changes of subscribed sheets to their subscribers
+    Every tick, each sheet whose version moved has its changes since the
+    last broadcast read once from the model's change log (written cells,
+    recalculated dependents and emptied positions), encoded once and
+    queued for each subscriber.
+    """
+
+    def __init__(self, model, tick: float = 0.1, max_pending: int = 64):
+        self.model = model
+        self.tick = tick
+        self.max_pending = max_pending
+        self._channels: Dict[int, _Channel] = {}
+        self._lock = threading.Lock()
+        self._broadcast_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def subscribe(self, sheet_id: int, since: Optional[int] = None, epoch: Optional[str] = None) -> Subscription:
+        """
+        Subscribe to a sheet. With since (a version from this epoch), the
+        first event catches the client up from there; otherwise it only
+        carries the current version.
+        """
+        subscription = Subscription(sheet_id, self.max_pending)
+        with self._lock:
+            channel = self._channels.get(sheet_id)
+            if channel is None:
+                channel = self._channels[sheet_id] = _Channel(self.model.get_sheet_version(sheet_id))
+            channel.subscribers.add(subscription)
+            # Under the lock, so no broadcast falls between the catch-up and the next tick
+            version = self.model.get_sheet_version(sheet_id)
+            if since is None:
+                first = self._changes_event(sheet_id, version, ([], []))
+            else:
+                changes = None
+                if (epoch is None or epoch == self.model.version_epoch) and since <= self.model.version:
+                    changes = self.model.get_changes_since(sheet_id, since)
+                first = self._changes_event(sheet_id, version, changes)
+            subscription.push(first, self._reset_event(version))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sheet-events', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            channel = self._channels.get(subscription.sheet_id)
+            if channel is not None:
+                channel.subscribers.discard(subscription)
+                if not channel.subscribers:
+                    del self._channels[subscription.sheet_id]
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.broadcast()
+
+    def broadcast(self):
+        """Queue the changes of every subscribed sheet since its last broadcast"""
+        # One broadcast at a time, so each sheet's events are queued in version order
+        with self._broadcast_lock:
+            # Only the versions are read under the hub lock; subscribe and
+            # unsubscribe need not wait for changes to be read and encoded
+            with self._lock:
+                due = []
+                for sheet_id, channel in self._channels.items():
+                    version = self.model.get_sheet_version(sheet_id)
+                    if version != channel.version:
+                        due.append((sheet_id, channel.version, version, list(channel.subscribers)))
+                        channel.version = version
+            for sheet_id, since, version, subscribers in due:
+                event = self._changes_event(sheet_id, version, self.model.get_changes_since(sheet_id, since))
+                reset = self._reset_event(version)
+                for subscription in subscribers:
+                    subscription.push(event, reset)
+
+    def _reset_event(self, version: int) -> str:
+        return _event(RESET, version, {'epoch': self.model.version_epoch, 'version': version})
+
+    def _changes_event(self, sheet_id: int, version: int, changes) -> str:
+        if changes is None:
+            return self._reset_event(version)
+        cells, removed = changes
+        styles = self.model.get_sheet_styles(sheet_id)
+        return _event(CHANGES, version, {
+            'epoch': self.model.version_epoch,
+            'version': version,
+            'cells': [cell.to_dict(styles) for cell in cells],
+            'deleted': [{'row': row, 'column': column} for row, column in removed]
+        })
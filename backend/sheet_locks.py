@@ -0,0 +1,154 @@
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Optional
+
+
+class _Side:
+    """One side of a ReadWriteLock as a context manager"""
+
+    __slots__ = ('acquire', 'release')
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ReadWriteLock:
+    """
+    A lock held by any number of readers or by one writer
+    Waiting writers hold off new readers, so a steady stream of reads cannot
+    starve writes. It is reentrant: the writing thread may take either side
+    again and a reading thread may read again, but a reader may not take the
+    write side, as two readers upgrading would wait on each other forever.
+    A writer holds the internal mutex for the whole write, so other threads
+    simply queue on it and an uncontended write costs one lock round trip.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._condition = threading.Condition(self._mutex)
+        self._readers = 0
+        self._writers_waiting = 0
+        # Threads blocked in wait(); releases only notify when there are any
+        self._waiting = 0
+        self._writer: Optional[int] = None
+        self._write_depth = 0
+        # thread ident -> how many times that thread holds the read side
+        self._read_depths: Dict[int, int] = {}
+        self._read = _Side(self.acquire_read, self.release_read)
+        self._write = _Side(self.acquire_write, self.release_write)
+
+    def read(self) -> _Side:
+        return self._read
+
+    def write(self) -> _Side:
+        return self._write
+
+    def _wait(self):
+        # Caller holds _mutex
+        self._waiting += 1
+        self._condition.wait()
+        self._waiting -= 1
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        depth = self._read_depths.get(me)
+        if depth:
+            self._read_depths[me] = depth + 1
+            return
+        # Blocks while a writer holds the mutex; waits while one is waiting for readers to leave
+        with self._mutex:
+            while self._writers_waiting:
+                self._wait()
+            self._readers += 1
+            self._read_depths[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self.release_write()
+            return
+        depth = self._read_depths[me] - 1
+        if depth:
+            self._read_depths[me] = depth
+            return
+        with self._mutex:
+            del self._read_depths[me]
+            self._readers -= 1
+            if not self._readers and self._waiting:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        if me in self._read_depths:
+            raise RuntimeError('cannot take the write side of a lock while reading under it')
+        self._mutex.acquire()
+        if self._readers:
+            self._writers_waiting += 1
+            while self._readers:
+                self._wait()
+            self._writers_waiting -= 1
+        # The mutex stays held until release_write
+        self._writer = me
+        self._write_depth = 1
+
+    def release_write(self):
+        self._write_depth -= 1
+        if not self._write_depth:
+            self._writer = None
+            if self._waiting:
+                self._condition.notify_all()
+            self._mutex.release()
+
+
+class SheetLock(ReadWriteLock):
+    """
+    The lock of one sheet: reads of its cells take the read side, writes the
+    write side. Filling in formula results updates the sheet's engine and
+    cells, so readers doing it also hold calculating and take turns; writers
+    already have the sheet to themselves.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calculating = threading.Lock()
+
+
+class SheetLocks:
+    """The SheetLock of each sheet, made on first use"""
+
+    def __init__(self):
+        self._locks: Dict[int, SheetLock] = {}
+
+    def __getitem__(self, sheet_id: int) -> SheetLock:
+        lock = self._locks.get(sheet_id)
+        if lock is None:
+            # setdefault is atomic, so racing threads end up with the same lock
+            lock = self._locks.setdefault(sheet_id, SheetLock())
+        return lock
+
+    def writing(self, *sheet_ids: int):
+        """Hold the write side of every given sheet, taken in id order so writers never deadlock"""
+        sheet_ids = sorted(set(sheet_ids))
+        if len(sheet_ids) == 1:
+            return self[sheet_ids[0]].write()
+        return self._writing_all(sheet_ids)
+
+    @contextmanager
+    def _writing_all(self, sheet_ids):
+        with ExitStack() as stack:
+            for sheet_id in sheet_ids:
+                stack.enter_context(self[sheet_id].write())
+            yield
@@ -0,0 +1,171 @@
+import io
+import mmap
+import pickle
+import struct
+from operator import attrgetter
+from typing import Any, BinaryIO, Dict, List, Union
+
+import numpy as np
+
+from cell_record import Cell, DataType
+from gc_utils import paused_gc
+
+# File layout:
+#   header        magic, directory offset, directory length
+#   cell blocks   one per sheet, 8-byte aligned, each self-contained
+#   directory     pickled log sequence, id counters, the non-cell tables
+#                 and sheet_id -> (offset, length) of each cell block
+# A cell block holds the cell count, string count and extras length, then
+# the columns: id, row, column, style_id, created_at, updated_at (int64), two
+# uint32 string references per cell for value and formula, a uint8 data_type,
+# the string table (uint64 offsets and a UTF-8 blob) and a pickle of whatever
+# does not fit the columns (non-string values, extra fields).
+MAGIC = b'PXSNAP03'
+_HEADER = struct.Struct('<8sQQ')
+_BLOCK_HEADER = struct.Struct('<QQQ')
+_INTEGER_FIELDS = ('id', 'row', 'column', 'style_id', 'created_at', 'updated_at')
+_STRING_FIELDS = ('value', 'formula')
+_DATA_TYPES = list(DataType)
+_NO_DATA_TYPE = 255
+_NO_STRING = 0xFFFFFFFF
+
+
+def encode_cell_block(cells: List[Cell]) -> bytes:
+    """Columnar encoding of the cells of one sheet"""
+    count = len(cells)
+    integers = [np.fromiter(map(attrgetter(field), cells), np.int64, count) for field in _INTEGER_FIELDS]
+    codes = {data_type: code for code, data_type in enumerate(_DATA_TYPES)}
+    data_types = np.fromiter((codes.get(cell.data_type, _NO_DATA_TYPE) for cell in cells), np.uint8, count)
+    references = np.full((len(_STRING_FIELDS), count), _NO_STRING, dtype=np.uint32)
+    strings: Dict[str, int] = {}
+    extras: Dict[int, Dict] = {}
+
+    for field_number, field in enumerate(_STRING_FIELDS):
+        field_references = references[field_number]
+        for i, value in enumerate(map(attrgetter(field), cells)):
+            if type(value) is str:
+                field_references[i] = strings.setdefault(value, len(strings))
+            elif value is not None:
+                extras.setdefault(i, {})[field] = value
+    for i, cell in enumerate(cells):
+        if cell.extra:
+            extras.setdefault(i, {}).update(cell.extra)
+
+    encoded = [string.encode('utf-8', 'surrogatepass') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    extras_bytes = _dumps(extras) if extras else b''
+    return b''.join((
+        _BLOCK_HEADER.pack(count, len(encoded), len(extras_bytes)),
+        *(column.tobytes() for column in integers), references.tobytes(), data_types.tobytes(),
+        offsets.tobytes(), b''.join(encoded), extras_bytes,
+    ))
+
+
+def decode_cell_block(block: Union[bytes, memoryview], sheet_id: int) -> List[Cell]:
+    """The cells of a block written by encode_cell_block"""
+    count, string_count, extras_length = _BLOCK_HEADER.unpack_from(block, 0)
+    position = _BLOCK_HEADER.size
+    ids, rows, columns, style_ids, created, updated = (
+        np.frombuffer(block, np.int64, count, position + 8 * count * i).tolist()
+        for i in range(len(_INTEGER_FIELDS)))
+    position += 8 * len(_INTEGER_FIELDS) * count
+    references = np.frombuffer(block, np.uint32, len(_STRING_FIELDS) * count, position)
+    position += 4 * len(_STRING_FIELDS) * count
+    data_types = np.frombuffer(block, np.uint8, count, position).tolist()
+    position += count
+    offsets = np.frombuffer(block, np.uint64, string_count + 1, position).tolist()
+    position += 8 * (string_count + 1)
+    blob = bytes(block[position:position + offsets[-1]])
+    position += offsets[-1]
+    extras = pickle.loads(block[position:position + extras_length]) if extras_length else {}
+
+    # The last entry stands for "no string" / "no data type"
+    strings = [blob[start:end].decode('utf-8', 'surrogatepass') for start, end in zip(offsets, offsets[1:])]
+    strings.append(None)
+    references = np.where(references == _NO_STRING, string_count, references)
+    values, formulas = ([strings[reference] for reference in field]
+                        for field in references.reshape(len(_STRING_FIELDS), count).tolist())
+    types = _DATA_TYPES + [None] * (256 - len(_DATA_TYPES))
+
+    cells = []
+    with paused_gc():
+        for i in range(count):
+            cell = Cell(ids[i], sheet_id, rows[i], columns[i], values[i], formulas[i],
+                        types[data_types[i]], style_ids[i], created[i], updated[i])
+            extra = extras.get(i)
+            if extra:
+                cell.update(extra)
+            cells.append(cell)
+    return cells
+
+
+def write_snapshot(file: BinaryIO, sequence: int, current_ids: Dict[str, int],
+                   tables: Dict[str, Dict[int, Dict]], cell_blocks: Dict[int, Any]):
+    """
+    Write a snapshot. cell_blocks maps each sheet id to its cells or to
+    an already encoded block (copied verbatim from an older snapshot).
+    """
+    file.write(_HEADER.pack(MAGIC, 0, 0))
+    sheets = {}
+    for sheet_id, block in cell_blocks.items():
+        if isinstance(block, list):
+            block = encode_cell_block(block)
+        file.write(b'\0' * (-file.tell() % 8))
+        sheets[sheet_id] = (file.tell(), len(block))
+        file.write(block)
+    directory = _dumps({'sequence': sequence, 'current_ids': current_ids, 'tables': tables, 'sheets': sheets})
+    offset = file.tell()
+    file.write(directory)
+    file.seek(0)
+    file.write(_HEADER.pack(MAGIC, offset, len(directory)))
+
+
+def _dumps(value: Any) -> bytes:
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    # Plain trees of records: skip the memo, which costs more than it saves
+    pickler.fast = True
+    pickler.dump(value)
+    return buffer.getvalue()
+
+
+class SnapshotReader:
+    """
+    A snapshot file mapped into memory
+    Opening it reads the header and directory only; a sheet's cell block is
+    paged in and decoded when cells(sheet_id) is first called for it.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, length = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        with paused_gc():
+            directory = pickle.loads(self._map[offset:offset + length])
+        self.sequence: int = directory['sequence']
+        self.current_ids: Dict[str, int] = directory['current_ids']
+        self.tables: Dict[str, Dict[int, Dict]] = directory['tables']
+        self.sheets: Dict[int, tuple] = directory['sheets']
+
+    def block(self, sheet_id: int) -> memoryview:
+        offset, length = self.sheets[sheet_id]
+        return memoryview(self._map)[offset:offset + length]
+
+    def cell_ids(self, sheet_id: int) -> np.ndarray:
+        """The ids of a sheet's cells in block order, read without decoding the block"""
+        block = self.block(sheet_id)
+        count = _BLOCK_HEADER.unpack_from(block, 0)[0]
+        return np.frombuffer(block, np.int64, count, _BLOCK_HEADER.size)
+
+    def cells(self, sheet_id: int) -> List[Cell]:
+        return decode_cell_block(self.block(sheet_id), sheet_id)
+
+    def close(self):
+        """Unmap the file; a block still held elsewhere keeps the map until it is dropped"""
+        try:
+            self._map.close()
+        except BufferError:
+            pass
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List
+
+# Indexed columns of each table, besides the id; the full record is kept as JSON in `data`.
+# Ids are AUTOINCREMENT so that ids of deleted records are never handed out again.
+_KEY_COLUMNS = {
+    'spreadsheets': ('owner_id',),
+    'sheets': ('spreadsheet_id',),
+    'cells': ('sheet_id', 'row', 'column'),
+    'comments': ('cell_id',),
+    'activities': ('spreadsheet_id',),
+    'collaborators': ('spreadsheet_id',),
+}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spreadsheets (id INTEGER PRIMARY KEY AUTOINCREMENT, owner_id INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_spreadsheets_owner ON spreadsheets (owner_id);
+CREATE TABLE IF NOT EXISTS sheets (id INTEGER PRIMARY KEY AUTOINCREMENT, spreadsheet_id INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_sheets_spreadsheet ON sheets (spreadsheet_id);
+CREATE TABLE IF NOT EXISTS cells (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_id INTEGER, "row" INTEGER, "column" INTEGER, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cells_position ON cells (sheet_id, "row", "column");
+CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY AUTOINCREMENT, cell_id INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_comments_cell ON comments (cell_id);
+CREATE TABLE IF NOT EXISTS activities (id INTEGER PRIMARY KEY AUTOINCREMENT, spreadsheet_id INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_activities_spreadsheet ON activities (spreadsheet_id);
+CREATE TABLE IF NOT EXISTS collaborators (id INTEGER PRIMARY KEY AUTOINCREMENT, spreadsheet_id INTEGER, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_collaborators_spreadsheet ON collaborators (spreadsheet_id);
+'''
+
+
+def _upsert_sql(table: str) -> str:
+    columns = ('id',) + _KEY_COLUMNS[table] + ('data',)
+    names = ', '.join(f'"{column}"' for column in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    return f'INSERT OR REPLACE INTO {table} ({names}) VALUES ({placeholders})'
+
+
+_UPSERT_SQL = {table: _upsert_sql(table) for table in _KEY_COLUMNS}
+
+_encode = json.JSONEncoder(separators=(',', ':'), check_circular=False).encode
+
+
+class SQLiteStore:
+    """
+    Durable storage for the records of SpreadsheetModel
+    Connections come from a pool of at most max_connections, opened in WAL
+    mode so readers never block the writer; a thread waits for one to come
+    free rather than opening its own, so a server with many request threads
+    holds a bounded number of connections. Statements are fixed strings, so
+    sqlite3's per-connection statement cache prepares each one once. Writes
+    inside transaction() are committed together, and the transaction keeps
+    its connection until it ends.
+    """
+
+    def __init__(self, path: str, max_connections: int = 4):
+        self.path = path
+        # The connection held by the calling thread's open transaction
+        self._local = threading.local()
+        self._idle: List[sqlite3.Connection] = []
+        self._connections: List[sqlite3.Connection] = []
+        self._slots = threading.Semaphore(max_connections)
+        self._lock = threading.Lock()
+        with self.connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False, cached_statements=64)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only syncs at checkpoints and is still safe from corruption
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        A connection for the calling thread: the one its open transaction
+        holds, or one taken from the pool until the block ends
+        """
+        held = getattr(self._local, 'connection', None)
+        if held is not None:
+            yield held
+            return
+        self._slots.acquire()
+        try:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._open()
+            try:
+                yield connection
+            finally:
+                with self._lock:
+                    self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Group writes into one transaction; nested calls join the outer one"""
+        if getattr(self._local, 'connection', None) is not None:
+            yield self._local.connection
+            return
+        with self.connection() as connection:
+            # Take the write lock up front: with several threads writing, a deferred
+            # transaction can fail to upgrade, while IMMEDIATE waits for its turn
+            connection.execute('BEGIN IMMEDIATE')
+            self._local.connection = connection
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                # A failed COMMIT leaves the transaction open too
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                raise
+            finally:
+                self._local.connection = None
+
+    def upsert(self, table: str, records: Iterable[Dict]):
+        """Insert or replace records by id"""
+        keys = _KEY_COLUMNS[table]
+        rows = ((record['id'],) + tuple(record.get(key) for key in keys) + (_encode(record),)
+                for record in records)
+        with self.transaction() as connection:
+            connection.executemany(_UPSERT_SQL[table], rows)
+
+    def delete(self, table: str, column: str, value):
+        """Delete the records whose indexed column equals value"""
+        if column != 'id' and column not in _KEY_COLUMNS[table]:
+            raise ValueError(f"{column} is not an indexed column of {table}")
+        with self.transaction() as connection:
+            connection.execute(f'DELETE FROM {table} WHERE "{column}" = ?', (value,))
+
+    def delete_ids(self, table: str, ids: Iterable[int]):
+        """Delete records by id"""
+        with self.transaction() as connection:
+            connection.executemany(f'DELETE FROM {table} WHERE id = ?', ((record_id,) for record_id in ids))
+
+    def load(self, table: str) -> Iterator[Dict]:
+        """Every record of a table, in id order"""
+        with self.connection() as connection:
+            for (data,) in connection.execute(f'SELECT data FROM {table} ORDER BY id'):
+                yield json.loads(data)
+
+    def get(self, table: str, ids: Iterable[int]) -> Dict[int, Dict]:
+        """The stored records among ids, by id"""
+        records = {}
+        with self.connection() as connection:
+            for record_id in ids:
+                row = connection.execute(f'SELECT data FROM {table} WHERE id = ?', (record_id,)).fetchone()
+                if row is not None:
+                    records[record_id] = json.loads(row[0])
+        return records
+
+    def select(self, table: str, column: str, value) -> List[Dict]:
+        """The records whose indexed column equals value, in id order"""
+        if column != 'id' and column not in _KEY_COLUMNS[table]:
+            raise ValueError(f"{column} is not an indexed column of {table}")
+        with self.connection() as connection:
+            rows = connection.execute(f'SELECT data FROM {table} WHERE "{column}" = ? ORDER BY id',
+                                      (value,)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def last_id(self, table: str) -> int:
+        """The highest id ever stored in a table, including deleted records"""
+        with self.connection() as connection:
+            row = connection.execute(
+                'SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+        return row[0] if row else 0
+
+    def is_empty(self) -> bool:
+        with self.connection() as connection:
+            return not any(connection.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                           for table in _KEY_COLUMNS)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._idle = []
+        self._local = threading.local()
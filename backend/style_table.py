@@ -0,0 +1,52 @@
+import json
+import threading
+from typing import Dict, Iterable, List, Optional
+
+
+def _style_key(formatting: Dict) -> str:
+    return json.dumps(formatting, sort_keys=True, separators=(',', ':'))
+
+
+class StyleTable:
+    """
+    The distinct formatting dicts of a spreadsheet, numbered by first use
+    Cells hold a style id instead of their own formatting. Style 0 is the
+    empty formatting, and styles are never removed, so ids stay valid for
+    the life of the spreadsheet. The styles list is the one kept in the
+    spreadsheet record, so it is persisted with it.
+    """
+
+    def __init__(self, styles: Optional[List[Dict]] = None):
+        if not styles:
+            styles = [{}]
+        self.styles = styles
+        self._ids = {_style_key(formatting): style_id for style_id, formatting in enumerate(styles)}
+        # Sheets of one spreadsheet may add styles from different threads
+        self._lock = threading.Lock()
+
+    def intern(self, formatting: Optional[Dict]) -> int:
+        """The id of formatting, added as a new style when it has none"""
+        if not formatting:
+            return 0
+        key = _style_key(formatting)
+        style_id = self._ids.get(key)
+        if style_id is None:
+            with self._lock:
+                style_id = self._ids.get(key)
+                if style_id is None:
+                    # Appended before it is published, so every id handed out is readable
+                    self.styles.append(dict(formatting))
+                    style_id = self._ids[key] = len(self.styles) - 1
+        return style_id
+
+    def __getitem__(self, style_id: int) -> Dict:
+        return self.styles[style_id]
+
+    def __len__(self) -> int:
+        return len(self.styles)
+
+    def to_dict(self, style_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict]:
+        """style id -> formatting, for every style or only the given ids"""
+        if style_ids is None:
+            return dict(enumerate(self.styles))
+        return {style_id: self.styles[style_id] for style_id in sorted(set(style_ids))}
@@ -0,0 +1,185 @@
+import os
+import pickle
+import re
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from snapshot_file import SnapshotReader, write_snapshot
+
+# Each record is a little-endian (payload length, CRC32 of payload) header and a pickled payload
+_HEADER = struct.Struct('<II')
+_SEGMENT_PATTERN = re.compile(r'^wal\.(\d{8})\.log$')
+SNAPSHOT_FILE = 'snapshot.bin'
+
+
+def _segment_name(sequence: int) -> str:
+    return f'wal.{sequence:08d}.log'
+
+
+def _fsync_directory(directory: str):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    Append-only, segmented redo log with group commit and snapshots
+    Records are buffered by append(); commit() makes them durable. Only one
+    thread writes and fsyncs at a time, and it flushes everything buffered so
+    far, so concurrent writers share one fsync. The log is split into numbered
+    segments: a snapshot starts a new segment and, once written, deletes the
+    segments it covers. Records are pickled, so log files must only come from
+    this process.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._buffer: List[bytes] = []
+        self._appended = 0
+        self._durable = 0
+        # Guards the buffer; _flush_lock serializes writes to the segment file
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        segments = self._segments()
+        self.sequence = segments[-1] if segments else 1
+        self._file = open(os.path.join(directory, _segment_name(self.sequence)), 'ab')
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _segments(self) -> List[int]:
+        found = (_SEGMENT_PATTERN.match(name) for name in os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in found if match)
+
+    # Writing
+    def append(self, record: Any):
+        """Log a record; it is durable once committed (at the end of the outermost group)"""
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._buffer.append(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._buffer.append(payload)
+            self._appended += 1
+            position = self._appended
+        if not getattr(self._local, 'depth', 0):
+            self.commit(position)
+
+    @contextmanager
+    def group(self):
+        """Commit the records appended inside the block together, with one fsync"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+        if not self._local.depth:
+            self.commit(self._appended)
+
+    def commit(self, position: int):
+        """Make every record up to position durable"""
+        with self._flush_lock:
+            if self._durable >= position:
+                # Another thread's fsync already covered it
+                return
+            self._flush()
+
+    def _flush(self):
+        # Caller holds _flush_lock
+        with self._lock:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            position = self._appended
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._durable = position
+
+    # Snapshots
+    def snapshot(self, capture: Callable[[], Tuple[Dict, Dict, Dict]]):
+        """
+        Start a new segment, then write the (current_ids, tables, cell_blocks)
+        returned by capture() as the snapshot and delete the older segments.
+        capture runs after the switch, so every change it may miss is in the
+        new segment; replaying whole-record redo records over a slightly newer
+        state converges to the same result.
+        """
+        with self._flush_lock:
+            self._flush()
+            self._file.close()
+            self.sequence += 1
+            self._file = open(os.path.join(self.directory, _segment_name(self.sequence)), 'ab')
+            sequence = self.sequence
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            write_snapshot(snapshot, sequence, *capture())
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+        _fsync_directory(self.directory)
+        for old in self._segments():
+            if old < sequence:
+                os.remove(os.path.join(self.directory, _segment_name(old)))
+
+    def start_snapshots(self, take: Callable[[], None], interval: float):
+        """Call take() from a background thread every interval seconds, when records were logged"""
+        def run():
+            snapshotted = self._appended
+            while not self._stop.wait(interval):
+                if self._appended != snapshotted:
+                    snapshotted = self._appended
+                    take()
+
+        self._snapshot_thread = threading.Thread(target=run, name='wal-snapshots', daemon=True)
+        self._snapshot_thread.start()
+
+    # Recovery
+    def open_snapshot(self) -> Optional[SnapshotReader]:
+        """The newest snapshot, mapped into memory, or None without one"""
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        return SnapshotReader(path) if os.path.exists(path) else None
+
+    def recover(self) -> Tuple[Optional[SnapshotReader], Iterator[Any]]:
+        """
+        The newest snapshot (None without one) and an iterator over the records
+        logged after it. A torn record at the end of the last segment, left by
+        a crash mid-write, is cut off.
+        """
+        snapshot = self.open_snapshot()
+        return snapshot, self._replay(snapshot.sequence if snapshot is not None else 0)
+
+    def _replay(self, start: int) -> Iterator[Any]:
+        for sequence in self._segments():
+            if sequence < start:
+                continue
+            path = os.path.join(self.directory, _segment_name(sequence))
+            with open(path, 'rb') as segment:
+                data = segment.read()
+            offset = 0
+            while offset + _HEADER.size <= len(data):
+                length, checksum = _HEADER.unpack_from(data, offset)
+                payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                yield pickle.loads(payload)
+                offset += _HEADER.size + length
+            if offset < len(data) and sequence == self.sequence:
+                with self._flush_lock:
+                    self._file.truncate(offset)
+
+    def close(self):
+        self._stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        with self._flush_lock:
+            self._flush()
+            self._file.close()
@@ -2,9 +2,13 @@
 
 import requests
 import sys
+import os
 import json
 from datetime import datetime
 
+# The engine and model checks run in-process against the backend modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
 class UltimatePixelSheetsAPITester:
     def __init__(self, base_url="http://localhost:5000"):
         self.base_url = base_url
@@ -26,6 +30,8 @@ class UltimatePixelSheetsAPITester:
         try:
             if method == 'GET':
                 response = requests.get(url, headers=headers)
+            elif method == 'POST' and isinstance(data, str):
+                response = requests.post(url, data=data, headers=headers)
             elif method == 'POST':
                 response = requests.post(url, json=data, headers=headers)
             elif method == 'PUT':
@@ -56,6 +62,634 @@ class UltimatePixelSheetsAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, {}
 
+    def check(self, name, actual, expected):
+        """Run a single in-process check of a computed value"""
+        self.tests_run += 1
+        print(f"\n🔍 Checking {name}...")
+        if actual == expected:
+            self.tests_passed += 1
+            print(f"✅ Passed - {actual!r}")
+            return True
+        print(f"❌ Failed - Expected {expected!r}, got {actual!r}")
+        return False
+
+    def test_formula_engine(self):
+        """Test formula parsing and evaluation"""
+        print("\n🧮 Testing Formula Engine...")
+        from formula_engine import FormulaEngine
+
+        engine = FormulaEngine()
+        self.check("Multiplication Before Addition", engine.evaluate("=1+2*3"), 7)
+        self.check("Parentheses", engine.evaluate("=(1+2)*3"), 9)
+        self.check("Subtraction Is Left-Associative", engine.evaluate("=10-4-3"), 3)
+        self.check("Power Binds Tighter Than Unary Minus", engine.evaluate("=-2^2"), -4)
+        self.check("Power Is Right-Associative", engine.evaluate("=2^3^2"), 512)
+        self.check("Power Before Multiplication", engine.evaluate("=2*3^2"), 18)
+        self.check("Concatenation After Arithmetic", engine.evaluate('="a"&1+2'), "a3")
+        self.check("Comparison After Arithmetic", engine.evaluate("=1+2=3"), "TRUE")
+        self.check("Doubled Quotes In Strings", engine.evaluate('="say ""hi"""'), 'say "hi"')
+        self.check("IF Skips The Untaken Branch", engine.evaluate("=IF(1>0, 1, 1/0)"), 1)
+        self.check("IF Takes The Else Branch", engine.evaluate('=IF(0, 1/0, "no")'), "no")
+        self.check("IF Without Else", engine.evaluate("=IF(0, 2)"), "FALSE")
+        self.check("Division By Zero", engine.evaluate("=1/0"), "#ERROR: Division by zero")
+
+        engine.set_cells({'A1': '2', 'A2': '3', 'B1': '=A1*A2+SUM(A1:A2)'})
+        self.check("Cell And Range References", engine.evaluate_cell((1, 2)), 11)
+
+        engine.set_cells({'A1': '0.1', 'A2': '0.2', 'A3': '0.3', 'C1': '1e16', 'C2': '1'})
+        self.check("Single Cell Range Sum", engine.evaluate("=SUM(A2:A2)"), 0.2)
+        self.check("Range Sum Ignores Rows Above", engine.evaluate("=SUM(A2:A3)"), 0.5)
+        self.check("Range Average", engine.evaluate("=AVERAGE(A2:A3)"), 0.25)
+        self.check("Small Value Below A Large One", engine.evaluate("=SUM(C2:C2)"), 1)
+        for value in ('0.7', '0.2'):
+            engine.set_cell((2, 1), value)
+        self.check("Range Sum After Updates", engine.evaluate("=SUM(A2:A3)"), 0.5)
+
+        # Blank and text cells are skipped, not counted as 0; an error in the range propagates
+        engine.set_cells({'A1': '1', 'A2': 'hello', 'A4': '3', 'A5': '=1/0',
+                          'B1': '2', 'B2': '="text"', 'B3': '=B1*2'})
+        self.check("SUM Skips Blank And Text", engine.evaluate("=SUM(A1:A4)"), 4)
+        self.check("AVERAGE Skips Blank And Text", engine.evaluate("=AVERAGE(A1:A4)"), 2)
+        self.check("COUNT Skips Blank And Text", engine.evaluate("=COUNT(A1:A4)"), 2)
+        self.check("MIN And MAX Skip Text", [engine.evaluate("=MIN(A1:A4)"), engine.evaluate("=MAX(A1:A4)")], [1, 3])
+        self.check("Formula Results Count, Text Results Do Not",
+                   [engine.evaluate("=SUM(B1:B3)"), engine.evaluate("=COUNT(B1:B3)"), engine.evaluate("=AVERAGE(B1:B3)")],
+                   [6, 2, 3])
+        self.check("Range Of Only Blank And Text", [engine.evaluate("=SUM(A2:A3)"), engine.evaluate("=COUNT(A2:A3)")],
+                   [0, 0])
+        for function in ('SUM', 'AVERAGE', 'COUNT'):
+            self.check(f"{function} Propagates An Error In The Range",
+                       engine.evaluate(f"={function}(A1:A5)"), "#ERROR: Division by zero")
+
+    def test_range_sums(self):
+        """Test range sums against math.fsum on values of mixed magnitude"""
+        print("\n➕ Testing Range Sums...")
+        import math
+        import random
+        from formula_engine import FormulaEngine
+
+        rng = random.Random(7)
+        engine = FormulaEngine()
+        values = {}
+        for row in range(1, 2001):
+            # Huge values around the range, a mix of small ones inside it
+            if row < 500 or row > 1500:
+                value = rng.choice((1e20, -1e20, 3e19)) * rng.random()
+            else:
+                value = rng.choice((1e8, 1.0, 1e-3, -7.5)) * rng.random()
+            values[row] = value
+            engine.set_cell((row, 1), repr(value))
+
+        def close(top, bottom):
+            total, count = engine.range_sum_count(top, 1, bottom, 1)
+            expected = math.fsum(values[row] for row in range(top, bottom + 1))
+            bound = 1e-12 * sum(abs(values[row]) for row in range(top, bottom + 1))
+            return count == bottom - top + 1 and abs(total - expected) <= bound
+
+        self.check("Small Values Between Huge Ones", close(500, 1500), True)
+        self.check("Single Row Between Huge Ones", close(1000, 1000), True)
+        self.check("Range Across Huge Values", close(1, 2000), True)
+        for row in rng.sample(range(500, 1501), 200):
+            values[row] = rng.choice((1e8, 1e-3, -2.0)) * rng.random()
+            engine.set_cell((row, 1), repr(values[row]))
+        for row in rng.sample(range(1, 500), 50):
+            values[row] = 1e21 * rng.random()
+            engine.set_cell((row, 1), repr(values[row]))
+        self.check("Small Values After Point Updates", close(500, 1500), True)
+        self.check("Inner Range After Point Updates", close(700, 900), True)
+
+    def test_dependency_graph(self):
+        """Test recalculation of dependents and cycle detection"""
+        print("\n🔗 Testing Dependency Graph...")
+        from formula_engine import FormulaEngine
+        from models import SpreadsheetModel
+
+        engine = FormulaEngine()
+        engine.set_cells({'A1': '2', 'A2': '3', 'B1': '=A1*2', 'C1': '=B1+1', 'D1': '=SUM(A1:A3)',
+                          'E1': '=F1', 'F1': '=E1+1', 'G1': '=E1'})
+        results = engine.recalculate_all()
+        self.check("Initial Results", [results[(1, 2)], results[(1, 3)], results[(1, 4)]], [4, 5, 5])
+        self.check("Cycle Is Circular", [results[(1, 5)], results[(1, 6)]], ["#CIRCULAR", "#CIRCULAR"])
+        self.check("Reading A Cycle Is Circular", results[(1, 7)], "#CIRCULAR")
+
+        engine.set_cell((1, 1), '5')
+        self.check("Edit Updates Direct And Chained Dependents",
+                   engine.recalculate([(1, 1)]), {(1, 2): 10, (1, 3): 11, (1, 4): 8})
+        engine.set_cell((3, 1), '10')
+        self.check("Edit Inside A Range Updates Only The Range Reader",
+                   engine.recalculate([(3, 1)]), {(1, 4): 18})
+        engine.set_cell((1, 6), '7')
+        self.check("Breaking A Cycle Recovers Its Readers",
+                   engine.recalculate([(1, 6)]), {(1, 5): 7, (1, 7): 7})
+
+        # The sample sheet computes Profit as =B1-B2 from Revenue and Expenses
+        model = SpreadsheetModel()
+        model.update_cell_by_position(1, 1, 2, {'value': '70000'})
+        profit = model.get_calculated_cells_in_range(1, 3, 2, 3, 2)[0][0]
+        self.check("Model Recalculates Dependents On Write", profit.calculated_value, 35000)
+
+        # Loaded formulas compile only when something reaches them
+        engine = FormulaEngine()
+        engine.load_cells([((1, 1), '1')] + [((row, 1), f'=A{row - 1}+1') for row in range(2, 101)]
+                          + [((1, 2), '=SUM(A1:A3)')])
+        self.check("Window Read Of Loaded Formulas", engine.evaluate_cells([(3, 1), (1, 2)]),
+                   {(3, 1): 3, (1, 2): 6})
+        self.check("Formulas Outside The Read Stay Uncompiled", len(engine.uncompiled), 97)
+        engine.set_cell((1, 1), '10')
+        self.check("Edit Reaches Formulas Never Compiled",
+                   engine.recalculate([(1, 1)])[(100, 1)], 109)
+        self.check("Dependents Lookup Compiles The Rest", len(engine.uncompiled), 0)
+
+        # Each level reads the one below twice; the memo makes that linear
+        engine = FormulaEngine()
+        engine.set_cells({'A1': '1', **{f'A{row}': f'=A{row - 1}+A{row - 1}' for row in range(2, 39)}})
+        self.check("Diamond Chain Result", engine.evaluate_cell((38, 1)), 2 ** 37)
+        self.check("Each Formula Evaluated Once Per Pass", engine.last_pass.stats(),
+                   {'evaluations': 37, 'evaluations_saved': 36})
+        engine.evaluate_cell((38, 1))
+        self.check("Current Results Are Reused", engine.last_pass.stats(),
+                   {'evaluations': 0, 'evaluations_saved': 1})
+        engine.set_cell((1, 1), '2')
+        self.check("Edit Reevaluates The Chain Once", [engine.evaluate_cell((38, 1)), engine.last_pass.stats()],
+                   [2 ** 38, {'evaluations': 37, 'evaluations_saved': 36}])
+        model = SpreadsheetModel()
+        model.get_calculated_cells_in_range(1, 1, 1, 3, 3)
+        model.update_cell_by_position(1, 1, 2, {'value': '70000'})
+        self.check("Model Write Evaluates Only The Dependent", model.engines.get(1).last_pass.stats(),
+                   {'evaluations': 1, 'evaluations_saved': 0})
+
+    def test_cold_engine_writes(self):
+        """Test writes to a sheet whose formula engine is not loaded"""
+        print("\n🧊 Testing Writes Without A Warm Engine...")
+        from flask import Flask
+        from models import SpreadsheetModel
+        from routes import register_routes
+
+        model = SpreadsheetModel()
+        app = Flask(__name__)
+        register_routes(app, model)
+        client = app.test_client()
+        self.check("Profit Computed While Warm",
+                   model.get_calculated_cells_in_range(1, 3, 2, 3, 2)[0][0].calculated_value, 15000)
+
+        model.engines.evict(1)
+        written = client.put('/api/sheets/1/cells/3/2', json={'value': '5', 'data_type': 'number'}).get_json()
+        self.check("Constant Written Cold Drops The Old Result", 'calculated_value' in written, False)
+        cells = {(cell.row, cell.column): cell for cell in model.get_calculated_cells(1)}
+        self.check("Calculated Cells Hold No Old Result", cells[(3, 2)].calculated_value, None)
+        exported = client.get('/api/spreadsheets/1/export/csv?values=computed').get_data(as_text=True)
+        self.check("Computed Export Shows The New Value", exported.splitlines()[2].split(',')[1], '5')
+
+        model.engines.evict(1)
+        model.update_cell_by_position(1, 3, 2, {'value': '=B1*2', 'formula': '=B1*2', 'data_type': 'formula'})
+        self.check("Formula Written Cold Drops The Old Result", model.get_cell(1, 3, 2).calculated_value, None)
+        self.check("Formula Written Cold Computes On Read",
+                   model.get_calculated_cells_in_range(1, 3, 2, 3, 2)[0][0].calculated_value, 100000)
+
+    def test_parallel_recalculation(self):
+        """Test that recalculating across worker processes matches recalculating in one"""
+        print("\n🧮 Testing Parallel Recalculation...")
+        import logging
+        from formula_engine import FormulaEngine
+        from parallel_recalc import ParallelRecalculator
+
+        def cells():
+            for row in range(1, 61):
+                yield (row, 1), str(row * 1.5)
+                yield (row, 2), f'=A{row}*2' if row == 1 else f'=B{row - 1}+A{row}'
+                yield (row, 3), f'=SUM(A1:A{row})/B{row}'
+                yield (row, 4), f'=IF(C{row}>0.5, "high", "low") & D{max(row - 1, 1)}' if row > 1 else '="start"'
+                yield (row, 5), f'=B{row}-C{row}+F{row}'
+                yield (row, 6), '=1/0' if row % 17 == 0 else f'=ROUND(A{row}/7, 3)'
+            yield (61, 7), '=H61'
+            yield (61, 8), '=G61+1'
+
+        def engine(recalculator=None):
+            loaded = FormulaEngine(recalculator)
+            loaded.load_cells(cells())
+            return loaded
+
+        serial = engine()
+        recalculator = ParallelRecalculator(2, min_formulas=10, tasks_per_worker=2)
+        passes = []
+        run = recalculator._run
+        recalculator._run = lambda engine, tasks: passes.append(len(tasks)) or run(engine, tasks)
+        parallel = engine(recalculator)
+        expected = serial.recalculate_all()
+        self.check("Parallel Results Match Serial", parallel.recalculate_all(), expected)
+        self.check("Batch Evaluated Across Workers", bool(passes) and passes[0] > 1, True)
+
+        for loaded in (serial, parallel):
+            loaded.set_cell((1, 1), '100')
+        self.check("Parallel Recalculation After An Edit Matches Serial",
+                   parallel.recalculate([(1, 1)]), serial.recalculate([(1, 1)]))
+
+        def broken(engine, tasks):
+            raise OSError('cannot fork')
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('parallel_recalc')
+        logger.addHandler(handler)
+        try:
+            recalculator._run = broken
+            fallback = engine(recalculator)
+            self.check("Failed Pool Falls Back To Serial Results", fallback.recalculate_all(), expected)
+        finally:
+            logger.removeHandler(handler)
+        self.check("Failed Pool Is Logged", [record.exc_info[0] for record in records], [OSError])
+
+    def test_engine_registry(self):
+        """Test eviction of idle and surplus formula engines"""
+        print("\n♻️  Testing Engine Registry...")
+        import time
+        from engine_registry import EngineRegistry
+
+        now = [0.0]
+        registry = EngineRegistry(lambda sheet_id: object(), max_engines=2, idle_seconds=900,
+                                  clock=lambda: now[0])
+        registry.get(1)
+        now[0] = 500
+        registry.get(2)
+        now[0] = 1000
+        registry.evict_idle()
+        self.check("Idle Engine Evicted", sorted(registry.engines), [2])
+
+        now[0] = 1950
+        registry.get(3)
+        self.check("Access Evicts Idle Engines", sorted(registry.engines), [3])
+
+        registry.get(4)
+        registry.get(5)
+        self.check("Least Recently Used Evicted Beyond Max", sorted(registry.engines), [4, 5])
+
+        registry.start_evicting(0.01)
+        now[0] = 5000
+        deadline = time.monotonic() + 5
+        while registry.engines and time.monotonic() < deadline:
+            time.sleep(0.01)
+        registry.close()
+        self.check("Background Thread Evicts Without Traffic", sorted(registry.engines), [])
+
+    def test_persistent_model(self):
+        """Test the SQLite connection pool and in-memory rollback of failed writes"""
+        print("\n💾 Testing Persistent Model...")
+        import sqlite3
+        import tempfile
+        import threading
+        from models import PersistentSpreadsheetModel
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pixelsheets.db')
+            model = PersistentSpreadsheetModel(path)
+
+            def write(row):
+                model.update_cell_by_position(1, row, 5, {'value': str(row)})
+
+            threads = [threading.Thread(target=write, args=(row,)) for row in range(10, 110)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.check("Connections Stay Within The Pool", len(model.store._connections) <= 4, True)
+
+            upsert = model.store.upsert
+
+            def failing_upsert(table, records):
+                list(records)
+                raise sqlite3.OperationalError('disk I/O error')
+
+            model.store.upsert = failing_upsert
+            try:
+                model.update_cells_by_position(1, [{'row': 1, 'column': 2, 'value': '7'},
+                                                   {'row': 9, 'column': 9, 'value': 'new'}])
+            except sqlite3.OperationalError:
+                pass
+            model.store.upsert = upsert
+            self.check("Failed Batch Leaves Memory As Stored",
+                       (model.get_cell(1, 1, 2).value, model.get_cell(1, 9, 9)), ('50000', None))
+            profit = model.get_calculated_cells_in_range(1, 3, 2, 3, 2)[0][0]
+            self.check("Failed Batch Leaves Results As Stored", profit.calculated_value, 15000)
+            model.store.close()
+
+    def test_write_ahead_log(self):
+        """Test recovery of logged writes across restarts, with and without a torn tail"""
+        print("\n📜 Testing Write-Ahead Log Recovery...")
+        import tempfile
+        from models import LoggedSpreadsheetModel
+
+        def segment_path(directory):
+            return os.path.join(directory, sorted(name for name in os.listdir(directory) if name.endswith('.log'))[-1])
+
+        with tempfile.TemporaryDirectory() as directory:
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            model.update_cell_by_position(1, 1, 2, {'value': '70000'})
+            model.update_cells_by_position(1, [{'row': 5, 'column': 1, 'value': 'note'},
+                                               {'row': 5, 'column': 2, 'value': '=B3*2', 'formula': '=B3*2',
+                                                'data_type': 'formula'}])
+            model.close()
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            restored = model.get_calculated_cells_in_range(1, 1, 1, 5, 2)[0]
+            values = {(cell.row, cell.column): cell.calculated_value if cell.formula else cell.value
+                      for cell in restored}
+            self.check("Writes Survive A Restart",
+                       [values.get((1, 2)), values.get((5, 1)), values.get((3, 2)), values.get((5, 2))],
+                       ['70000', 'note', 35000, 70000])
+
+            # A crash in the middle of the last write leaves part of its record
+            model.update_cell_by_position(1, 6, 1, {'value': 'torn'})
+            model.close()
+            path = segment_path(directory)
+            with open(path, 'r+b') as segment:
+                segment.truncate(os.path.getsize(path) - 3)
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            self.check("Torn Record Is Dropped", model.get_cell(1, 6, 1), None)
+            self.check("Records Before The Tear Survive", model.get_cell(1, 5, 1).value, 'note')
+            model.update_cell_by_position(1, 7, 1, {'value': 'after'})
+            model.close()
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            self.check("Writes After A Torn Tail Survive", model.get_cell(1, 7, 1).value, 'after')
+            model.close()
+
+        # A cell replayed out of a sheet still in the snapshot must not come back in it
+        with tempfile.TemporaryDirectory() as directory:
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            target = model.create_sheet({'spreadsheet_id': 1, 'name': 'Moved'})['id']
+            model.take_snapshot()
+            model.close()
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            model.update_cell_by_position(1, 1, 1, {'sheet_id': target})
+            model.close()
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            model.take_snapshot()
+            model.close()
+
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            self.check("Moved Cell Stays Out Of Its Old Sheet", model.get_cell(1, 1, 1), None)
+            moved = model.get_cell(target, 1, 1)
+            self.check("Moved Cell Is In Its New Sheet", moved and (moved.id, moved.value), (1, 'Revenue'))
+            model.close()
+
+            # A new snapshot releases the map of the one it replaces
+            model = LoggedSpreadsheetModel(directory, snapshot_interval=0)
+            previous = model.snapshot
+            model.take_snapshot()
+            try:
+                previous.cell_ids(target)
+                released = False
+            except ValueError:
+                released = True
+            self.check("Replaced Snapshot Is Unmapped", released, True)
+            moved = model.get_cell(target, 1, 1)
+            self.check("Pending Sheets Load From The New Snapshot", moved and moved.value, 'Revenue')
+            model.close()
+
+    def test_cross_sheet_moves(self):
+        """Test cells moved between two sheets in both directions at once"""
+        print("\n🔀 Testing Cross-Sheet Moves...")
+        import threading
+        from models import SpreadsheetModel
+
+        model = SpreadsheetModel()
+        other = model.create_sheet({'spreadsheet_id': 1, 'name': 'Other'})['id']
+        model.update_cell_by_position(1, 50, 1, {'value': 'left'})
+        model.update_cell_by_position(other, 50, 2, {'value': 'right'})
+
+        def shuttle(home, away, column):
+            for _ in range(300):
+                model.update_cell_by_position(home, 50, column, {'sheet_id': away})
+                model.update_cell_by_position(away, 50, column, {'sheet_id': home})
+
+        threads = [threading.Thread(target=shuttle, args=(1, other, 1), daemon=True),
+                   threading.Thread(target=shuttle, args=(other, 1, 2), daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.check("Opposite Moves Do Not Deadlock", [thread.is_alive() for thread in threads], [False, False])
+        self.check("Moved Cells End Up Home",
+                   [model.get_cell(1, 50, 1).value, model.get_cell(other, 50, 2).value], ['left', 'right'])
+
+    def test_cell_writes(self):
+        """Test cell writes that would corrupt the sheet are rejected"""
+        print("\n🛡️ Testing Cell Writes...")
+        from flask import Flask
+        from models import SpreadsheetModel
+        from routes import register_routes
+
+        app = Flask(__name__)
+        model = SpreadsheetModel()
+        register_routes(app, model)
+        client = app.test_client()
+
+        response = client.put('/api/sheets/1/cells/1/1', json={'style_id': 99})
+        self.check("Unknown Style Id Is Rejected", response.status_code, 400)
+        self.check("Sheet Still Reads", client.get('/api/sheets/1/cells').status_code, 200)
+        cell = model.get_cell(1, 1, 1)
+        response = client.put('/api/sheets/1/cells/1/1', json={'id': cell.id + 100})
+        self.check("Cell Id Is Rejected", response.status_code, 400)
+        self.check("Cell Keeps Its Id", model.get_cell(1, 1, 1) is model.cells.get(cell.id), True)
+        response = client.post('/api/sheets/1/cells:batch',
+                               json={'updates': [{'row': 1, 'column': 1, 'value': 'x', 'created_at': 0}]})
+        self.check("Batch With A Timestamp Is Rejected", response.status_code, 400)
+        self.check("Rejected Batch Writes Nothing", model.get_cell(1, 1, 1).value, cell.value)
+
+        # Moving a cell onto another one would leave the index short of model.cells
+        occupant = model.get_cell(1, 1, 2)
+        response = client.put('/api/sheets/1/cells/1/1', json={'row': 1, 'column': 2})
+        self.check("Move Onto A Cell Is Rejected", response.status_code, 400)
+        self.check("Both Cells Stay Put", [model.get_cell(1, 1, 1) is cell, model.get_cell(1, 1, 2) is occupant],
+                   [True, True])
+        self.check("Index Matches The Cells", len(model.sheet_cells[1]),
+                   sum(1 for record in model.cells.values() if record.sheet_id == 1))
+        other = model.create_sheet({'spreadsheet_id': 1, 'name': 'Other'})['id']
+        model.update_cell_by_position(other, 1, 1, {'value': 'taken'})
+        response = client.post('/api/sheets/1/cells:batch',
+                               json={'updates': [{'row': 1, 'column': 2, 'sheet_id': other},
+                                                 {'row': 1, 'column': 1, 'sheet_id': other}]})
+        self.check("Batch Moving Two Cells Onto One Is Rejected", response.status_code, 400)
+        self.check("Rejected Moves Write Nothing", model.get_cell(1, 1, 2) is occupant, True)
+
+    def test_import_types(self):
+        """Test data_type inference when rows are imported and written over"""
+        print("\n📥 Testing Import Type Inference...")
+        from flask import Flask
+        from models import SpreadsheetModel
+        from routes import register_routes
+
+        app = Flask(__name__)
+        model = SpreadsheetModel()
+        register_routes(app, model)
+        client = app.test_client()
+        sheet_id = model.create_sheet({'spreadsheet_id': 1, 'name': 'Imported'})['id']
+
+        def types(row, width=4):
+            return [model.get_cell(sheet_id, row, column).data_type.value for column in range(1, width + 1)]
+
+        body = '1,a,=A1*2,\n2.5,7,=SUM(A1:A2),1e3\n-3,,=B1,\n'
+        response = client.post(f'/api/sheets/{sheet_id}/import', data=body)
+        self.check("Import Counts Cells", response.get_json(), {'rows': 3, 'cells': 9})
+        self.check("Numeric Column Is Number, Mixed Is Text, Formulas Are Formula", types(2),
+                   ['number', 'text', 'formula', 'number'])
+        self.check("Blank Cells Are Not Created", model.get_cell(sheet_id, 3, 2), None)
+        self.check("Imported Formulas Compute",
+                   [cell.calculated_value for cell in model.get_calculated_cells_in_range(sheet_id, 1, 3, 2, 3)[0]],
+                   [2, 3.5])
+
+        # Inference is per chunk, so a column can change type from one chunk to the next
+        model.import_rows(sheet_id, [['1'], ['2'], ['x'], ['3']], start_row=10, chunk_size=2)
+        self.check("Each Chunk Infers Its Own Types",
+                   [model.get_cell(sheet_id, row, 1).data_type.value for row in range(10, 14)],
+                   ['number', 'number', 'text', 'text'])
+
+        # Writing over imported cells takes the types of the new values
+        client.post(f'/api/sheets/{sheet_id}/import', data='x,=A1,5,\n')
+        self.check("Reimport Retypes Existing Cells", [types(1, 3), model.get_cell(sheet_id, 1, 4)],
+                   [['text', 'formula', 'number'], None])
+        model.update_cell_by_position(sheet_id, 1, 1, {'value': '42', 'data_type': 'number'})
+        self.check("Write Keeps Its Data Type", model.get_cell(sheet_id, 1, 1).data_type.value, 'number')
+        self.check("Formula Reads The Written Number",
+                   model.get_calculated_cells_in_range(sheet_id, 1, 2, 1, 2)[0][0].calculated_value, 42)
+
+    def test_sheet_versions(self):
+        """Test conditional GETs of cells and sheets, and delta sync"""
+        print("\n🏷️ Testing Sheet Versions...")
+        from flask import Flask
+        from models import SpreadsheetModel
+        from routes import register_routes
+
+        app = Flask(__name__)
+        model = SpreadsheetModel()
+        register_routes(app, model)
+        client = app.test_client()
+
+        response = client.get('/api/sheets/1/cells')
+        etag = response.headers.get('ETag')
+        response = client.get('/api/sheets/1/cells', headers={'If-None-Match': etag})
+        self.check("Unchanged Cells Are Not Modified", (response.status_code, response.data), (304, b''))
+        self.check("Not Modified Carries The Tag", response.headers.get('ETag'), etag)
+        response = client.get('/api/sheets/1/cells?rows=1-2&cols=1-2', headers={'If-None-Match': etag})
+        self.check("Windowed Read Is Not Modified Either", response.status_code, 304)
+        sheets = client.get('/api/spreadsheets/1/sheets')
+        response = client.get('/api/spreadsheets/1/sheets', headers={'If-None-Match': sheets.headers.get('ETag')})
+        self.check("Unchanged Sheets Are Not Modified", response.status_code, 304)
+        gzipped = client.get('/api/sheets/1/cells', headers={'Accept-Encoding': 'gzip'})
+        self.check("Compressed Body Has Its Own Tag",
+                   [gzipped.headers.get('Content-Encoding'), gzipped.headers.get('ETag') != etag,
+                    gzipped.headers.get('Vary')], ['gzip', True, 'Accept-Encoding'])
+        response = client.get('/api/sheets/1/cells', headers={'Accept-Encoding': 'gzip',
+                                                              'If-None-Match': gzipped.headers.get('ETag')})
+        self.check("Compressed Tag Is Not Modified",
+                   [response.status_code, response.headers.get('ETag')], [304, gzipped.headers.get('ETag')])
+
+        client.put('/api/sheets/1/cells/5/5', json={'value': 'new'})
+        response = client.get('/api/sheets/1/cells', headers={'If-None-Match': etag})
+        self.check("A Write Changes The Tag", [response.status_code, response.headers.get('ETag') != etag], [200, True])
+        response = client.get('/api/spreadsheets/1/sheets', headers={'If-None-Match': sheets.headers.get('ETag')})
+        self.check("A Cell Write Moves The Spreadsheet Version", response.status_code, 200)
+
+        # Delta sync: changes since a version, until the change log no longer reaches it
+        since = model.get_sheet_version(1)
+        client.put('/api/sheets/1/cells/6/6', json={'value': 'later'})
+        changes = client.get(f'/api/sheets/1/changes?since={since}').get_json()
+        self.check("Changes Since A Version", [(cell['row'], cell['column']) for cell in changes['cells']], [(6, 6)])
+        model.change_logs[1].max_entries = 2
+        for column in range(1, 4):
+            client.put(f'/api/sheets/1/cells/7/{column}', json={'value': 'push'})
+        response = client.get(f'/api/sheets/1/changes?since={since}')
+        self.check("Changes Past The Horizon Are Gone",
+                   [response.status_code, response.get_json()['version']], [410, model.get_sheet_version(1)])
+        response = client.get(f'/api/sheets/1/changes?since={model.get_sheet_version(1)}&epoch=other')
+        self.check("Changes From Another Epoch Are Gone", response.status_code, 410)
+        response = client.get(f'/api/sheets/1/changes?since={model.version + 1}')
+        self.check("Changes From A Future Version Are Gone", response.status_code, 410)
+
+    def test_activity_log(self):
+        """Test activity pages, their filters and retention"""
+        print("\n📜 Testing Activity Log...")
+        from models import SpreadsheetModel
+
+        model = SpreadsheetModel(activity_retention=5)
+        for number in range(8):
+            model.create_activity({'spreadsheet_id': 7, 'user_id': number % 2,
+                                   'action': 'cell_updated' if number % 3 else 'sheet_created'})
+        held = [activity['id'] for activity in model.get_activities_by_spreadsheet(7)]
+        self.check("Only The Newest Are Retained", len(held), 5)
+        self.check("Evicted Activities Leave The Model",
+                   sorted(activity['id'] for activity in model.activities.values()
+                          if activity['spreadsheet_id'] == 7), held)
+
+        page, cursor = model.get_activity_page(7, 2)
+        self.check("First Page Is Newest First", [activity['id'] for activity in page], held[:-3:-1])
+        page, cursor = model.get_activity_page(7, 2, cursor)
+        self.check("Next Page Continues From The Cursor", [activity['id'] for activity in page], held[-3:-5:-1])
+        page, cursor = model.get_activity_page(7, 2, cursor)
+        self.check("Last Page Has No Cursor", ([activity['id'] for activity in page], cursor), ([held[0]], None))
+        self.check("Filtered By Action And User",
+                   [(activity['action'], activity['user_id']) for activity in
+                    model.get_activity_page(7, 10, action='cell_updated', user_id=1)[0]],
+                   [('cell_updated', 1)] * 2)
+        self.check("Filter With No Matches", model.get_activity_page(7, 10, action='missing'), ([], None))
+
+        # Long runs drop evicted entries from the front of each series
+        for number in range(3000):
+            model.create_activity({'spreadsheet_id': 8, 'user_id': 1, 'action': 'cell_updated'})
+        page, cursor = model.get_activity_page(8, 10, user_id=1)
+        self.check("Retention Holds Over A Long Run",
+                   [len(model.get_activities_by_spreadsheet(8)), len(page), cursor],
+                   [5, 5, None])
+        self.check("Newest Survive A Long Run", page[0]['id'], max(model.activities))
+
+    def test_activity_writer(self):
+        """Test repeated updates of one cell are recorded as one activity"""
+        print("\n📝 Testing Activity Writer...")
+        from activity_writer import ActivityWriter
+
+        written = []
+        writer = ActivityWriter(written.append, window=60)
+
+        def updated(value, column=1):
+            return {'spreadsheet_id': 1, 'user_id': 1, 'action': 'cell_updated',
+                    'details': {'sheet_id': 1, 'row': 1, 'column': column, 'value': value}}
+
+        for value in ('a', 'b', 'c'):
+            writer.record(updated(value))
+        writer.record(updated('other', column=2))
+        writer.record({'spreadsheet_id': 1, 'user_id': 1, 'action': 'sheet_created', 'details': {'sheet_id': 2}})
+        writer.flush()
+        writer.close()
+
+        self.check("Other Actions Are Written At Once", written[0]['action'], 'sheet_created')
+        coalesced = [activity['details'] for activity in written if activity['action'] == 'cell_updated']
+        self.check("Repeats Of One Cell Are One Activity",
+                   [(details['column'], details['value'], details.get('count')) for details in coalesced],
+                   [(1, 'c', 3), (2, 'other', None)])
+
+    def test_export_during_write(self):
+        """Test a CSV export that a wider write overtakes while it streams"""
+        print("\n📤 Testing Export During Write...")
+        from flask import Flask
+        from models import SpreadsheetModel
+        from routes import register_routes
+
+        app = Flask(__name__)
+        model = SpreadsheetModel()
+        register_routes(app, model)
+        model.import_rows(1, ([str(row), '1', '2'] for row in range(4, 3001)), start_row=4)
+        # The view reads the sheet's bounds, and the test client takes the first chunk of rows
+        response = app.test_client().get('/api/spreadsheets/1/export/csv', buffered=False)
+        model.update_cell_by_position(1, 2500, 10, {'value': 'late'})
+        rows = response.get_data(as_text=True).splitlines()
+        self.check("Export Streams Past A Wider Write", response.status_code, 200)
+        self.check("Export Keeps The Width It Started With",
+                   (len(rows), {row.count(',') for row in rows}), (3000, {2}))
+
     def test_spreadsheets_api(self):
         """Test spreadsheet CRUD operations"""
         print("\n📊 Testing Spreadsheet API...")
@@ -187,6 +821,37 @@ class UltimatePixelSheetsAPITester:
         
         if success:
             print(f"   Found {len(cells)} cells")
+
+        # Test conditional GET cells
+        success, _ = self.run_test(
+            "Get Cells Not Modified",
+            "GET",
+            f"api/sheets/{self.sheet_id}/cells",
+            304,
+            headers={'If-None-Match': '*'}
+        )
+
+        # Test windowed GET cells
+        success, window = self.run_test(
+            "Get Cells Window",
+            "GET",
+            f"api/sheets/{self.sheet_id}/cells?rows=1-50&cols=1-30&limit=100",
+            200
+        )
+
+        if success:
+            print(f"   Found {len(window.get('cells', []))} cells in window")
+        
+        # Test delta sync
+        success, changes = self.run_test(
+            "Get Cell Changes",
+            "GET",
+            f"api/sheets/{self.sheet_id}/changes?since=0",
+            200
+        )
+
+        if success:
+            print(f"   {len(changes.get('cells', []))} changed cells up to version {changes.get('version')}")
         
         # Test UPDATE cell
         cell_data = {
@@ -217,6 +882,134 @@ class UltimatePixelSheetsAPITester:
             data=formula_data
         )
 
+        # Test batch cell update
+        batch_data = {
+            "updates": [
+                {"row": 1, "column": 2, "value": "10"},
+                {"row": 2, "column": 1, "value": "20"},
+                {"row": 3, "column": 1, "value": "=B1+A2", "formula": "=B1+A2", "data_type": "formula"}
+            ]
+        }
+
+        success, batch = self.run_test(
+            "Batch Update Cells",
+            "POST",
+            f"api/sheets/{self.sheet_id}/cells:batch",
+            200,
+            data=batch_data
+        )
+
+        if success:
+            print(f"   Recalculated {len(batch.get('recalculated', []))} formulas")
+            recalculated = {(entry['row'], entry['column']): entry['calculated_value']
+                            for entry in batch.get('recalculated', [])}
+            self.check("Batch Recalculated A3", recalculated.get((3, 1)), 30)
+            written = {(entry['row'], entry['column']): entry for entry in batch.get('cells', [])}
+            self.check("Batch Cell A3 Calculated Value", written.get((3, 1), {}).get('calculated_value'), 30)
+
+        # A batch with a bad entry writes none of its entries
+        self.run_test(
+            "Reject Batch With Bad Entry",
+            "POST",
+            f"api/sheets/{self.sheet_id}/cells:batch",
+            400,
+            data={"updates": [
+                {"row": 1, "column": 2, "value": "7"},
+                {"row": 1, "column": 3, "value": "x", "data_type": "bogus"}
+            ]}
+        )
+
+        success, window = self.run_test(
+            "Get Cell After Rejected Batch",
+            "GET",
+            f"api/sheets/{self.sheet_id}/cells?rows=1-3&cols=1-3",
+            200
+        )
+
+        if success:
+            values = {(c['row'], c['column']): c for c in window.get('cells', [])}
+            self.check("B1 Unchanged By Rejected Batch", values.get((1, 2), {}).get('value'), '10')
+            self.check("C1 Unchanged By Rejected Batch", values.get((1, 3), {}).get('value') == 'x', False)
+            self.check("A3 Unchanged By Rejected Batch", values.get((3, 1), {}).get('calculated_value'), 30)
+
+        self.run_test(
+            "Batch Update Unknown Sheet",
+            "POST",
+            "api/sheets/999999/cells:batch",
+            404,
+            data={"updates": [{"row": 1, "column": 1, "value": "1"}]}
+        )
+
+        # Test range formatting and the style table
+        format_data = {"top": 1, "left": 1, "bottom": 3, "right": 3, "formatting": {"bold": True}, "merge": True}
+
+        success, formatted = self.run_test(
+            "Format Cell Range",
+            "POST",
+            f"api/sheets/{self.sheet_id}/cells:format",
+            200,
+            data=format_data
+        )
+
+        if success:
+            print(f"   Formatted {formatted.get('cells', 0)} cells")
+
+        success, compact = self.run_test(
+            "Get Cells With Style Table",
+            "GET",
+            f"api/sheets/{self.sheet_id}/cells?styles=table",
+            200
+        )
+
+        if success:
+            print(f"   Found {len(compact.get('styles', {}))} styles")
+
+        success, rows = self.run_test(
+            "Get Cells As Rows",
+            "GET",
+            f"api/sheets/{self.sheet_id}/cells?format=rows",
+            200
+        )
+
+        if success:
+            print(f"   Found {len(rows.get('rows', []))} rows of {len(rows.get('keys', []))} keys")
+
+        # Test CSV import
+        success, imported = self.run_test(
+            "Import CSV",
+            "POST",
+            f"api/sheets/{self.sheet_id}/import?row=100",
+            201,
+            data="1,2,=A100+B100\n3,4,=A101+B101\n",
+            headers={'Content-Type': 'text/csv'}
+        )
+
+        if success:
+            print(f"   Imported {imported.get('cells', 0)} cells")
+
+    def test_events_api(self):
+        """Test the sheet event stream"""
+        print("\n📡 Testing Events API...")
+
+        if not self.sheet_id:
+            print("❌ No sheet ID available for events tests")
+            return
+
+        self.tests_run += 1
+        url = f"{self.base_url}/api/sheets/{self.sheet_id}/events"
+        print(f"\n🔍 Testing Sheet Events...")
+        print(f"   GET {url}")
+        try:
+            with requests.get(url, stream=True, timeout=5) as response:
+                first = next(line for line in response.iter_lines(decode_unicode=True) if line.startswith('event:'))
+            if response.status_code == 200 and first == 'event: changes':
+                self.tests_passed += 1
+                print(f"✅ Passed - First event: {first}")
+            else:
+                print(f"❌ Failed - Status: {response.status_code}, first event: {first}")
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+
     def test_activities_api(self):
         """Test activities API"""
         print("\n📝 Testing Activities API...")
@@ -235,6 +1028,16 @@ class UltimatePixelSheetsAPITester:
         if success:
             print(f"   Found {len(activities)} activities")
 
+        success, page = self.run_test(
+            "Get Activities Page",
+            "GET",
+            f"api/spreadsheets/{self.spreadsheet_id}/activities?limit=10&action=cell_updated",
+            200
+        )
+
+        if success:
+            print(f"   Found {len(page.get('activities', []))} activities, next before: {page.get('next_before')}")
+
     def test_collaborators_api(self):
         """Test collaborators API"""
         print("\n👥 Testing Collaborators API...")
@@ -271,6 +1074,13 @@ class UltimatePixelSheetsAPITester:
         if success:
             print(f"   CSV export successful, data length: {len(str(csv_data))}")
 
+        success, csv_data = self.run_test(
+            "Export CSV Computed Values",
+            "GET",
+            f"api/spreadsheets/{self.spreadsheet_id}/export/csv?values=computed",
+            200
+        )
+
     def test_comments_api(self):
         """Test comments API"""
         print("\n💬 Testing Comments API...")
@@ -304,6 +1114,23 @@ class UltimatePixelSheetsAPITester:
         """Run all API tests"""
         print("🚀 Starting Ultimate Pixel Sheets API Tests...")
         print(f"Testing against: {self.base_url}")
+
+        # In-process checks of the engine and model; these need no server
+        self.test_formula_engine()
+        self.test_range_sums()
+        self.test_dependency_graph()
+        self.test_cold_engine_writes()
+        self.test_parallel_recalculation()
+        self.test_engine_registry()
+        self.test_persistent_model()
+        self.test_write_ahead_log()
+        self.test_cross_sheet_moves()
+        self.test_cell_writes()
+        self.test_import_types()
+        self.test_sheet_versions()
+        self.test_activity_log()
+        self.test_activity_writer()
+        self.test_export_during_write()
         
         # Test basic connectivity
         try:
@@ -317,6 +1144,7 @@ class UltimatePixelSheetsAPITester:
         self.test_spreadsheets_api()
         self.test_sheets_api()
         self.test_cells_api()
+        self.test_events_api()
         self.test_activities_api()
         self.test_collaborators_api()
         self.test_export_api()